@@ -8,27 +8,175 @@ This script generates the 'blockMeshDict' file for meshing a 1D,
 discrete pellets. It automates the  process by reading the necessary
 input parameters from a file named 'rodDict'.The 'rodDict' file must
 be located in the same directory as this script.
+
+The generator can also be used from Python without touching the disk:
+
+    import rodMaker
+    mesh = rodMaker.build_rod(rodMaker.readRodDict('rodDict'))
+    mesh.write('system/blockMeshDict')
 """
 
 import math
+import copy
 from collections import defaultdict
 import os
 import re
 # importing the module 
 import ast
 import random
+import tempfile
+import argparse
+import glob
+import hashlib
+import io
+import itertools
+import json
+import pprint
+import shutil
+import errno
+import fcntl
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+
+__version__ = "1.1"
 
 ###################################################################################################################################################
 ######################----------------------------- UNIVERSAL FUNCTIONS FOR ALL GEOMETRIES ------------------------------######################
 ###################################################################################################################################################
 
+class GrowableArray:
+    """
+    Contiguous (N, width) array that grows geometrically, so that rows can be
+    appended one by one or in bulk at amortized constant cost. 'view' gives
+    the filled rows without copying them.
+    """
+
+    def __init__(self, width, dtype=np.float64, capacity=64):
+        self._data = np.empty((capacity, width), dtype=dtype)
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def view(self):
+        return self._data[:self._size]
+
+    def reserve(self, capacity):
+        if capacity > len(self._data):
+            data = np.empty((max(capacity, 2*len(self._data)), self._data.shape[1]), dtype=self._data.dtype)
+            data[:self._size] = self._data[:self._size]
+            self._data = data
+
+    def grow(self, n):
+        # appends n uninitialized rows and returns them, to be filled in place
+        self.reserve(self._size + n)
+        self._size += n
+        return self._data[self._size - n:self._size]
+
+    def append(self, row):
+        self.grow(1)[0] = row
+
+    def extend(self, rows):
+        rows = np.asarray(rows, dtype=self._data.dtype).reshape(-1, self._data.shape[1])
+        self.grow(len(rows))[:] = rows
+
+class BlockStore:
+    """
+    Hex blocks as arrays: vertex labels (N, 8), number of cells (N, 3) and
+    the id of the block name (cellZone), the names being kept once in
+    'zoneNames'.
+    """
+
+    def __init__(self):
+        self.hexes = GrowableArray(8, np.int32)
+        self.cells = GrowableArray(3, np.int32)
+        self._zones = GrowableArray(1, np.int32)
+        self.zoneNames = []
+        self._zoneIds = {}
+
+    def __len__(self):
+        return len(self.hexes)
+
+    @property
+    def zones(self):
+        return self._zones.view[:, 0]
+
+    def zoneId(self, name):
+        if name not in self._zoneIds:
+            self._zoneIds[name] = len(self.zoneNames)
+            self.zoneNames.append(name)
+        return self._zoneIds[name]
+
+    def append(self, vertices, mesh, name):
+        self.hexes.append(vertices)
+        self.cells.append(mesh)
+        self._zones.append(self.zoneId(name))
+
+    def extend(self, hexes, cells, zones):
+        self.hexes.extend(hexes)
+        self.cells.extend(cells)
+        self._zones.extend(zones)
+
+class EdgeStore:
+    """
+    Arc edges as arrays: the two end vertex labels (M, 2) and the point the
+    arc passes through (M, 3).
+    """
+
+    def __init__(self):
+        self.ends = GrowableArray(2, np.int32)
+        self.midpoints = GrowableArray(3)
+
+    def __len__(self):
+        return len(self.ends)
+
+    def append(self, vertices, midpoint):
+        self.ends.append(vertices)
+        self.midpoints.append(midpoint)
+
+class ProjectionStore:
+    """
+    Faces projected on the dish spheres: the face vertex labels (K, 4) and
+    the index of the sphere each face is projected on.
+    """
+
+    def __init__(self):
+        self.faces = GrowableArray(4, np.int32)
+        self._spheres = GrowableArray(1, np.int32)
+
+    def __len__(self):
+        return len(self.faces)
+
+    @property
+    def spheres(self):
+        return self._spheres.view[:, 0]
+
+    def append(self, face, sphere_index):
+        self.faces.append(face)
+        self._spheres.append(sphere_index)
+
+    def extend(self, faces, sphereIds):
+        self.faces.extend(faces)
+        self._spheres.extend(sphereIds)
+
+class TemplateRecorder(list):
+    """
+    Stands in for the vertex, block, edge, projection and sphere stores while
+    the pattern of a single pellet is built: it keeps the arguments of every
+    append, which may hold one value per pellet (see addStampedPellets).
+    """
+
+    def append(self, *args):
+        super().append(args)
+
 def appendBlock(list_blocks, vertices, mesh, name):
-    block = {
-        "name" : name,
-        "vertices" : vertices,
-        "mesh" : mesh
-    }
-    list_blocks.append(block)
+    list_blocks.append(vertices, mesh, name)
 
 def addToPatchDict(patchDict, name, type, neighbour, owner, face):
     if name not in patchDict:
@@ -212,24 +360,9 @@ def addSpheres(list_spheres,pellet, offset, geometry, shiftX=0, shiftY=0):
             z_bottom=offset - math.sqrt(R**2-r_dish**2)
             z_top=offset + h + math.sqrt(R**2-r_dish**2)
 
-            bottom_sphere = {
-
-                "z":                z_bottom,
-                "radius":           R,
-                "x":                shiftX,
-                "y":                shiftY
-
-            }
-            list_spheres.append(bottom_sphere)
-
-            top_sphere = {
-                "z":                z_top,
-                "radius":           R,
-                "x":                shiftX,
-                "y":                shiftY
-            }
-            
-            list_spheres.append(top_sphere)
+            # each sphere is stored as (x, y, z, radius)
+            list_spheres.append([shiftX, shiftY, z_bottom, R])
+            list_spheres.append([shiftX, shiftY, z_top, R])
 
 
 def append4SymVertices(list_vertices, xy, height, shiftX=0, shiftY=0):
@@ -827,12 +960,7 @@ def addCladBlocks(list_blocks, clad_block, i_vertex, geometry):
 
 
 def appendEdge(list_edges, vertices, midpoint):
-
-    edge = {
-        "vertices": vertices,
-        "midpoint": midpoint
-    }
-    list_edges.append(edge)
+    list_edges.append(vertices, midpoint)
 
 def append8AzimuthallySymmEdges(list_edges, i_vertex, baseEdge, shift, pelletHeight, xy, h, offset, shiftX=0, shiftY=0):
     baseEdge=[x + i_vertex for x in baseEdge]
@@ -1073,12 +1201,7 @@ def addCladEdges(list_edges, clad_block, i_vertex, offset, geometry):
 
 
 def appendFaceProjection(list_projection_faces, face, sphere_index):
-
-    projection = {
-        "face" : face,
-        "sphere" :  f'sphere_{sphere_index}'
-    }
-    list_projection_faces.append(projection)
+    list_projection_faces.append(face, sphere_index)
 
 def addFaceProjections(list_projection_faces, pellet, i_vertex, i_sphere, geometry):
     if geometry=="3D":
@@ -1251,21 +1374,21 @@ def addFuelToPatchDict(patchDict, mergePatchDict, pellet, merging, N_pellets, bo
                     addToPatchDict(patchDict, "fuelTop_" + str(i_global), 'regionCoupledOFFBEAT', "fuelBottom_" + str(i_global+1), "false", base)
                 else:
                     addToPatchDict(patchDict, "fuelTop_" + str(i_global), "patch", "none", "false", base)
+    
+        ###################################################################################################################
+        ####################################  Setting the inner boundary patches ##########################################
+        ###################################################################################################################
+                
+        if rInner>0:
+            base=[x + i_vertex for x in [1, 0, shift, shift+1]]
+            addToPatchDict(patchDict, "fuelInner", "patch", "none", "false", base)
         
-            ###################################################################################################################
-            ####################################  Setting the inner boundary patches ##########################################
-            ###################################################################################################################
-                    
-            if rInner>0:
-                base=[x + i_vertex for x in [1, 0, shift, shift+1]]
-                addToPatchDict(patchDict, "fuelInner", "patch", "none", "false", base)
-            
-            ###################################################################################################################
-            ####################################  Setting the outer boundary patches ##########################################
-            ###################################################################################################################
+        ###################################################################################################################
+        ####################################  Setting the outer boundary patches ##########################################
+        ###################################################################################################################
 
-            base=[x + i_vertex for x in [shift-2, shift-1, 2*shift-2, 2*shift-1]]  
-            addToPatchDict(patchDict, "fuelOuter", "regionCoupledOFFBEAT", "cladInner", "true", base)
+        base=[x + i_vertex for x in [shift-2, shift-1, 2*shift-2, 2*shift-1]]  
+        addToPatchDict(patchDict, "fuelOuter", "regionCoupledOFFBEAT", "cladInner", "true", base)
         
 
     #**************************************************   3D  *********************************************************
@@ -1652,12 +1775,836 @@ def addCladToPatchDict(patchDict, mergePatchDict, clad_block, merging, N_blocks,
         addToPatchDict(patchDict, "cladOuter", 'patch',  'none', "false", base)
             
 
+###################################################################################################################################################
+#########################------------------------------------------ PELLET STAMPING ------------------------------------------#########################
+###################################################################################################################################################
+
+# All the pellets of a fuel block share the same shape: they only differ by
+# their axial offset, their eccentricity shift and the index of their first
+# vertex (and sphere). The builders above are therefore called once per fuel
+# block with the offsets and shifts of all its pellets given as arrays, and
+# the resulting single-pellet pattern is translated to every pellet at once.
+
+def stampRows(rows, nPellets, dtype=float, out=None):
+    # rows: list of rows whose entries are scalars or arrays with one value
+    # per pellet -> array of shape (nPellets, len(rows), len(row))
+    width = len(rows[0]) if rows else 0
+    stamped = np.empty((nPellets, len(rows), width), dtype=dtype) if out is None else out
+    for r, row in enumerate(rows):
+        for c, value in enumerate(row):
+            stamped[:, r, c] = value
+    return stamped
+
+# The block and face-projection topology of a pellet does not depend on its
+# dimensions, only on the entries below: it is cached so that rods sharing a
+# pellet discretization (e.g. the variants of a parameter sweep) reuse it.
+TOPOLOGY_KEYS = ("blockName", "type", "nVertices", "nCellsAzimuthal", "nCellsRPellet",
+                 "nCellsRDish", "nCellsRChamfer", "nCellsZPellet")
+TOPOLOGY_CACHE_SIZE = 256
+topologyCache = {}
+
+def pelletTopology(pellet, geometry):
+    key = (geometry, pellet["rInner"]==0) + tuple(pellet.get(k) for k in TOPOLOGY_KEYS)
+    topology = topologyCache.get(key)
+    if topology is None:
+        template = TemplateRecorder()
+        addFuelBlocks(template, pellet, 0, geometry)
+        hexes = np.array([vertices for vertices, cells, name in template], dtype=np.int32)
+        cells = np.array([cells for vertices, cells, name in template], dtype=np.int32)
+        names = [name for vertices, cells, name in template]
+
+        template = TemplateRecorder()
+        addFaceProjections(template, pellet, 0, 2, geometry)
+        faces = np.array([face for face, sphere_index in template], dtype=np.int32).reshape(-1, 4)
+        sphereIds = np.array([sphere_index for face, sphere_index in template], dtype=np.int32)
+
+        if len(topologyCache) >= TOPOLOGY_CACHE_SIZE:
+            topologyCache.clear()
+        topology = topologyCache[key] = (hexes, cells, names, faces, sphereIds)
+    return topology
+
+def addStampedPellets(mesh, pellet, nPellets, i_vertex, i_sphere, offsets, shiftX, shiftY, geometry):
+
+    nVertices = pellet["nVertices"]
+    vertexBase = i_vertex + nVertices*np.arange(nPellets)
+
+    ################################# spheres #############################################
+    template = TemplateRecorder()
+    addSpheres(template, pellet, offsets, geometry, shiftX, shiftY)
+    nSpheres = len(template)
+    rows = mesh.spheres.grow(nPellets*nSpheres)
+    stampRows([sphere for sphere, in template], nPellets, out=rows.reshape(nPellets, nSpheres, 4))
+
+    ################################# vertices ############################################
+    template = TemplateRecorder()
+    addPelletVertices(template, pellet, offsets, geometry, shiftX, shiftY)
+    rows = mesh.vertices.grow(nPellets*len(template))
+    stampRows([vertex for vertex, in template], nPellets, out=rows.reshape(nPellets, len(template), 3))
+
+    ################################# blocks ##############################################
+    hexes, cells, names, faces, sphereIds = pelletTopology(pellet, geometry)
+    zones = np.array([mesh.blocks.zoneId(name) for name in names], dtype=np.int32)
+    mesh.blocks.extend((hexes[None, :, :] + vertexBase[:, None, None]).reshape(-1, 8), np.tile(cells, (nPellets, 1)), np.tile(zones, nPellets))
+
+    ################################# edges ###############################################
+    template = TemplateRecorder()
+    addFuelEdges(template, pellet, 0, offsets, geometry, shiftX, shiftY)
+    if template:
+        ends = np.array([vertices for vertices, midpoint in template], dtype=np.int32)
+        mesh.edges.ends.extend(ends[None, :, :] + vertexBase[:, None, None])
+        rows = mesh.edges.midpoints.grow(nPellets*len(template))
+        stampRows([midpoint for vertices, midpoint in template], nPellets, out=rows.reshape(nPellets, len(template), 3))
+
+    ################################# face projections ####################################
+    if len(faces):
+        sphereBase = i_sphere - 2 + nSpheres*np.arange(nPellets)
+        mesh.projections.extend(faces[None, :, :] + vertexBase[:, None, None], sphereIds[None, :] + sphereBase[:, None])
+
+    return i_sphere + nPellets*nSpheres
+
+###################################################################################################################################################
+#########################------------------------------------------- AXIAL SHARDING -------------------------------------------#########################
+###################################################################################################################################################
+
+# The pellets only depend on each other through the running vertex, sphere
+# and pellet counters, which follow from the number of rows each pellet of a
+# fuel block adds. With 'buildWorkers' > 1 the pellets of the rod are split
+# into contiguous axial shards, built concurrently by worker processes that
+# write their rows straight into a shared memory segment at offsets computed
+# in advance; the cladding is built by the parent meanwhile. The rows and the
+# patches are then joined in shard order, which gives the same mesh as the
+# serial loop of build_rod.
+
+SHARD_FIELDS = (('vertices', 3, np.float64), ('hexes', 8, np.int32), ('cells', 3, np.int32), ('zones', 1, np.int32),
+                ('edgeEnds', 2, np.int32), ('midpoints', 3, np.float64), ('spheres', 4, np.float64),
+                ('faces', 4, np.int32), ('sphereIds', 1, np.int32))
+
+def fuelLayout(setup):
+    # [(pellet, offsets, shiftX, shiftY)] of the fuel blocks: the axial offset
+    # and the eccentricity shift of each of their pellets
+    geometry = setup["geometry"]
+    eccentricity = setup["eccentricity"]
+    # random shifts of the 'default' eccentricity, reproducible if a seed is given
+    seed = setup.get("eccentricitySeed", None)
+    rng = random if seed is None else random.Random(seed)
+    global_fuel_offset = setup["offsetFuel"]
+    i_global = 1
+
+    layout = []
+    for pellet, nPellets in zip(setup["fuel_blocks"], setup["nPelletsFuel"]):
+        # axial offsets of the pellets of this block, accumulated one
+        # pellet height at a time (the last entry is the top of the block)
+        offsets = np.add.accumulate(np.concatenate(([global_fuel_offset], np.full(nPellets, pellet['height']))))
+
+        shiftX = np.zeros(nPellets)
+        shiftY = np.zeros(nPellets)
+        if geometry == '3D':
+            # the smeared parts of a hybrid stack stay centred
+            if eccentricity and not pellet.get('smeared', False):
+                if setup["eccentricity_mode"] == 'default':
+                    minGap = setup["minGap"]
+                    for j in range(nPellets):
+                        shiftX[j] = rng.uniform(-minGap, minGap)
+                        shiftY[j] = rng.uniform(-minGap, minGap)
+                else:
+                    eccVector = np.array(setup["eccVector"][i_global-1:i_global-1+nPellets], dtype=float).reshape(-1, 2)
+                    shiftX[:] = eccVector[:, 0]
+                    shiftY[:] = eccVector[:, 1]
+
+        layout.append((pellet, offsets[:-1], shiftX, shiftY))
+        if nPellets > 0:
+            global_fuel_offset = offsets[-1].item()
+        i_global += nPellets
+    return layout
+
+def pelletRowCounts(pellet, geometry):
+    # number of rows of each SHARD_FIELDS array added by one pellet
+    single = np.zeros(1)
+    spheres = TemplateRecorder()
+    addSpheres(spheres, pellet, single, geometry, single, single)
+    vertices = TemplateRecorder()
+    addPelletVertices(vertices, pellet, single, geometry, single, single)
+    edges = TemplateRecorder()
+    addFuelEdges(edges, pellet, 0, single, geometry, single, single)
+    hexes, cells, names, faces, sphereIds = pelletTopology(pellet, geometry)
+    return {'vertices': len(vertices), 'hexes': len(hexes), 'cells': len(hexes), 'zones': len(hexes),
+            'edgeEnds': len(edges), 'midpoints': len(edges), 'spheres': len(spheres),
+            'faces': len(faces), 'sphereIds': len(faces)}
+
+def meshRows(mesh, zoneIds):
+    # the SHARD_FIELDS arrays of a mesh, with the zones numbered by zoneIds
+    zones = np.array([zoneIds[name] for name in mesh.blocks.zoneNames], dtype=np.int32)
+    return {'vertices': mesh.vertices.view, 'hexes': mesh.blocks.hexes.view, 'cells': mesh.blocks.cells.view,
+            'zones': zones[mesh.blocks.zones], 'edgeEnds': mesh.edges.ends.view, 'midpoints': mesh.edges.midpoints.view,
+            'spheres': mesh.spheres.view, 'faces': mesh.projections.faces.view, 'sphereIds': mesh.projections.spheres}
+
+def sharedArrays(memory, totals):
+    # views of the SHARD_FIELDS arrays laid out one after the other in 'memory'
+    arrays = {}
+    start = 0
+    for name, width, dtype in SHARD_FIELDS:
+        arrays[name] = np.ndarray((totals[name], width), dtype=dtype, buffer=memory.buf, offset=start)
+        start += totals[name]*width*np.dtype(dtype).itemsize
+    return arrays
+
+def sharedSize(totals):
+    return max(sum(totals[name]*width*np.dtype(dtype).itemsize for name, width, dtype in SHARD_FIELDS), 1)
+
+def mergePatches(mesh, patchDict, mergePatchDict):
+    # appends the patches of a later part of the rod to those of mesh
+    for name, patch in patchDict.items():
+        if name in mesh.patchDict:
+            mesh.patchDict[name]["faces"].extend(patch["faces"])
+        else:
+            mesh.patchDict[name] = patch
+    mesh.mergePatchDict.update(mergePatchDict)
+
+def buildPelletShard(task):
+    # builds the pellet segments of one shard into its rows of the shared
+    # memory and returns the patches of its pellets
+    memoryName, totals, starts, zoneIds, segments, setup = task
+    geometry = setup["geometry"]
+    part = RodMesh(setup["convertToMeters"], geometry)
+    for pellet, offsets, shiftX, shiftY, i_vertex, i_sphere, i_global in segments:
+        addStampedPellets(part, pellet, len(offsets), i_vertex, i_sphere, offsets, shiftX, shiftY, geometry)
+        for j in range(len(offsets)):
+            addFuelToPatchDict(part.patchDict, part.mergePatchDict, pellet, setup["mergeFuelPatchPairs"], setup["totalPelletNumber"],
+                               setup["bottomCap"], setup["topCap"], i_vertex + j*pellet['nVertices'], i_global + j, geometry)
+
+    memory = shared_memory.SharedMemory(name=memoryName)
+    try:
+        arrays = sharedArrays(memory, totals)
+        for name, rows in meshRows(part, zoneIds).items():
+            arrays[name][starts[name]:starts[name] + len(rows)] = rows.reshape(-1, arrays[name].shape[1])
+        del arrays
+    finally:
+        memory.close()
+    return part.patchDict, dict(part.mergePatchDict)
+
+def addShardedRod(mesh, setup, layout, workers):
+    """
+    Adds the pellets of 'layout' (see fuelLayout) and the cladding to the
+    empty mesh with 'workers' processes, as the serial loop of build_rod
+    would. Returns the number of fuel blocks.
+    """
+    geometry = setup["geometry"]
+    counts = [pelletRowCounts(pellet, geometry) for pellet, offsets, shiftX, shiftY in layout]
+    totals = {name: sum(count[name]*len(offsets) for count, (pellet, offsets, shiftX, shiftY) in zip(counts, layout))
+              for name, width, dtype in SHARD_FIELDS}
+
+    # the zones are numbered in the order of the serial loop
+    zoneIds = {}
+    for pellet, offsets, shiftX, shiftY in layout:
+        for name in pelletTopology(pellet, geometry)[2]:
+            zoneIds[name] = mesh.blocks.zoneId(name)
+
+    # counters and rows at the start of every pellet of every block
+    nPellets = sum(len(offsets) for pellet, offsets, shiftX, shiftY in layout)
+    nShards = max(min(workers, nPellets), 1)
+    bounds = [round(k*nPellets/nShards) for k in range(nShards + 1)]
+    tasks = [[] for k in range(nShards)]
+    starts = [None]*nShards
+    rows = dict.fromkeys(totals, 0)
+    i_vertex, i_sphere, i_global = 0, 2, 1
+    for (pellet, offsets, shiftX, shiftY), count in zip(layout, counts):
+        before = (rows['vertices'], rows['edgeEnds'], rows['spheres'])
+        for k in range(nShards):
+            first, last = max(bounds[k] - (i_global - 1), 0), min(bounds[k + 1] - (i_global - 1), len(offsets))
+            if first >= last:
+                continue
+            if starts[k] is None:
+                starts[k] = {name: rows[name] + first*count[name] for name in rows}
+            tasks[k].append((pellet, offsets[first:last], shiftX[first:last], shiftY[first:last],
+                             i_vertex + first*pellet['nVertices'], i_sphere + first*count['spheres'], i_global + first))
+        for name in rows:
+            rows[name] += len(offsets)*count[name]
+        mesh.pelletRows.append((i_global - 1, len(offsets), before, (rows['vertices'], rows['edgeEnds'], rows['spheres'])))
+        i_vertex += len(offsets)*pellet['nVertices']
+        i_sphere += len(offsets)*count['spheres']
+        i_global += len(offsets)
+
+    memory = shared_memory.SharedMemory(create=True, size=sharedSize(totals))
+    try:
+        with ProcessPoolExecutor(max_workers=nShards) as pool:
+            futures = [pool.submit(buildPelletShard, (memory.name, totals, start, zoneIds, segments, setup))
+                       for start, segments in zip(starts, tasks) if segments]
+            # the cladding only follows the pellets through its first vertex
+            cladding = RodMesh(setup["convertToMeters"], geometry)
+            addCladding(cladding, setup, i_vertex)
+            patches = [future.result() for future in futures]
+
+        arrays = sharedArrays(memory, totals)
+        mesh.vertices.extend(arrays['vertices'])
+        mesh.blocks.extend(arrays['hexes'], arrays['cells'], arrays['zones'])
+        mesh.edges.ends.extend(arrays['edgeEnds'])
+        mesh.edges.midpoints.extend(arrays['midpoints'])
+        mesh.spheres.extend(arrays['spheres'])
+        mesh.projections.extend(arrays['faces'], arrays['sphereIds'])
+        del arrays
+    finally:
+        memory.close()
+        memory.unlink()
+    for patchDict, mergePatchDict in patches:
+        mergePatches(mesh, patchDict, mergePatchDict)
+    nFuelBlocks = len(mesh.blocks)
+
+    cladRows = meshRows(cladding, {name: mesh.blocks.zoneId(name) for name in cladding.blocks.zoneNames})
+    mesh.vertices.extend(cladRows['vertices'])
+    mesh.blocks.extend(cladRows['hexes'], cladRows['cells'], cladRows['zones'])
+    mesh.edges.ends.extend(cladRows['edgeEnds'])
+    mesh.edges.midpoints.extend(cladRows['midpoints'])
+    mergePatches(mesh, cladding.patchDict, cladding.mergePatchDict)
+    return nFuelBlocks
+
+###################################################################################################################################################
+#########################----------------------------------------- CONFORMAL STACKING -----------------------------------------#########################
+###################################################################################################################################################
+
+# Consecutive pellets (and cladding blocks) are built with their own vertices
+# and are joined through the patch pairs <material>Top_i / <material>Bottom_i+1,
+# either coupled or merged. When the two faces of a pair coincide, the
+# vertices, arc edges and projections of the bottom one are replaced by
+# those of the top one: the interface then becomes a set of internal faces.
+
+def relabelVertices(mesh, labels):
+    # Replaces every vertex label v by labels[v] in the blocks, arc edges,
+    # projections and patches, then drops the vertices no block uses and the
+    # arc edges and projections that became duplicated or unused
+    hexes = mesh.blocks.hexes.view
+    hexes[:] = labels[hexes]
+    used = np.zeros(len(mesh.vertices), dtype=bool)
+    used[hexes] = True
+    compact = np.cumsum(used) - 1
+    compact[~used] = -1
+
+    keptVertices = mesh.vertices.view[used]
+    mesh.vertices = GrowableArray(3, capacity=max(len(keptVertices), 1))
+    mesh.vertices.extend(keptVertices)
+    hexes[:] = compact[hexes]
+
+    ends = compact[labels[mesh.edges.ends.view]]
+    keep = np.all(ends >= 0, axis=1)
+    first = np.sort(np.unique(np.sort(ends, axis=1), axis=0, return_index=True)[1])
+    first = first[keep[first]]
+    edges = EdgeStore()
+    edges.ends.extend(ends[first])
+    edges.midpoints.extend(mesh.edges.midpoints.view[first])
+    mesh.edges = edges
+
+    faces = compact[labels[mesh.projections.faces.view]]
+    sphereIds = mesh.projections.spheres
+    keep = np.all(faces >= 0, axis=1)
+    first = np.sort(np.unique(np.column_stack((np.sort(faces, axis=1), sphereIds)), axis=0, return_index=True)[1])
+    first = first[keep[first]]
+    projections = ProjectionStore()
+    projections.extend(faces[first], sphereIds[first])
+    mesh.projections = projections
+
+    for patch in mesh.patchDict.values():
+        patch['faces'] = compact[labels[np.array(patch['faces'], dtype=int).reshape(-1, 4)]].tolist()
+
+def interfaceEdges(mesh, faces):
+    # {(sorted end labels): midpoint or None} of the edges of 'faces'
+    arcs = {tuple(sorted(ends)): midpoint for ends, midpoint in zip(mesh.edges.ends.view.tolist(), mesh.edges.midpoints.view)}
+    edges = {}
+    for face in faces:
+        for ends in zip(face, face[1:] + face[:1]):
+            if ends[0] != ends[1]:
+                key = tuple(sorted(ends))
+                edges[key] = arcs.get(key)
+    return edges
+
+def interfaceProjections(mesh, faces):
+    # {(sorted face labels): sphere} of the projected faces among 'faces'
+    spheres = mesh.spheres.view
+    projected = {tuple(sorted(face)): tuple(spheres[s]) for face, s in zip(mesh.projections.faces.view.tolist(), mesh.projections.spheres.tolist())}
+    return {key: projected[key] for key in (tuple(sorted(face)) for face in faces) if key in projected}
+
+def coincidentInterface(mesh, top, bottom, tolerance):
+    # {bottom label: top label} if the faces of the patches top and bottom
+    # coincide with the same edges and projections, None otherwise
+    topFaces, bottomFaces = mesh.patchDict[top]['faces'], mesh.patchDict[bottom]['faces']
+    if len(topFaces) != len(bottomFaces):
+        return None
+    topLabels, bottomLabels = np.unique(topFaces), np.unique(bottomFaces)
+    pairs = matchPoints(mesh.vertices.view, topLabels, bottomLabels, tolerance)
+    if len(topLabels) != len(bottomLabels) or len(pairs) != len(bottomLabels):
+        return None
+    mappedFaces = [[pairs[label] for label in face] for face in bottomFaces]
+    if {tuple(sorted(face)) for face in topFaces} != {tuple(sorted(face)) for face in mappedFaces}:
+        return None
+    topToBottom = {t: b for b, t in pairs.items()}
+    bottomEdges = interfaceEdges(mesh, bottomFaces)
+    for (a, b), midpoint in interfaceEdges(mesh, topFaces).items():
+        other = bottomEdges.get(tuple(sorted((topToBottom[a], topToBottom[b]))), False)
+        if other is False or (midpoint is None) != (other is None) or (midpoint is not None and np.abs(midpoint - other).max() > tolerance):
+            return None
+    topProjections = interfaceProjections(mesh, topFaces)
+    bottomProjections = {tuple(sorted(pairs[label] for label in key)): sphere for key, sphere in interfaceProjections(mesh, bottomFaces).items()}
+    if topProjections.keys() != bottomProjections.keys() or any(
+            np.abs(np.subtract(topProjections[key], bottomProjections[key])).max() > tolerance for key in topProjections):
+        return None
+    return pairs
+
+def weldConformalInterfaces(mesh):
+    """
+    Shares the vertices of the coincident interfaces between consecutive
+    pellets or cladding blocks, removing the duplicated arc edges and face
+    projections and the patch pair (and merge) of each welded interface.
+    Returns the names of the removed patches.
+    """
+    vertices = mesh.vertices.view
+    tolerance = 1e-7*np.ptp(vertices, axis=0).max()
+    remap = np.arange(len(vertices))
+    welded = []
+    for top in list(mesh.patchDict):
+        match = re.fullmatch(r"(fuel|clad)Top_(\d+)", top)
+        bottom = match and "%sBottom_%d" % (match.group(1), int(match.group(2)) + 1)
+        if bottom not in mesh.patchDict:
+            continue
+        pairs = coincidentInterface(mesh, top, bottom, tolerance)
+        if pairs is not None:
+            remap[list(pairs)] = list(pairs.values())
+            welded += [top, bottom]
+    if not welded:
+        return welded
+
+    while np.any(remap[remap] != remap):
+        remap = remap[remap]
+    for name in welded:
+        del mesh.patchDict[name]
+        mesh.mergePatchDict.pop(name, None)
+    relabelVertices(mesh, remap)
+    return welded
+
+###################################################################################################################################################
+#########################---------------------------------------- AZIMUTHAL SYMMETRY ----------------------------------------#########################
+###################################################################################################################################################
+
+# The 3D fuel and cladding are made of 4 azimuthal blocks per ring, each one
+# spanning the sector between two diagonals (x = +-y), and of a square block
+# around the axis for solid pellets and caps. A symmetric rod can be cut along
+# the diagonal planes: the blocks outside the kept sectors are dropped, the
+# square is replaced by one triangular (collapsed) block per kept sector and
+# symmetryPlane patches close the cut.
+
+# kept sectors, as the range of the azimuth (degrees) of the block centres,
+# and the normals of the cut planes
+SYMMETRY_SECTORS = {'half': (-45, 135), 'quarter': (-45, 45)}
+SYMMETRY_PLANES = {'half': [(1, 1)], 'quarter': [(1, 1), (1, -1)]}
+
+def cutSymmetry(mesh, symmetry, nFuelBlocks):
+    """
+    Keeps the 'half' (x + y > 0) or the 'quarter' (|y| < x) of a symmetric
+    3D rod, the first nFuelBlocks blocks being the fuel, and adds the
+    symmetryPlane patches fuelSymmetry<n> and cladSymmetry<n> on the cut
+    planes (no number for the half).
+    """
+    if symmetry not in SYMMETRY_SECTORS:
+        raise ValueError("symmetry must be 'half' or 'quarter', not %r" % (symmetry,))
+    lo, hi = SYMMETRY_SECTORS[symmetry]
+    vertices = mesh.vertices.view
+    tolerance = 1e-7*np.ptp(vertices, axis=0).max()
+    azimuth = lambda xy: math.degrees(math.atan2(xy[1], xy[0]))
+    projected = {tuple(sorted(face)): sphere for face, sphere in zip(mesh.projections.faces.view.tolist(), mesh.projections.spheres.tolist())}
+
+    blocks = []
+    centres = []
+    replaced = defaultdict(list)
+    for b, (hex, cells, zone) in enumerate(zip(mesh.blocks.hexes.view.tolist(), mesh.blocks.cells.view.tolist(), mesh.blocks.zones.tolist())):
+        centre = vertices[hex, :2].mean(axis=0)
+        if np.hypot(*centre) > tolerance:
+            if lo < azimuth(centre) < hi:
+                blocks.append((hex, cells, zone, b < nFuelBlocks))
+            continue
+
+        # block around the axis: one triangle per kept sector, from a new
+        # vertex on the axis to a side of the square
+        if np.any(vertices[hex[4:], 2] <= vertices[hex[:4], 2]):
+            raise ValueError("the block %d around the axis is not axial, it cannot be cut" % b)
+        axis = []
+        for ring in (hex[:4], hex[4:]):
+            point = vertices[ring].mean(axis=0)
+            sphere = projected.get(tuple(sorted(ring)))
+            if sphere is not None:
+                point = projectOnSphere(point, mesh.spheres.view[sphere])
+            axis.append(len(vertices) + len(centres))
+            centres.append(point)
+        for a in range(4):
+            pa, pb = hex[a], hex[(a + 1) % 4]
+            if not lo < azimuth(vertices[[pa, pb], :2].mean(axis=0)) < hi:
+                continue
+            along, across = (cells[0], cells[1]) if a % 2 == 0 else (cells[1], cells[0])
+            pie = [axis[0], pa, pb, axis[0], axis[1], hex[4 + a], hex[4 + (a + 1) % 4], axis[1]]
+            blocks.append((pie, [math.ceil(across/2), along, cells[2]], zone, b < nFuelBlocks))
+            replaced[tuple(sorted(hex[:4]))].append([pie[c] for c in BLOCK_FACES[4][2]])
+            replaced[tuple(sorted(hex[4:]))].append([pie[c] for c in BLOCK_FACES[5][2]])
+
+    mesh.vertices.extend(centres)
+    vertices = mesh.vertices.view
+
+    store = BlockStore()
+    for name in mesh.blocks.zoneNames:
+        store.zoneId(name)
+    store.extend([hex for hex, cells, zone, fuel in blocks], [cells for hex, cells, zone, fuel in blocks],
+                 [zone for hex, cells, zone, fuel in blocks])
+    mesh.blocks = store
+
+    # faces and edges of the kept blocks
+    blockFaces = {}
+    blockEdges = set()
+    for hex, cells, zone, fuel in blocks:
+        for axis, side, corners in BLOCK_FACES:
+            face = [hex[c] for c in corners]
+            key = tuple(sorted(face))
+            count = blockFaces[key][0] + 1 if key in blockFaces else 1
+            blockFaces[key] = (count, face, fuel)
+        blockEdges.update((min(hex[s], hex[e]), max(hex[s], hex[e])) for s, e, axis in BLOCK_EDGES)
+
+    keep = [(min(ends), max(ends)) in blockEdges for ends in mesh.edges.ends.view.tolist()]
+    edges = EdgeStore()
+    edges.ends.extend(mesh.edges.ends.view[keep])
+    edges.midpoints.extend(mesh.edges.midpoints.view[keep])
+    mesh.edges = edges
+
+    faces, sphereIds = [], []
+    for face, sphere in zip(mesh.projections.faces.view.tolist(), mesh.projections.spheres.tolist()):
+        key = tuple(sorted(face))
+        for kept in replaced.get(key, [face] if key in blockFaces else []):
+            faces.append(kept)
+            sphereIds.append(sphere)
+    mesh.projections = ProjectionStore()
+    mesh.projections.extend(np.array(faces, dtype=int).reshape(-1, 4), sphereIds)
+
+    inPatches = set()
+    for patch in mesh.patchDict.values():
+        patchFaces = []
+        for face in patch['faces']:
+            key = tuple(sorted(face))
+            patchFaces.extend(replaced.get(key, [face] if key in blockFaces else []))
+        patch['faces'] = patchFaces
+        inPatches.update(tuple(sorted(face)) for face in patchFaces)
+
+    # the faces left open by the cut
+    planes = SYMMETRY_PLANES[symmetry]
+    for key, (count, face, fuel) in blockFaces.items():
+        if count > 1 or key in inPatches or len(set(key)) < 3:
+            continue
+        for n, normal in enumerate(planes):
+            if np.all(np.abs(vertices[face, :2] @ np.array(normal, dtype=float)) <= tolerance):
+                name = ("fuel" if fuel else "clad") + "Symmetry" + (str(n + 1) if len(planes) > 1 else "")
+                addToPatchDict(mesh.patchDict, name, "symmetryPlane", "none", "false", face)
+                break
+
+    relabelVertices(mesh, np.arange(len(vertices)))
+
+###################################################################################################################################################
+#########################--------------------------------------- AXIALLY PERIODIC UNIT CELL ---------------------------------------#########################
+###################################################################################################################################################
+
+# A unit cell is made of a few pellets of one fuel block and of the cladding
+# segment of the same height around them, without caps. The rodDict is
+# reduced to this single fuel and cladding block before the setup, so the
+# usual builders make the cell; its bottom and top ends (fuel and cladding)
+# then become translational cyclic patch pairs.
+
+UNIT_CELL_FUEL_KEYS = ('blockNameFuel', 'rInnerFuel', 'rOuterFuel', 'heightFuel', 'nPelletsFuel',
+                       'rDishFuel', 'rCurvatureDish', 'chamferHeight', 'chamferWidth', 'squareFraction',
+                       'nCellsRPellet', 'nCellsRDish', 'nCellsRChamfer', 'nCellsZPellet', 'nCellsAzimuthalFuel')
+UNIT_CELL_CLAD_KEYS = ('blockNameClad', 'rInnerClad', 'rOuterClad', 'heightClad',
+                       'nCellsRClad', 'nCellsZClad', 'nCellsAzimuthalClad')
+
+# (owner, neighbour) cyclic patches of the ends of the unit cell
+CYCLIC_ENDS = (('fuelBottom', 'fuelTop'), ('cladBottom', 'cladTop'))
+
+def unitCellDict(rodDict):
+    """
+    Returns a copy of rodDict reduced to its unit cell: 'unitCell' pellets of
+    the fuel block 'unitCellBlock' (the first by default), starting at the
+    bottom of the block, and the part of the cladding block around them
+    (with its axial cell size), without caps.
+    """
+    geometry = rodDict['geometryType']
+    if geometry not in ('3D', '2D-discrete'):
+        raise ValueError("'unitCell' needs the pellets of a 3D or 2D-discrete geometry")
+    if geometry == '3D' and rodDict['eccentricity']:
+        raise ValueError("'unitCell' needs 'eccentricity': False")
+
+    nPellets = rodDict['unitCell']
+    b = rodDict.get('unitCellBlock', 0)
+    height = nPellets*rodDict['heightFuel'][b]/rodDict['nPelletsFuel'][b]
+    bottom = rodDict['offsetFuel'] + sum(rodDict['heightFuel'][:b])
+
+    # cladding block around the middle of the cell
+    cladTops = rodDict['offsetClad'] + np.cumsum(rodDict['heightClad'])
+    c = int(np.searchsorted(cladTops, bottom + 0.5*height))
+    if c == len(cladTops) or cladTops[c] - rodDict['heightClad'][c] > bottom + 0.5*height:
+        raise ValueError("no cladding block around the unit cell")
+    nCellsZ = max(1, int(round(rodDict['nCellsZClad'][c]*height/rodDict['heightClad'][c])))
+
+    cell = copy.deepcopy(rodDict)
+    for keys, index in ((UNIT_CELL_FUEL_KEYS, b), (UNIT_CELL_CLAD_KEYS, c)):
+        for key in keys:
+            if isinstance(cell.get(key), list):
+                cell[key] = [cell[key][index]]
+    cell.update(nBlocksFuel=1, nBlocksClad=1, nPelletsFuel=[nPellets], heightFuel=[height],
+                heightClad=[height], nCellsZClad=[nCellsZ], offsetFuel=bottom, offsetClad=bottom,
+                bottomCapHeight=0, topCapHeight=0)
+    return cell
+
+def makeCyclicEnds(mesh, period, nPellets):
+    # Turns the end patches of the unit cell into cyclic pairs. Only the flat
+    # faces in the end planes are periodic: the dish and chamfer faces of the
+    # end pellets are moved to the dishChamferBottom_1/dishChamferTop_<n>
+    # wall patches, as between two pellets. The faces of the neighbour (top)
+    # patch are listed in the order of the matching faces of the owner
+    # (bottom) patch translated by the period
+    vertices = mesh.vertices.view
+    tolerance = 1e-7*np.ptp(vertices, axis=0).max()
+    separation = (0.0, 0.0, float(period*mesh.convertToMeters))
+    for owner, neighbour in CYCLIC_ENDS:
+        ends = []
+        for name, cavity, plane in ((owner, "dishChamferBottom_1", np.min), (neighbour, "dishChamferTop_%d" % nPellets, np.max)):
+            faces = np.array(mesh.patchDict[name]['faces'], dtype=int).reshape(-1, 4)
+            z = vertices[faces, 2]
+            flat = np.all(np.abs(z - plane(z)) <= tolerance, axis=1)
+            if not flat.all():
+                addToPatchDict(mesh.patchDict, cavity, "patch", "none", "false", [])
+                mesh.patchDict[cavity]["faces"].extend(faces[~flat].tolist())
+            ends.append(faces[flat])
+        ownerFaces, neighbourFaces = ends
+        n = len(ownerFaces)
+        centres = np.concatenate((vertices[ownerFaces].mean(axis=1) + (0.0, 0.0, period), vertices[neighbourFaces].mean(axis=1)))
+        pairs = matchPoints(centres, np.arange(n), n + np.arange(len(neighbourFaces)), tolerance)
+        if len(neighbourFaces) != n or len(pairs) != n or len(set(pairs.values())) != n:
+            raise ValueError("the faces of %s and %s are not periodic" % (owner, neighbour))
+        order = np.empty(n, dtype=int)
+        order[list(pairs.values())] = np.array(list(pairs)) - n
+        mesh.patchDict[owner].update(type="cyclic", neighbour=neighbour, separation=separation, faces=ownerFaces.tolist())
+        mesh.patchDict[neighbour].update(type="cyclic", neighbour=owner, separation=(0.0, 0.0, -separation[2]),
+                                         faces=neighbourFaces[order].tolist())
+
+###################################################################################################################################################
+#########################------------------------------------ HYBRID DISCRETE/SMEARED STACK ------------------------------------#########################
+###################################################################################################################################################
+
+# Only the pellets of an axial window keep their dishes, chamfers and
+# interfaces; each run of pellets of a fuel block outside the window becomes
+# one flat pellet as high as the run (a plain O-grid cylinder in 3D, a single
+# wedge block in 2D-discrete) with a coarse axial mesh. The runs count as
+# pellets in the numbering of the patches, so the transitions are ordinary
+# pellet interfaces fuelTop_i/fuelBottom_i+1.
+
+def discretePellets(fuel_blocks, nPelletsFuel, offsetFuel, window):
+    # mask of the pellets of the stack inside the window: {'pellets': [first,
+    # last]} (counted from 1, inclusive) or {'z': [zMin, zMax]} (the pellets
+    # overlapping the range)
+    heights = np.repeat([pellet['height'] for pellet in fuel_blocks], nPelletsFuel)
+    if 'pellets' in window:
+        first, last = window['pellets']
+        index = np.arange(1, len(heights) + 1)
+        discrete = (index >= first) & (index <= last)
+    elif 'z' in window:
+        zMin, zMax = window['z']
+        tops = offsetFuel + np.cumsum(heights)
+        discrete = (tops > zMin) & (tops - heights < zMax)
+    else:
+        raise ValueError("'discreteWindow' needs a 'pellets' or a 'z' range")
+    if not discrete.any():
+        raise ValueError("no pellet in the discrete window %s" % window)
+    return discrete
+
+def hybridFuelBlocks(fuel_blocks, nPelletsFuel, discrete, nCellsZSmeared, geometry):
+    """
+    Splits the fuel blocks into runs of discrete pellets and smeared flat
+    pellets. Returns the new blocks, their number of pellets and the index in
+    the original stack of each new pellet (None for the smeared ones).
+    """
+    blocks, nPellets, source = [], [], []
+    first = 0
+    for pellet, count in zip(fuel_blocks, nPelletsFuel):
+        for isDiscrete, run in itertools.groupby(range(first, first + count), key=lambda j: discrete[j]):
+            run = list(run)
+            if isDiscrete:
+                blocks.append(pellet)
+                nPellets.append(len(run))
+                source.extend(run)
+                continue
+            smeared = dict(pellet)
+            smeared.update(type='flat', rDish=0.0, chamferWidth=0.0, chamferHeight=0.0, rLand=pellet['rOuter'],
+                           height=len(run)*pellet['height'], nCellsZPellet=max(1, int(round(len(run)*nCellsZSmeared))),
+                           nVertices=16 if geometry == '3D' else 8, smeared=True)
+            blocks.append(smeared)
+            nPellets.append(1)
+            source.append(None)
+        first += count
+    return blocks, nPellets, source
+
+###################################################################################################################################################
+#########################--------------------------------------- INTERFACE PATCH GROUPS ---------------------------------------#########################
+###################################################################################################################################################
+
+# Without merging, every pellet (and cladding block) interface is a coupled
+# pair of patches <material>Top_i / <material>Bottom_i+1. Optionally, all the
+# coupled pairs of a material are gathered in a single pair of patches, the
+# tops and the bottoms listed interface by interface in the same order; a
+# JSON sidecar keeps the face range of each interface in the two patches.
+
+INTERFACE_GROUPS = {
+    'fuel': ('fuelPelletTops', 'fuelPelletBottoms', 'pellet'),
+    'clad': ('cladBlockTops', 'cladBlockBottoms', 'block'),
+}
+
+def groupInterfacePatches(mesh):
+    # Replaces the coupled interface patch pairs by the patches of
+    # INTERFACE_GROUPS; mesh.patchGroups records, for each new patch, the
+    # index of the pellet (block) and the number of block faces of each
+    # interface
+    pairs = set()
+    for name, patch in mesh.patchDict.items():
+        match = re.fullmatch(r"(fuel|clad)Top_(\d+)", name)
+        bottom = match and "%sBottom_%d" % (match.group(1), int(match.group(2)) + 1)
+        if (bottom in mesh.patchDict and patch['type'] == 'regionCoupledOFFBEAT'
+                and mesh.patchDict[bottom]['type'] == 'regionCoupledOFFBEAT'):
+            pairs.update((name, bottom))
+
+    patchDict = {}
+    for name, patch in mesh.patchDict.items():
+        if name not in pairs:
+            patchDict[name] = patch
+            continue
+        material, side, index = re.fullmatch(r"(fuel|clad)(Top|Bottom)_(\d+)", name).groups()
+        tops, bottoms, item = INTERFACE_GROUPS[material]
+        group, neighbour = (tops, bottoms) if side == 'Top' else (bottoms, tops)
+        if group not in patchDict:
+            patchDict[group] = {"type": "regionCoupledOFFBEAT", "neighbour": neighbour,
+                                "owner": "true" if side == 'Top' else "false", "faces": []}
+            mesh.patchGroups[group] = []
+        patchDict[group]["faces"].extend(patch["faces"])
+        mesh.patchGroups[group].append((int(index), len(patch["faces"])))
+    mesh.patchDict = patchDict
+
+def interfaceMap(mesh):
+    # {patch: {'neighbour', 'interfaces': [{<pellet|block>, startFace, nFaces}]}}
+    # with the face ranges relative to the start of the patch
+    nFaces = {}
+    for hex, cells in zip(mesh.blocks.hexes.view.tolist(), mesh.blocks.cells.view.tolist()):
+        for axis, side, corners in BLOCK_FACES:
+            nFaces[tuple(sorted(hex[c] for c in corners))] = cells[(axis + 1) % 3]*cells[(axis + 2) % 3]
+
+    groups = {}
+    for group, interfaces in mesh.patchGroups.items():
+        faces = iter(mesh.patchDict[group]["faces"])
+        # (the group may carry the prefix of a rod of an assembly)
+        item = next(entry[2] for entry in INTERFACE_GROUPS.values() if group.endswith(entry[0]) or group.endswith(entry[1]))
+        ranges = []
+        start = 0
+        for index, nEntries in interfaces:
+            size = sum(nFaces[tuple(sorted(next(faces)))] for _ in range(nEntries))
+            ranges.append({item: index, "startFace": start, "nFaces": size})
+            start += size
+        groups[group] = {"neighbour": mesh.patchDict[group]["neighbour"], "interfaces": ranges}
+    return groups
+
+def writeInterfaceMap(mesh, path):
+    # JSON sidecar of the grouped interface patches (removed if there are none)
+    if mesh.patchGroups:
+        with BufferedSink(path) as sink:
+            json.dump(interfaceMap(mesh), sink, indent=1)
+    elif os.path.exists(path):
+        os.remove(path)
+
 ###################################################################################################################################################
 #########################----------------------------------- GENERAL WRITING FUNCTIONS -----------------------------------#########################
 ###################################################################################################################################################
     
-def writeHeader(file):
-    header = """
+# Every section of the blockMeshDict is produced by a generator of already
+# formatted text chunks; the chunks are handed to a BufferedSink which writes
+# them to the file in large batches.
+
+CHUNK_ROWS = 50000
+
+class BufferedSink:
+    """
+    Collects text chunks and passes them to the file in large writelines()
+    batches. If the target is a path, the text goes to a temporary file in
+    the same directory that replaces the target only once everything has
+    been written, so a failed run never leaves a truncated file behind. A
+    file-like target is written to directly and is left open. In binary
+    mode, text chunks are encoded and large buffers (e.g. NumPy arrays)
+    are written as they are, without a copy.
+    """
+
+    def __init__(self, target, batchSize=1 << 20, binary=False):
+        self.target = target
+        self.batchSize = batchSize
+        self.binary = binary
+        self._chunks = []
+        self._size = 0
+        self._file = None
+        self._tmpPath = None
+
+    def __enter__(self):
+        if hasattr(self.target, "write"):
+            self._file = self.target
+        else:
+            directory = os.path.dirname(os.path.abspath(self.target))
+            fd, self._tmpPath = tempfile.mkstemp(dir=directory, prefix="." + os.path.basename(self.target) + ".", suffix=".tmp")
+            # mkstemp creates the file with mode 0600, use the usual mode instead
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(self._tmpPath, 0o666 & ~umask)
+            self._file = os.fdopen(fd, "wb" if self.binary else "w")
+        return self
+
+    def write(self, chunk):
+        if self.binary:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            elif memoryview(chunk).nbytes >= self.batchSize:
+                self.flush()
+                self._file.write(chunk)
+                return
+        self._chunks.append(chunk)
+        self._size += len(chunk)
+        if self._size >= self.batchSize:
+            self.flush()
+
+    def writelines(self, chunks):
+        for chunk in chunks:
+            self.write(chunk)
+
+    def flush(self):
+        self._file.writelines(self._chunks)
+        self._chunks = []
+        self._size = 0
+
+    def __exit__(self, excType, exc, traceback):
+        if self._tmpPath is None:
+            if excType is None:
+                self.flush()
+            return False
+
+        try:
+            if excType is None:
+                self.flush()
+        finally:
+            self._file.close()
+            if excType is None:
+                os.replace(self._tmpPath, self.target)
+            else:
+                os.remove(self._tmpPath)
+        return False
+
+def formatRows(row_str, rows):
+    # formats the rows of a 2D array (one 'row_str' per row), CHUNK_ROWS rows
+    # at a time, with a single '%' operation per chunk
+    for start in range(0, len(rows), CHUNK_ROWS):
+        chunk = rows[start:start + CHUNK_ROWS]
+        yield (row_str * len(chunk)) % tuple(chunk.ravel().tolist())
+
+def iterHeader():
+    yield """
 /*--------------------------------*- C++ -*----------------------------------*\\
 | ========                 |                                                 |
 | \\      /  F ield         | OpenFOAM: The Open Source CFD Toolbox           |
@@ -1674,222 +2621,1241 @@ FoamFile
 }
 // * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * //
 """
-    file.write(header)
-
-def writeGeometry(list_spheres, file):
-    if list_spheres:
-        file.write("\ngeometry\n{\n")
-
-        for i in range(len(list_spheres)):
-            sphere = list_spheres[i]
-            file.write(f"\n    sphere_{i}\n")
-            file.write("    {\n")
-            file.write("        type searchableSphere;\n")
-            file.write(f"        centre ({sphere['x']} {sphere['y']} {sphere['z']});\n")
-            file.write(f"        radius {sphere['radius']};\n")
-            file.write("    }\n")
-        file.write("}\n")
-
-def writeVertices(list_vertices, file):
-    file.write("\nvertices\n(\n")
-
-    for vertex in list_vertices:
-        vertex_str = "    (" + " ".join(map(str, vertex)) + ")\n"
-        file.write(vertex_str)
-
-    file.write(");\n")
-
-def writeBlocks(list_blocks, file):
-    file.write("\nblocks\n(\n")
-    for block in list_blocks:
-        vertices_str = " ".join(map(lambda x: str(int(x)), block["vertices"]))
-        mesh_str = " ".join(map(lambda x: str(int(x)), block["mesh"]))
-        block_str = f"    hex ( {vertices_str} ) {block['name']} ({mesh_str}) simpleGrading (1 1 1)\n"
-        file.write(block_str)
-    file.write(");\n")
-
-def writeEdges(list_edges, file):
-    if list_edges:
-        file.write("\nedges\n(\n")
-        for edge in list_edges:
-            vertices = [int(v) for v in edge['vertices']] # ensuring vertices are treated as integers
-            midpoint_str = ' '.join(str(x) for x in edge['midpoint'])
-            edge_str = f"    arc {vertices[0]} {vertices[1]} ({midpoint_str})\n"
-            file.write(edge_str)
-        file.write(");\n")
-
-def writeFaceProjections(list_projection_faces, file):
-    if list_projection_faces:
-        file.write("\nfaces\n(\n")
-
-        for projection in list_projection_faces:
-            face = ' '.join(str(int(x)) for x in projection['face'])
-            sphere_name = projection['sphere']
-            file.write(f"    project ({face}) {sphere_name}\n")
-        file.write(");\n")
-
-def writeBoundaries(patchDict, file):
-
-    file.write("\nboundary\n(\n")
+
+def iterGeometry(spheres, float_str="%r"):
+    if len(spheres):
+        yield "\ngeometry\n{\n"
+
+        sphere_str = ("\n    sphere_%d\n"
+                      "    {\n"
+                      "        type searchableSphere;\n"
+                      f"        centre ({float_str} {float_str} {float_str});\n"
+                      f"        radius {float_str};\n"
+                      "    }\n")
+        rows = np.empty((len(spheres), 5), dtype=object)
+        rows[:, 0] = np.arange(len(spheres))
+        rows[:, 1:] = spheres
+        yield from formatRows(sphere_str, rows)
+        yield "}\n"
+
+def iterVertices(vertices, float_str="%r"):
+    yield "\nvertices\n(\n"
+    yield from formatRows(f"    ({float_str} {float_str} {float_str})\n", vertices)
+    yield ");\n"
+
+def iterBlocks(blocks):
+    yield "\nblocks\n(\n"
+    # rows of: 8 vertex labels, block name, 3 numbers of cells
+    rows = np.empty((len(blocks), 12), dtype=object)
+    rows[:, :8] = blocks.hexes.view
+    rows[:, 8] = np.array(blocks.zoneNames, dtype=object)[blocks.zones]
+    rows[:, 9:] = blocks.cells.view
+    yield from formatRows("    hex ( %d %d %d %d %d %d %d %d ) %s (%d %d %d) simpleGrading (1 1 1)\n", rows)
+    yield ");\n"
+
+def iterEdges(ends, midpoints, float_str="%r", polyLines=()):
+    if len(ends) or len(polyLines):
+        yield "\nedges\n(\n"
+        rows = np.empty((len(ends), 5), dtype=object)
+        rows[:, :2] = ends
+        rows[:, 2:] = midpoints
+        yield from formatRows(f"    arc %d %d ({float_str} {float_str} {float_str})\n", rows)
+        point_str = f"({float_str} {float_str} {float_str})"
+        for start, end, points in polyLines:
+            yield "    polyLine %d %d (" % (start, end) + " ".join(point_str % tuple(p) for p in points.tolist()) + ")\n"
+        yield ");\n"
+
+def iterFaceProjections(faces, sphereIds):
+    if len(faces):
+        yield "\nfaces\n(\n"
+        rows = np.empty((len(faces), 5), dtype=object)
+        rows[:, :4] = faces
+        rows[:, 4] = sphereIds
+        yield from formatRows("    project (%d %d %d %d) sphere_%d\n", rows)
+        yield ");\n"
+
+def iterBoundaries(patchDict):
+
+    yield "\nboundary\n(\n"
     for patchName, patchInfo in patchDict.items():
-        file.write(f"    {patchName}\n")
-        file.write("    {\n")
-        file.write(f"        type {patchInfo['type']};\n")
+        patch_str = f"    {patchName}\n    {{\n        type {patchInfo['type']};\n"
 
         if patchInfo['type'] == "regionCoupledOFFBEAT":
-            file.write(f"        neighbourPatch {patchInfo.get('neighbour', '')};\n")
-            file.write("        neighbourRegion region0;\n")
-            file.write(f"        owner {'true' if patchInfo.get('owner') == 'true' else 'false'};\n")
+            patch_str += f"        neighbourPatch {patchInfo.get('neighbour', '')};\n"
+            patch_str += "        neighbourRegion region0;\n"
+            patch_str += f"        owner {'true' if patchInfo.get('owner') == 'true' else 'false'};\n"
             # Specific logic for cladInner or fuelOuter
             if patchName == "cladInner" or patchName == "fuelOuter":
-                file.write("        updateAMI true;\n")
+                patch_str += "        updateAMI true;\n"
             else:
-                file.write("        updateAMI false;\n")
-        
-        file.write("        faces\n        (\n")
-        for face in patchInfo['faces']:
-            faceStr = " ".join(map(str, face))
-            file.write(f"            ({faceStr})\n")
-        file.write("        );\n")
-        file.write("    }\n\n")
-    file.write(");\n")
-
-def writeMergedPatches(mergePatchDict, file):
-    file.write("\nmergePatchPairs \n(\n")
+                patch_str += "        updateAMI false;\n"
+        if patchInfo['type'] == "cyclic":
+            patch_str += f"        neighbourPatch {patchInfo['neighbour']};\n"
+            patch_str += "        transform translational;\n"
+            patch_str += "        separationVector (%r %r %r);\n" % patchInfo['separation']
+
+        yield patch_str + "        faces\n        (\n"
+        yield from formatRows("            (%d %d %d %d)\n", np.array(patchInfo['faces'], dtype=np.int64).reshape(-1, 4))
+        yield "        );\n    }\n\n"
+    yield ");\n"
+
+def iterMergedPatches(mergePatchDict):
+    yield "\nmergePatchPairs \n(\n"
     for masterPatchName in mergePatchDict:
         slavePatchName = mergePatchDict[masterPatchName]
-        file.write("\t(")
-        file.write(masterPatchName + " " + slavePatchName)
-        file.write(")\n")
+        yield "\t(" + masterPatchName + " " + slavePatchName + ")\n"
+
+    yield ");\n\n"
+
+def snapToGrid(values, decimals, resolution):
+    # Rounds to 'decimals' decimals. Values closer to each other than a
+    # thousandth of the resolution are first replaced by the smallest of them,
+    # so that coordinates which only differ by round-off (e.g. the top of a
+    # pellet and the bottom of the next one) cannot end up on both sides of a
+    # rounding boundary.
+    if values.size == 0:
+        return values
+    unique, inverse = np.unique(values, return_inverse=True)
+    newValue = np.concatenate(([True], np.diff(unique) > 1e-3*resolution))
+    representative = unique[newValue][np.cumsum(newValue) - 1]
+    # adding 0.0 turns -0.0 into 0.0
+    return np.round(representative, decimals)[inverse.reshape(values.shape)] + 0.0
+
+def countUniqueRows(rows):
+    # number of distinct rows of a (N, 3) array, through one int64 key per row
+    # (much cheaper than np.unique(rows, axis=0))
+    keys = np.zeros(len(rows), dtype=np.int64)
+    for c in range(rows.shape[1]):
+        unique, codes = np.unique(rows[:, c], return_inverse=True)
+        keys = keys*len(unique) + codes
+    return len(np.unique(keys))
+
+def roundCoordinates(mesh, precision):
+    """
+    Rounds the vertices, arc midpoints and spheres of the mesh for writing
+    them with 'precision' significant digits. The digits are counted on the
+    largest coordinate of the rod, so the rounding step is the same
+    everywhere along the rod: it is 10**(-decimals)*convertToMeters meters.
+    Returns the rounded arrays and the matching format string.
+    """
+
+    vertices = mesh.vertices.view
+    midpoints = mesh.edges.midpoints.view
+    spheres = mesh.spheres.view
+
+    arrays = [a for a in (vertices, midpoints, spheres) if a.size]
+    maxAbs = max(np.abs(a).max() for a in arrays) if arrays else 0.0
+    exponent = math.floor(math.log10(maxAbs)) if maxAbs > 0 else 0
+    decimals = precision - 1 - exponent
+    resolution = 10.0**(-decimals)
+
+    # every x (y, z) coordinate is rounded together, so that equal values in
+    # different sections stay equal
+    rounded = [np.empty_like(vertices), np.empty_like(midpoints), np.empty_like(spheres)]
+    for c in range(3):
+        values = np.concatenate((vertices[:, c], midpoints[:, c], spheres[:, c]))
+        values = snapToGrid(values, decimals, resolution)
+        rounded[0][:, c] = values[:len(vertices)]
+        rounded[1][:, c] = values[len(vertices):len(vertices) + len(midpoints)]
+        rounded[2][:, c] = values[len(vertices) + len(midpoints):]
+    if len(spheres):
+        rounded[2][:, 3] = snapToGrid(spheres[:, 3], decimals, resolution)
+
+    if countUniqueRows(rounded[0]) < countUniqueRows(vertices):
+        raise ValueError(f"writePrecision {precision} merges distinct vertices "
+                         f"(rounding step {resolution*mesh.convertToMeters:g} m), increase it")
+
+    # enough significant digits to print the rounded values exactly, trailing
+    # zeros are dropped by %g
+    return rounded[0], rounded[1], rounded[2], f"%.{precision}g"
+
+def dishPolyLines(mesh, vertices, midpoints, spheres):
+    """
+    Replaces the projection on the dish spheres by analytic edges: every edge
+    of a projected face becomes a polyLine through its points on the sphere,
+    one per cell division, placed as by the direct polyMesh writer (the
+    straight or arc edge is sampled, then moved radially onto the sphere).
+    Returns the mask of the arc edges to keep and the polyLines as (start,
+    end, points).
+    """
+    projectedEdges = {}
+    for face, sphere in zip(mesh.projections.faces.view.tolist(), mesh.projections.spheres.tolist()):
+        for a, b in zip(face, face[1:] + face[:1]):
+            if a != b:
+                projectedEdges[(min(a, b), max(a, b))] = sphere
+    nCells = {}
+    for hex, cells in zip(mesh.blocks.hexes.view.tolist(), mesh.blocks.cells.view.tolist()):
+        for first, last, axis in BLOCK_EDGES:
+            key = (min(hex[first], hex[last]), max(hex[first], hex[last]))
+            if key in projectedEdges:
+                nCells[key] = cells[axis]
+
+    arcs = {}
+    keep = np.ones(len(mesh.edges), dtype=bool)
+    for e, (start, end) in enumerate(mesh.edges.ends.view.tolist()):
+        key = (min(start, end), max(start, end))
+        if nCells.get(key, 1) > 1:
+            arcs[key] = (start, midpoints[e], end)
+            keep[e] = False
+
+    polyLines = []
+    for key, sphere in projectedEdges.items():
+        n = nCells.get(key, 1)
+        if n < 2:
+            continue
+        start, end = key
+        lambdas = np.arange(1, n)/n
+        if key in arcs:
+            first, midpoint, last = arcs[key]
+            inner = arcPoints(vertices[first], midpoint, vertices[last], lambdas if first == start else 1 - lambdas)
+        else:
+            inner = vertices[start] + lambdas[:, None]*(vertices[end] - vertices[start])
+        polyLines.append((start, end, projectOnSphere(inner, spheres[sphere])))
+    return keep, polyLines
+
+def sectionDigest(*parts):
+    # digest of the data a section is made of (arrays, or anything with a stable repr)
+    digest = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            digest.update(str((part.dtype, part.shape)).encode())
+            digest.update(np.ascontiguousarray(part).data)
+        else:
+            digest.update(repr(part).encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+def blockMeshDictSections(mesh, precision=None):
+    # The blockMeshDict as an ordered list of (name, digest, text generator
+    # factory): each digest covers everything its section is written from
+    if precision is None or precision >= 17:
+        # '%r' gives the same digits as str(float)
+        float_str = "%r"
+        vertices, midpoints, spheres = mesh.vertices.view, mesh.edges.midpoints.view, mesh.spheres.view
+    else:
+        vertices, midpoints, spheres, float_str = roundCoordinates(mesh, precision)
+
+    blocks, ends, projectedFaces, sphereIds = mesh.blocks, mesh.edges.ends.view, mesh.projections.faces.view, mesh.projections.spheres
+    polyLines = []
+    if mesh.analyticDish and len(projectedFaces):
+        keep, polyLines = dishPolyLines(mesh, vertices, midpoints, spheres)
+        ends, midpoints = ends[keep], midpoints[keep]
+        spheres, projectedFaces, sphereIds = spheres[:0], projectedFaces[:0], sphereIds[:0]
+    polyLineDigest = [(start, end, sectionDigest(points)) for start, end, points in polyLines]
+    convertToMeters = "\nconvertToMeters " + str(mesh.convertToMeters) + "; \n\n"
+    return [
+        ("header",          sectionDigest(convertToMeters),
+                            lambda: itertools.chain(iterHeader(), [convertToMeters])),
+        ("geometry",        sectionDigest(spheres, float_str),
+                            lambda: iterGeometry(spheres, float_str)),
+        ("vertices",        sectionDigest(vertices, float_str),
+                            lambda: iterVertices(vertices, float_str)),
+        ("blocks",          sectionDigest(blocks.hexes.view, blocks.cells.view, blocks.zones, blocks.zoneNames),
+                            lambda: iterBlocks(blocks)),
+        ("edges",           sectionDigest(ends, midpoints, float_str, polyLineDigest),
+                            lambda: iterEdges(ends, midpoints, float_str, polyLines)),
+        ("faces",           sectionDigest(projectedFaces, sphereIds),
+                            lambda: iterFaceProjections(projectedFaces, sphereIds)),
+        ("boundary",        sectionDigest(mesh.patchDict),
+                            lambda: iterBoundaries(mesh.patchDict)),
+        ("mergePatchPairs", sectionDigest(dict(mesh.mergePatchDict)),
+                            lambda: iterMergedPatches(mesh.mergePatchDict)),
+    ]
+
+def iterBlockMeshDict(mesh, precision=None):
+    for name, digest, section in blockMeshDictSections(mesh, precision):
+        yield from section()
+
+def readSections(path):
+    # Sections of the existing blockMeshDict as {name: (digest, text)}, using
+    # the '<path>.sections' sidecar; empty if the file changed since written
+    try:
+        with open(path + ".sections") as f:
+            sidecar = json.load(f)
+        stat = os.stat(path)
+        if [stat.st_size, stat.st_mtime_ns] != sidecar["stat"]:
+            return {}
+        with open(path, newline="") as f:
+            text = f.read()
+    except (OSError, ValueError, KeyError):
+        return {}
+
+    sections = {}
+    start = 0
+    for name, digest, length in sidecar["sections"]:
+        sections[name] = (digest, text[start:start + length])
+        start += length
+    return sections if start == len(text) else {}
+
+def writeBlockMeshDictIncremental(mesh, path, precision=None):
+    """
+    Writes the blockMeshDict at 'path', formatting only the sections whose
+    digest differs from the one recorded in the '<path>.sections' sidecar at
+    the previous write; the others are copied from the existing file.
+    Returns the names of the sections that were regenerated.
+    """
+    previous = readSections(path)
+    sidecar = {"sections": [], "stat": None}
+    regenerated = []
+    with BufferedSink(path) as sink:
+        for name, digest, section in blockMeshDictSections(mesh, precision):
+            if name in previous and previous[name][0] == digest:
+                text = previous[name][1]
+            else:
+                text = "".join(section())
+                regenerated.append(name)
+            sink.write(text)
+            sidecar["sections"].append([name, digest, len(text)])
+
+    stat = os.stat(path)
+    sidecar["stat"] = [stat.st_size, stat.st_mtime_ns]
+    with BufferedSink(path + ".sections") as sink:
+        json.dump(sidecar, sink)
+    return regenerated
+
+def writeBlockMeshDict(mesh, target, precision=None, incremental=False):
+    # target: path of the blockMeshDict or an open text file
+    # precision: significant digits of the coordinates, None for all of them
+    # incremental: only regenerate the sections that changed since the last
+    # incremental write of the same path
+    if incremental and not hasattr(target, "write"):
+        writeBlockMeshDictIncremental(mesh, target, precision)
+        return
+    with BufferedSink(target) as sink:
+        sink.writelines(iterBlockMeshDict(mesh, precision))
 
-    file.write(");\n\n")
+###################################################################################################################################################
+#########################---------------------------------------- DIRECT POLYMESH WRITER ----------------------------------------#########################
+###################################################################################################################################################
 
-'''------------------------------------------------------------
--------------------------- MAIN -------------------------------
-------------------------------------------------------------'''
-###############################################################
-#### Reading the rodDict file and making the dictionary #######
-###############################################################
-    
-# Reading the data from the rodDict file 
-with open('rodDict') as f: 
-    data = f.read() 
-
-# Reconstructing the data as a dictionary 
-rodDict = ast.literal_eval(data)
-
-###############################################################
-######### Extracting parameters from the dictionary ###########
-###############################################################
-
-# Basic parameters
-convertToMeters = rodDict['convertToMeters']
-geometry = rodDict['geometryType'] 
-
-nBlocksFuel = rodDict['nBlocksFuel']
-blockNameFuel = rodDict['blockNameFuel']
-nBlocksClad = rodDict['nBlocksClad']
-blockNameClad = rodDict['blockNameClad']
-
-# Geometrical parameters for fuel and cladding
-rInnerFuel = rodDict['rInnerFuel']
-rOuterFuel = rodDict['rOuterFuel']
-rInnerClad = rodDict['rInnerClad']
-rOuterClad = rodDict['rOuterClad']
-heightFuel = rodDict['heightFuel']
-heightClad = rodDict['heightClad']
-
-# Global offsets
-offsetFuel = rodDict['offsetFuel']
-offsetClad = rodDict['offsetClad']
-
-# Mesh properties for cladding
-nCellsZClad = rodDict['nCellsZClad']
-nCellsRClad = rodDict['nCellsRClad']
-
-if geometry!='3D':
-    # transforming degrees to radians
-    wedgeAngle=rodDict['wedgeAngle']*math.pi/180
-
-if geometry=='2D-discrete' or geometry=='3D':
-    # Pellet parameters
-    nPelletsFuel = rodDict['nPelletsFuel']
-    totalPelletNumber=sum(nPelletsFuel)
-
-if geometry=='3D':
-    squareFractionTopCap=rodDict.get('squareFractionTopCap', None)
-    squareFractionBottomCap=rodDict.get('squareFractionBottomCap', None)
-
-if geometry=='2D-discrete' or geometry=='3D':
-    # Global merge patch pairs options
-    mergeCladPatchPairs = rodDict['mergeCladPatchPairs']
-    mergeFuelPatchPairs = rodDict['mergeFuelPatchPairs']
-
-    # Geometry of the fuel pellet
-    rDishFuel = rodDict['rDishFuel']
-    rCurvatureDish = rodDict['rCurvatureDish']
-    chamferHeight = rodDict['chamferHeight']
-    chamferWidth = rodDict['chamferWidth']
-
-if geometry=='3D':
-    # Mesh properties for fuel
-    squareFraction = rodDict['squareFraction']
-    nCellsAzimuthalFuel = rodDict['nCellsAzimuthalFuel']
-    nCellsAzimuthalClad = rodDict['nCellsAzimuthalClad']
-    eccentricity=rodDict['eccentricity']
-    eccentricity_mode=rodDict['eccentricity_mode']
-
-    if eccentricity_mode=='manual':
-        eccVector=rodDict['eccentricity_vector']
-
-
-###################################################################
-############## Dealing with the top and bottom caps ###############
-####### adding new blocks to the list of cladding blocks ##########
-###################################################################
-cladType = ['normal' for i in range(nBlocksClad)]
-
-bottomCap=False
-topCap=False
-
-if geometry!='1D':
-    # Cap parameters
-    bottomCapHeight = rodDict['bottomCapHeight']
-    topCapHeight = rodDict['topCapHeight']
-    nCellsRBottomCap = rodDict.get('nCellsRBottomCap', None)
-    nCellsZBottomCap = rodDict.get('nCellsZBottomCap', None)
-    nCellsRTopCap = rodDict.get('nCellsRTopCap', None)
-    nCellsZTopCap = rodDict.get('nCellsZTopCap', None)
-        
+# For 3D rods the polyMesh can be written directly instead of going through
+# blockMesh. The blocks follow the blockMesh conventions: vertices 0-1 along
+# the first block axis (i), 0-3 along the second (j) and 0-4 along the third
+# (k), with uniform grading. The points of every block are labelled
+# topologically (block vertex, point of a block edge, point of a block face
+# or interior point), so the points on the edges and faces shared by two
+# blocks are the same, and placed by transfinite interpolation: arcs are
+# evaluated exactly, edges and faces of 'project' faces are projected
+# radially on their sphere and the interior follows from the six faces.
+
+# corners of the hex in (i, j, k) index space
+HEX_CORNERS = ((0, 0, 0), (1, 0, 0), (1, 1, 0), (0, 1, 0), (0, 0, 1), (1, 0, 1), (1, 1, 1), (0, 1, 1))
+
+# the 12 edges of a block: (first vertex, last vertex, axis)
+BLOCK_EDGES = ((0, 1, 0), (3, 2, 0), (4, 5, 0), (7, 6, 0),
+               (0, 3, 1), (1, 2, 1), (4, 7, 1), (5, 6, 1),
+               (0, 4, 2), (1, 5, 2), (2, 6, 2), (3, 7, 2))
+
+# the 6 faces of a block: (axis, side, vertices in blockMesh order)
+BLOCK_FACES = ((0, 0, (0, 4, 7, 3)), (0, 1, (1, 2, 6, 5)),
+               (1, 0, (0, 1, 5, 4)), (1, 1, (3, 7, 6, 2)),
+               (2, 0, (0, 3, 2, 1)), (2, 1, (4, 5, 6, 7)))
+
+class PolyMesh:
+    """
+    An OpenFOAM polyMesh: points, faces (rows of point labels padded with
+    -1; internal faces first, in upper triangular order, then the faces of
+    each patch), owner and neighbour, the patches as (name, dictionary
+    entries, startFace, nFaces) and the cell zones as (name, cell labels).
+    """
+
+    def __init__(self, points, faces, owner, neighbour, patches, cellZones, nCells=None):
+        self.points = points
+        self.faces = faces
+        self.owner = owner
+        self.neighbour = neighbour
+        self.patches = patches
+        self.cellZones = cellZones
+        self._nCells = nCells
+
+    @property
+    def nCells(self):
+        if self._nCells is not None:
+            return self._nCells
+        return int(self.owner.max()) + 1 if len(self.owner) else 0
+
+    def write(self, directory, precision=None, binary=False, labelSize=32, scalarSize=64):
+        writePolyMesh(self, directory, precision, binary, labelSize, scalarSize)
+
+def edgeSlice(edge):
+    # index of the points of a block edge in the (i, j, k) point grid of the block
+    start, end, axis = edge
+    index = [-HEX_CORNERS[start][a] for a in range(3)]
+    index[axis] = slice(None)
+    return tuple(index)
+
+def faceSlice(face):
+    axis, side, corners = face
+    index = [slice(None)]*3
+    index[axis] = -side
+    return tuple(index)
+
+def canonicalTransform(corners):
+    # (transpose, flipA, flipB) bringing the 2x2 corner labels of a face grid
+    # to the orientation shared by all the blocks: smallest label first,
+    # followed along the first axis by the smaller of its two neighbours
+    # (and then the smaller opposite corner, for the faces of collapsed blocks)
+    def key(transform):
+        transpose, flipA, flipB = transform
+        flipped = (corners.T if transpose else corners)[::-1 if flipA else 1, ::-1 if flipB else 1]
+        return flipped[0, 0], flipped[1, 0], flipped[0, 1], flipped[1, 1]
+    return min(itertools.product((False, True), repeat=3), key=key)
+
+def fromCanonical(grid, transform):
+    transpose, flipA, flipB = transform
+    grid = grid[::-1 if flipA else 1, ::-1 if flipB else 1]
+    return grid.T if transpose else grid
+
+def arcPoints(start, midpoint, end, lambdas):
+    # points of the circular arc through start, midpoint and end at the
+    # fractions 'lambdas' of its length (uniform in angle, as blockMesh)
+    a = start - midpoint
+    b = end - midpoint
+    axb = np.cross(a, b)
+    centre = midpoint + np.cross(np.dot(a, a)*b - np.dot(b, b)*a, axb)/(2*np.dot(axb, axb))
+    radius = np.linalg.norm(start - centre)
+    e1 = (start - centre)/radius
+    e2 = np.cross(axb/np.linalg.norm(axb), e1)
+    angle = lambda p: math.atan2(np.dot(p - centre, e2), np.dot(p - centre, e1)) % (2*math.pi)
+    if angle(midpoint) > angle(end):
+        e2 = -e2
+    theta = angle(end)*lambdas[:, None]
+    return centre + radius*(np.cos(theta)*e1 + np.sin(theta)*e2)
+
+def projectOnSphere(points, sphere):
+    centre, radius = sphere[:3], sphere[3]
+    offsets = points - centre
+    return centre + radius*offsets/np.linalg.norm(offsets, axis=-1, keepdims=True)
+
+def coonsPatch(grid):
+    # fills the interior of a (m+1, n+1, 3) grid of points from its 4 sides
+    m, n = grid.shape[0] - 1, grid.shape[1] - 1
+    s = (np.arange(1, m)/m)[:, None, None]
+    t = (np.arange(1, n)/n)[None, :, None]
+    sides = ((1 - t)*grid[1:-1, :1] + t*grid[1:-1, -1:]
+             + (1 - s)*grid[:1, 1:-1] + s*grid[-1:, 1:-1])
+    corners = ((1 - s)*(1 - t)*grid[0, 0] + s*(1 - t)*grid[-1, 0]
+               + (1 - s)*t*grid[0, -1] + s*t*grid[-1, -1])
+    return sides - corners
+
+def transfiniteInterior(grid):
+    # interior points of a (nx+1, ny+1, nz+1, 3) block from its 6 faces
+    # (Gordon-Hall interpolation with linear blending)
+    nx, ny, nz = (n - 1 for n in grid.shape[:3])
+    u = (np.arange(1, nx)/nx)[:, None, None, None]
+    v = (np.arange(1, ny)/ny)[None, :, None, None]
+    w = (np.arange(1, nz)/nz)[None, None, :, None]
+    I, J, K = slice(1, -1), slice(1, -1), slice(1, -1)
+    weights = lambda x, side: x if side else 1 - x
+    side = lambda side: -1 if side else 0
+
+    faces = ((1 - u)*grid[0, J, K][None] + u*grid[-1, J, K][None]
+             + (1 - v)*grid[I, 0, K][:, None] + v*grid[I, -1, K][:, None]
+             + (1 - w)*grid[I, J, 0][:, :, None] + w*grid[I, J, -1][:, :, None])
+    edges = 0
+    corners = 0
+    for a in (0, 1):
+        for b in (0, 1):
+            edges = edges + (weights(u, a)*weights(v, b)*grid[side(a), side(b), K][None, None]
+                             + weights(v, a)*weights(w, b)*grid[I, side(a), side(b)][:, None, None]
+                             + weights(u, a)*weights(w, b)*grid[side(a), J, side(b)][None, :, None])
+            for c in (0, 1):
+                corners = corners + weights(u, a)*weights(v, b)*weights(w, c)*grid[side(a), side(b), side(c)]
+    return faces - edges + corners
+
+def labelBlockPoints(mesh):
+    # Point labels of every block, as (nx+1, ny+1, nz+1) arrays: the block
+    # vertices keep their label, the points of the block edges and faces
+    # get one label per (edge, position) and (face, position) whatever the
+    # block they are seen from, and the interior points get new labels
+    hexes = mesh.blocks.hexes.view.tolist()
+    nCells = mesh.blocks.cells.view.tolist()
+    nextLabel = len(mesh.vertices)
+    edgeLabels = {}
+    faceLabels = {}
+    blockLabels = []
+
+    for hex, cells in zip(hexes, nCells):
+        labels = np.empty([n + 1 for n in cells], dtype=np.int64)
+        for vertex, corner in zip(hex, HEX_CORNERS):
+            labels[tuple(-c for c in corner)] = vertex
+
+        for edge in BLOCK_EDGES:
+            start, end, axis = hex[edge[0]], hex[edge[1]], edge[2]
+            if start == end:
+                # collapsed edge of a collapsed block
+                labels[edgeSlice(edge)] = start
+                continue
+            key = (min(start, end), max(start, end))
+            if key not in edgeLabels:
+                edgeLabels[key] = np.arange(nextLabel, nextLabel + cells[axis] - 1)
+                nextLabel += cells[axis] - 1
+            interior = edgeLabels[key]
+            if len(interior) != cells[axis] - 1:
+                raise ValueError("blocks sharing the edge %s have different numbers of cells along it" % (key,))
+            labels[edgeSlice(edge)][1:-1] = interior if start < end else interior[::-1]
+
+        for face in BLOCK_FACES:
+            grid = labels[faceSlice(face)]
+            shape = (grid.shape[0] - 2, grid.shape[1] - 2)
+            if min(shape) <= 0:
+                continue
+            corners = grid[[0, -1]][:, [0, -1]]
+            if np.all(corners[0] == corners[1]):
+                grid[1:-1, 1:-1] = grid[:1, 1:-1]
+                continue
+            if np.all(corners[:, 0] == corners[:, 1]):
+                grid[1:-1, 1:-1] = grid[1:-1, :1]
+                continue
+            transform = canonicalTransform(corners)
+            key = tuple(sorted(hex[c] for c in face[2]))
+            if transform[0]:
+                shape = shape[::-1]
+            if key not in faceLabels:
+                faceLabels[key] = np.arange(nextLabel, nextLabel + shape[0]*shape[1]).reshape(shape)
+                nextLabel += shape[0]*shape[1]
+            interior = faceLabels[key]
+            if interior.shape != shape:
+                raise ValueError("blocks sharing the face %s have different numbers of cells on it" % (key,))
+            grid[1:-1, 1:-1] = fromCanonical(interior, transform)
+
+        nInterior = max(cells[0] - 1, 0)*max(cells[1] - 1, 0)*max(cells[2] - 1, 0)
+        labels[1:-1, 1:-1, 1:-1] = np.arange(nextLabel, nextLabel + nInterior).reshape(labels[1:-1, 1:-1, 1:-1].shape)
+        nextLabel += nInterior
+        blockLabels.append(labels)
+
+    return blockLabels, nextLabel
+
+def placeBlockPoints(mesh, blockLabels, nPoints):
+    # Coordinates of all the labelled points; every edge and face is placed
+    # once, by the first block using it
+    points = np.empty((nPoints, 3))
+    placed = np.zeros(nPoints, dtype=bool)
+    points[:len(mesh.vertices)] = mesh.vertices.view
+    placed[:len(mesh.vertices)] = True
+
+    arcs = {}
+    for (start, end), midpoint in zip(mesh.edges.ends.view.tolist(), mesh.edges.midpoints.view):
+        arcs[(start, end)] = midpoint
+    spheres = mesh.spheres.view
+    projectedFaces = {}
+    projectedEdges = {}
+    for face, sphere in zip(mesh.projections.faces.view.tolist(), mesh.projections.spheres.tolist()):
+        projectedFaces[tuple(sorted(face))] = sphere
+        for a, b in zip(face, face[1:] + face[:1]):
+            projectedEdges[(min(a, b), max(a, b))] = sphere
+
+    for hex, labels in zip(mesh.blocks.hexes.view.tolist(), blockLabels):
+        for edge in BLOCK_EDGES:
+            line = labels[edgeSlice(edge)]
+            if len(line) < 3 or placed[line[1]]:
+                continue
+            start, end = hex[edge[0]], hex[edge[1]]
+            lambdas = np.arange(1, len(line) - 1)/(len(line) - 1)
+            if (start, end) in arcs:
+                inner = arcPoints(points[start], arcs[(start, end)], points[end], lambdas)
+            elif (end, start) in arcs:
+                inner = arcPoints(points[end], arcs[(end, start)], points[start], 1 - lambdas)
+            else:
+                inner = points[start] + lambdas[:, None]*(points[end] - points[start])
+            sphere = projectedEdges.get((min(start, end), max(start, end)))
+            if sphere is not None:
+                inner = projectOnSphere(inner, spheres[sphere])
+            points[line[1:-1]] = inner
+            placed[line[1:-1]] = True
+
+        for face in BLOCK_FACES:
+            grid = labels[faceSlice(face)]
+            if grid.shape[0] < 3 or grid.shape[1] < 3 or placed[grid[1, 1]]:
+                continue
+            inner = coonsPatch(points[grid])
+            sphere = projectedFaces.get(tuple(sorted(hex[c] for c in face[2])))
+            if sphere is not None:
+                inner = projectOnSphere(inner, spheres[sphere])
+            points[grid[1:-1, 1:-1]] = inner
+            placed[grid[1:-1, 1:-1]] = True
+
+        if min(labels.shape) > 2:
+            points[labels[1:-1, 1:-1, 1:-1]] = transfiniteInterior(points[labels])
+
+    return points
+
+def placeWedgePoints(mesh, blockLabels, nPoints):
+    # the blocks of the wedge geometries are planar with straight edges:
+    # their points are the trilinear interpolation of the 8 vertices
+    points = np.empty((nPoints, 3))
+    vertices = mesh.vertices.view
+    for hex, labels in zip(mesh.blocks.hexes.view, blockLabels):
+        U, V, W = (w[..., None] for w in np.meshgrid(*(np.linspace(0, 1, n) for n in labels.shape), indexing='ij'))
+        c = vertices[hex]
+        points[labels] = ((1 - W)*((1 - V)*((1 - U)*c[0] + U*c[1]) + V*((1 - U)*c[3] + U*c[2]))
+                          + W*((1 - V)*((1 - U)*c[4] + U*c[5]) + V*((1 - U)*c[7] + U*c[6])))
+    points[:len(vertices)] = vertices
+    return points
+
+def blockCellFaces(labels, cellBase):
+    # Faces of the cells of one block, in the hex orientation of OpenFOAM:
+    # the faces between two cells of the block (normal towards the higher
+    # cell label), and the faces on each of the 6 block faces (outward, in
+    # the order blockMesh creates them)
+    nx, ny, nz = (n - 1 for n in labels.shape)
+    cells = cellBase + np.arange(nx*ny*nz).reshape(nz, ny, nx).transpose(2, 1, 0)
+    L = labels
+    quad = lambda *corners: np.stack([c.ravel() for c in corners], axis=1)
+
+    internal = [
+        (quad(L[1:-1, :-1, :-1], L[1:-1, 1:, :-1], L[1:-1, 1:, 1:], L[1:-1, :-1, 1:]), cells[:-1].ravel(), cells[1:].ravel()),
+        (quad(L[:-1, 1:-1, :-1], L[:-1, 1:-1, 1:], L[1:, 1:-1, 1:], L[1:, 1:-1, :-1]), cells[:, :-1].ravel(), cells[:, 1:].ravel()),
+        (quad(L[:-1, :-1, 1:-1], L[1:, :-1, 1:-1], L[1:, 1:, 1:-1], L[:-1, 1:, 1:-1]), cells[:, :, :-1].ravel(), cells[:, :, 1:].ravel()),
+    ]
+    surface = [
+        (quad(L[0, :-1, :-1].T, L[0, :-1, 1:].T, L[0, 1:, 1:].T, L[0, 1:, :-1].T), cells[0].T.ravel()),
+        (quad(L[-1, :-1, :-1].T, L[-1, 1:, :-1].T, L[-1, 1:, 1:].T, L[-1, :-1, 1:].T), cells[-1].T.ravel()),
+        (quad(L[:-1, 0, :-1], L[1:, 0, :-1], L[1:, 0, 1:], L[:-1, 0, 1:]), cells[:, 0].ravel()),
+        (quad(L[:-1, -1, :-1], L[:-1, -1, 1:], L[1:, -1, 1:], L[1:, -1, :-1]), cells[:, -1].ravel()),
+        (quad(L[:-1, :-1, 0], L[:-1, 1:, 0], L[1:, 1:, 0], L[1:, :-1, 0]), cells[:, :, 0].ravel()),
+        (quad(L[:-1, :-1, -1], L[1:, :-1, -1], L[1:, 1:, -1], L[:-1, 1:, -1]), cells[:, :, -1].ravel()),
+    ]
+    return internal, surface
+
+def collapseFaces(faces):
+    # Drops the repeated points of the faces of collapsed blocks (blocks with
+    # a repeated vertex, like the inner block of the wedge caps), as blockMesh
+    # does: returns the faces padded with -1 and the mask of the faces that
+    # keep at least 3 points
+    repeated = (faces == np.roll(faces, -1, axis=1)) | (faces < 0)
+    if not repeated.any():
+        return faces, np.ones(len(faces), dtype=bool)
+    order = np.argsort(repeated, axis=1, kind='stable')
+    packed = np.take_along_axis(faces, order, axis=1)
+    packed[np.take_along_axis(repeated, order, axis=1)] = -1
+    return packed, (~repeated).sum(axis=1) >= 3
+
+def matchFaces(faces):
+    # pairs (first, second) of rows of faces made of the same points
+    keys = np.sort(faces, axis=1)
+    order = np.lexsort(keys.T[::-1])
+    keys = keys[order]
+    same = np.all(keys[1:] == keys[:-1], axis=1)
+    if np.any(same[1:] & same[:-1]):
+        raise ValueError("more than two cells share a face")
+    first = np.nonzero(same)[0]
+    return order[first], order[first + 1]
+
+def matchPoints(points, master, slave, tolerance):
+    # pairs of labels {slave: master} of coincident points
+    masterKeys = {}
+    for offset in (0.0, 0.5):
+        for label, key in zip(master.tolist(), np.floor(points[master]/tolerance + offset).astype(np.int64).tolist()):
+            masterKeys.setdefault((offset,) + tuple(key), label)
+    pairs = {}
+    for offset in (0.0, 0.5):
+        for label, key in zip(slave.tolist(), np.floor(points[slave]/tolerance + offset).astype(np.int64).tolist()):
+            match = masterKeys.get((offset,) + tuple(key))
+            if match is not None and label not in pairs and match != label:
+                pairs[label] = match
+    return pairs
+
+def faceNormals(points, faces):
+    # area vectors of faces padded with -1 (Newell's formula)
+    valid = faces >= 0
+    first = faces[:, :1]
+    closed = np.where(valid, faces, first)
+    nextPoints = np.where(np.roll(valid, -1, axis=1), np.roll(closed, -1, axis=1), first)
+    return 0.5*np.cross(points[closed], points[nextPoints]).sum(axis=1)
+
+def padFaces(faces, width):
+    return np.pad(faces, ((0, 0), (0, width - faces.shape[1])), constant_values=-1) if faces.shape[1] < width else faces
+
+class FaceSet:
+    # faces being assembled: rows of point labels padded with -1, their
+    # owner and neighbour (-1 on the boundary), patch and boundary order
+    def __init__(self, faces, owner, neighbour, patch, order):
+        self.faces, self.owner, self.neighbour, self.patch, self.order = faces, owner, neighbour, patch, order
+
+    def select(self, mask):
+        return FaceSet(self.faces[mask], self.owner[mask], self.neighbour[mask], self.patch[mask], self.order[mask])
+
+    @staticmethod
+    def join(sets):
+        width = max(s.faces.shape[1] for s in sets)
+        return FaceSet(np.concatenate([padFaces(s.faces, width) for s in sets]),
+                       *(np.concatenate([getattr(s, a) for s in sets]) for a in ("owner", "neighbour", "patch", "order")))
+
+def pairFaces(boundary):
+    # turns the boundary faces made of the same points into internal faces,
+    # seen from their owner (the lower cell label)
+    first, second = matchFaces(boundary.faces)
+    swap = boundary.owner[first] > boundary.owner[second]
+    first[swap], second[swap] = second[swap], first[swap]
+    internal = boundary.select(first)
+    internal.neighbour = boundary.owner[second]
+    internal.patch = np.full(len(first), -1)
+    single = np.ones(len(boundary.faces), dtype=bool)
+    single[first] = single[second] = False
+    return internal, boundary.select(single)
+
+def stitchConformal(mesh, points, boundary, patchNames):
+    # mergePatchPairs of the 3D geometry: the coincident points of the two
+    # patches are merged, which makes their coincident faces internal.
+    # Returns the point map
+    extent = np.ptp(points, axis=0).max()
+    pointMap = np.arange(len(points))
+    for master, slave in mesh.mergePatchDict.items():
+        masterFaces = boundary.faces[boundary.patch == patchNames.index(master)]
+        slaveFaces = boundary.faces[boundary.patch == patchNames.index(slave)]
+        pairs = matchPoints(points, np.unique(masterFaces), np.unique(slaveFaces), 1e-7*extent)
+        if pairs:
+            pointMap[list(pairs)] = list(pairs.values())
+        merged = np.all(np.isin(slaveFaces, list(pairs)), axis=1).sum() if pairs else 0
+        if merged < min(len(masterFaces), len(slaveFaces)):
+            lo = np.maximum(points[masterFaces].min(axis=(0, 1)), points[slaveFaces].min(axis=(0, 1)))
+            hi = np.minimum(points[masterFaces].max(axis=(0, 1)), points[slaveFaces].max(axis=(0, 1)))
+            if merged or np.all(hi - lo > -1e-7*extent):
+                raise ValueError("the patches %s and %s of mergePatchPairs are not conformal: use blockMesh" % (master, slave))
+    return pointMap
+
+def cutWedgeInterface(points, isFront, boundary, master, slave, tolerance):
+    """
+    mergePatchPairs of the wedge geometries. The two patches lie in the same
+    z plane and are one cell thick, so their overlap is a union of radial
+    intervals: the faces of both patches are cut at every radius where one
+    of them has points, the overlapping pieces become internal faces and
+    the others stay in their patch. Returns the new faces (internal and
+    boundary pieces), the point map {slave: master} of the coincident
+    points and the points inserted in the edges along the interface.
+    """
+    rows = np.nonzero((boundary.patch == master) | (boundary.patch == slave))[0]
+    intervals = []
+    radii = []
+    for row in rows:
+        face = boundary.faces[row][boundary.faces[row] >= 0]
+        front = sorted((points[p, 0], p) for p in face if isFront[p])
+        back = sorted((points[p, 0], p) for p in face if not isFront[p])
+        side = 0 if boundary.patch[row] == master else 1
+        intervals.append((front[0][0], front[-1][0], side, row, front, back))
+        for (x, f), (_, b) in zip(front, back):
+            radii.append((x, side, f, b))
+
+    # radii of the cuts, coincident points of both sides merged
+    radii.sort()
+    cuts = []
+    pointMap = {}
+    for x, side, f, b in radii:
+        if cuts and x - cuts[-1][0] <= tolerance:
+            if cuts[-1][1] != side and (f, b) != cuts[-1][2:]:
+                keep, drop = ((cuts[-1][2:], (f, b)) if cuts[-1][1] == 0 else ((f, b), cuts[-1][2:]))
+                pointMap.update(zip(drop, keep))
+                cuts[-1] = (cuts[-1][0], 0) + keep
+            continue
+        cuts.append((x, side, f, b))
+
+    pieces = []
+    inserted = {}
+    xs = np.array([cut[0] for cut in cuts])
+    for k in range(len(cuts) - 1):
+        middle = 0.5*(xs[k] + xs[k + 1])
+        covering = [iv for iv in intervals if iv[0] < middle < iv[1]]
+        if not covering:
+            continue
+        owners = sorted((boundary.owner[iv[3]], iv) for iv in covering)
+        ownerCell, (x0, x1, side, row, front, back) = owners[0]
+        face = np.array([cuts[k][2], cuts[k + 1][2], cuts[k + 1][3], cuts[k][3]])
+        if np.dot(faceNormals(points, face[None])[0], faceNormals(points, boundary.faces[row:row + 1])[0]) < 0:
+            face = face[::-1]
+        neighbour = owners[1][0] if len(owners) > 1 else -1
+        patch = -1 if neighbour >= 0 else boundary.patch[row]
+        pieces.append((face, ownerCell, neighbour, patch, boundary.order[row] + k/len(cuts)))
+
+    # points of the cuts inside the edges of the original faces
+    for x0, x1, side, row, front, back in intervals:
+        for line, index in ((front, 2), (back, 3)):
+            start, end = line[0][1], line[-1][1]
+            between = [cut[index] for cut in cuts if x0 + tolerance < cut[0] < x1 - tolerance]
+            if between:
+                inserted[(start, end)] = between
+                inserted[(end, start)] = between[::-1]
+
+    faces = np.array([piece[0] for piece in pieces]).reshape(-1, 4)
+    cut = FaceSet(faces, *(np.array([piece[i] for piece in pieces]) for i in range(1, 5)))
+    return cut, rows, pointMap, inserted
+
+def insertEdgePoints(faces, rows, inserted):
+    # adds the points 'inserted' in the edges (p, q) of the faces in rows
+    grown = []
+    for row in rows:
+        face = [p for p in faces[row].tolist() if p >= 0]
+        newFace = []
+        for p, q in zip(face, face[1:] + face[:1]):
+            newFace.append(p)
+            newFace.extend(inserted.get((p, q), ()))
+        grown.append(newFace)
+    width = max([faces.shape[1]] + [len(face) for face in grown])
+    faces = padFaces(faces, width)
+    for row, face in zip(rows, grown):
+        faces[row, :len(face)] = face
+        faces[row, len(face):] = -1
+    return faces
+
+def buildPolyMesh(mesh):
+    """
+    Builds the polyMesh blockMesh would make of the blocks of the rod: same
+    point, cell and face ordering, same patches (with the mergePatchPairs
+    applied) and one cellZone per block name. The 3D geometry supports the
+    mergePatchPairs of conformal patches only; the 1D and 2D-smeared wedges
+    are built analytically, with their interfaces cut exactly.
+    """
+    if mesh.geometry == '3D':
+        blockLabels, nPoints = labelBlockPoints(mesh)
+        points = placeBlockPoints(mesh, blockLabels, nPoints)
+    elif mesh.geometry in ('1D', '2D-smeared'):
+        blockLabels, nPoints = labelBlockPoints(mesh)
+        points = placeWedgePoints(mesh, blockLabels, nPoints)
+    else:
+        raise ValueError("the direct polyMesh writer does not handle the %s geometry, use blockMesh" % mesh.geometry)
+
+    hexes = mesh.blocks.hexes.view
+    nCellsBlock = mesh.blocks.cells.view.prod(axis=1)
+    cellBase = np.concatenate(([0], np.cumsum(nCellsBlock)))
+
+    ################################# cells and faces #####################################
+    internal, surface = [], []
+    for b, labels in enumerate(blockLabels):
+        blockInternal, blockSurface = blockCellFaces(labels, cellBase[b])
+        internal.extend(blockInternal)
+        surface.extend((quads, owner, np.full(len(owner), 6*b + f)) for f, (quads, owner) in enumerate(blockSurface))
+    internalFaces = np.concatenate([quads for quads, owner, neighbour in internal])
+    nInternal = len(internalFaces)
+    internal = FaceSet(internalFaces,
+                       np.concatenate([owner for quads, owner, neighbour in internal]),
+                       np.concatenate([neighbour for quads, owner, neighbour in internal]),
+                       np.full(nInternal, -1), np.zeros(nInternal))
+    surfaceFaces = np.concatenate([quads for quads, owner, blockFace in surface])
+    surfaceBlockFace = np.concatenate([blockFace for quads, owner, blockFace in surface])
+
+    ################################# patches #############################################
+    patchNames = list(mesh.patchDict)
+    blockFacePatch = np.full(6*len(hexes), len(patchNames))
+    blockFaceEntry = np.zeros(6*len(hexes))
+    faceKeys = {}
+    for p, name in enumerate(patchNames):
+        for e, face in enumerate(mesh.patchDict[name]['faces']):
+            faceKeys[tuple(sorted(face))] = (p, e)
+    for b, hex in enumerate(hexes.tolist()):
+        for f, face in enumerate(BLOCK_FACES):
+            patch = faceKeys.get(tuple(sorted(hex[c] for c in face[2])))
+            if patch is not None:
+                blockFacePatch[6*b + f], blockFaceEntry[6*b + f] = patch
+    # boundary faces are ordered by patch, by block face in the patch and
+    # then as generated
+    surface = FaceSet(surfaceFaces,
+                      np.concatenate([owner for quads, owner, blockFace in surface]),
+                      np.full(len(surfaceFaces), -1),
+                      blockFacePatch[surfaceBlockFace],
+                      blockFaceEntry[surfaceBlockFace]*len(surfaceFaces) + np.arange(len(surfaceFaces)))
+
+    internal.faces, keep = collapseFaces(internal.faces)
+    if not keep.all():
+        internal = internal.select(keep)
+    surface.faces, keep = collapseFaces(surface.faces)
+    if not keep.all():
+        surface = surface.select(keep)
+    shared, boundary = pairFaces(surface)
+    internal = FaceSet.join([internal, shared])
+
+    ################################# mergePatchPairs #####################################
+    if mesh.geometry == '3D':
+        pointMap = stitchConformal(mesh, points, boundary, patchNames)
+        if np.any(pointMap != np.arange(nPoints)):
+            internal.faces = np.where(internal.faces >= 0, pointMap[internal.faces], -1)
+            boundary.faces = np.where(boundary.faces >= 0, pointMap[boundary.faces], -1)
+            stitched, boundary = pairFaces(boundary)
+            internal = FaceSet.join([internal, stitched])
+    else:
+        isFront = np.zeros(nPoints, dtype=bool)
+        for labels in blockLabels:
+            isFront[labels[:, 0, :]] = True
+        tolerance = 1e-7*np.ptp(points, axis=0).max()
+        pointMap = np.arange(nPoints)
+        for master, slave in mesh.mergePatchDict.items():
+            cut, rows, pairs, inserted = cutWedgeInterface(points, isFront, boundary, patchNames.index(master), patchNames.index(slave), tolerance)
+            if pairs:
+                pointMap[list(pairs)] = list(pairs.values())
+            cells = np.unique(boundary.owner[rows])
+            remaining = np.ones(len(boundary.faces), dtype=bool)
+            remaining[rows] = False
+            boundary = boundary.select(remaining)
+            internal.faces = insertEdgePoints(internal.faces, np.nonzero(np.isin(internal.owner, cells) | np.isin(internal.neighbour, cells))[0], inserted)
+            boundary.faces = insertEdgePoints(boundary.faces, np.nonzero(np.isin(boundary.owner, cells))[0], inserted)
+            internal = FaceSet.join([internal, cut.select(cut.neighbour >= 0)])
+            boundary = FaceSet.join([boundary, cut.select(cut.neighbour < 0)])
+        valid = internal.faces >= 0
+        internal.faces[valid] = pointMap[internal.faces[valid]]
+        valid = boundary.faces >= 0
+        boundary.faces[valid] = pointMap[boundary.faces[valid]]
+
+    ################################# ordering ############################################
+    internal = internal.select(np.argsort(internal.owner.astype(np.int64)*cellBase[-1] + internal.neighbour, kind='stable'))
+    boundary = boundary.select(np.lexsort((boundary.order, boundary.patch)))
+    width = max(internal.faces.shape[1], boundary.faces.shape[1])
+    faces = np.concatenate((padFaces(internal.faces, width), padFaces(boundary.faces, width)))
+    owner = np.concatenate((internal.owner, boundary.owner))
+
+    patches = []
+    start = len(internal.faces)
+    counts = np.bincount(boundary.patch, minlength=len(patchNames) + 1)
+    for p, name in enumerate(patchNames):
+        patches.append((name, mesh.patchDict[name], start, int(counts[p])))
+        start += int(counts[p])
+    if counts[-1]:
+        patches.append(("defaultFaces", {'type': 'empty'}, start, int(counts[-1])))
+
+    # points numbered in the order blockMesh meets them, block after block
+    flat = np.concatenate([labels.ravel(order='F') for labels in blockLabels])
+    order = np.argsort(flat, kind='stable')
+    first = np.concatenate(([True], flat[order][1:] != flat[order][:-1]))
+    rank = np.full(nPoints, len(flat))
+    rank[flat[order][first]] = order[first]
+    valid = faces >= 0
+    used = np.zeros(nPoints, dtype=bool)
+    used[faces[valid]] = True
+    used = np.nonzero(used)[0]
+    used = used[np.argsort(rank[used], kind='stable')]
+    renumber = np.full(nPoints, -1)
+    renumber[used] = np.arange(len(used))
+    faces[valid] = renumber[faces[valid]]
+    points = points[used]*mesh.convertToMeters
+
+    cellZone = np.repeat(mesh.blocks.zones, nCellsBlock)
+    cellZones = [(name, np.nonzero(cellZone == z)[0]) for z, name in enumerate(mesh.blocks.zoneNames)]
+
+    return PolyMesh(points, faces, owner, internal.neighbour, patches, cellZones)
+
+def iterFoamHeader(className, objectName, note=None, arch=None, location="constant/polyMesh"):
+    yield ("/*--------------------------------*- C++ -*----------------------------------*\\\n"
+           "  =========                 |\n"
+           "  \\\\      /  F ield         | OpenFOAM: The Open Source CFD Toolbox\n"
+           "   \\\\    /   O peration     |\n"
+           "    \\\\  /    A nd           |\n"
+           "     \\\\/     M anipulation  |\n"
+           "\\*---------------------------------------------------------------------------*/\n"
+           "FoamFile\n{\n"
+           "    version     2.0;\n"
+           + ("    format      ascii;\n" if arch is None else f"    format      binary;\n    arch        \"{arch}\";\n")
+           + f"    class       {className};\n")
+    if note is not None:
+        yield f"    note        \"{note}\";\n"
+    yield (f"    location    \"{location}\";\n"
+           f"    object      {objectName};\n"
+           "}\n"
+           "// * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * //\n\n")
+
+def iterList(row_str, rows):
+    yield "%d\n(\n" % len(rows)
+    yield from formatRows(row_str, rows)
+    yield ")\n\n"
+
+def iterBinaryList(array, dtype):
+    # an OpenFOAM list in binary format: size, then the raw contiguous data
+    # between parentheses (nothing for an empty list)
+    data = np.ascontiguousarray(array, dtype=dtype)
+    yield "%d\n" % len(data)
+    if len(data):
+        yield "("
+        yield memoryview(data).cast('B')
+        yield ")"
+    yield "\n\n"
+
+def iterFaces(faces):
+    # faces padded with -1, written run by run of faces of the same size
+    sizes = (faces >= 0).sum(axis=1)
+    yield "%d\n(\n" % len(faces)
+    breaks = np.concatenate(([0], np.nonzero(np.diff(sizes))[0] + 1, [len(faces)]))
+    for start, end in zip(breaks[:-1], breaks[1:]):
+        size = sizes[start]
+        yield from formatRows("%d(" % size + " ".join(["%d"]*size) + ")\n", faces[start:end, :size])
+    yield ")\n\n"
+
+def iterPolyBoundary(patches):
+    yield "%d\n(\n" % len(patches)
+    for name, info, start, nFaces in patches:
+        patch_str = f"    {name}\n    {{\n        type            {info['type']};\n"
+        patch_str += f"        nFaces          {nFaces};\n        startFace       {start};\n"
+        if info['type'] == "regionCoupledOFFBEAT":
+            patch_str += f"        neighbourPatch  {info.get('neighbour', '')};\n"
+            patch_str += "        neighbourRegion region0;\n"
+            patch_str += f"        owner           {'true' if info.get('owner') == 'true' else 'false'};\n"
+            patch_str += f"        updateAMI       {'true' if name in ('cladInner', 'fuelOuter') else 'false'};\n"
+        if info['type'] == "cyclic":
+            patch_str += "        matchTolerance  0.0001;\n"
+            patch_str += "        transform       translational;\n"
+            patch_str += f"        neighbourPatch  {info['neighbour']};\n"
+            patch_str += "        separationVector (%r %r %r);\n" % info['separation']
+        if info['type'] == "processor":
+            patch_str += "        inGroups        List<word> 1(processor);\n"
+            patch_str += "        matchTolerance  0.0001;\n"
+            patch_str += "        transform       unknown;\n"
+            patch_str += f"        myProcNo        {info['myProcNo']};\n"
+            patch_str += f"        neighbProcNo    {info['neighbProcNo']};\n"
+        yield patch_str + "    }\n"
+    yield ")\n\n"
+
+def iterCellZones(cellZones):
+    yield "%d\n(\n" % len(cellZones)
+    for name, cells in cellZones:
+        yield f"{name}\n{{\n    type cellZone;\ncellLabels      List<label> "
+        yield from iterList("%d\n", cells[:, None])
+        yield ";\n}\n"
+    yield ")\n\n"
+
+def writePolyMesh(polyMesh, directory, precision=None, binary=False, labelSize=32, scalarSize=64):
+    # writes points, faces, owner, neighbour, boundary and cellZones in
+    # 'directory' (usually constant/polyMesh). With binary=True, points,
+    # faces (as a faceCompactList), owner and neighbour are dumped from the
+    # arrays in OpenFOAM's binary format, with labels and scalars of
+    # labelSize and scalarSize bits
+    os.makedirs(directory, exist_ok=True)
+    float_str = "%r" if precision is None or precision >= 17 else f"%.{precision}g"
+    nPoints, nCells, nFaces, nInternal = len(polyMesh.points), polyMesh.nCells, len(polyMesh.faces), len(polyMesh.neighbour)
+    note = "nPoints:%d  nCells:%d  nFaces:%d  nInternalFaces:%d" % (nPoints, nCells, nFaces, nInternal)
+
+    if binary:
+        if labelSize not in (32, 64) or scalarSize not in (32, 64):
+            raise ValueError("labels and scalars are 32 or 64 bits, not %s and %s" % (labelSize, scalarSize))
+        valid = polyMesh.faces >= 0
+        if labelSize == 32 and max(nPoints, nCells, valid.sum()) >= 1 << 31:
+            raise ValueError("the mesh is too large for 32 bit labels")
+        label, scalar = "<i%d" % (labelSize//8), "<f%d" % (scalarSize//8)
+        arch = "LSB;label=%d;scalar=%d" % (labelSize, scalarSize)
+        offsets = np.concatenate(([0], np.cumsum(valid.sum(axis=1))))
+        files = (
+            ("points",      "vectorField",      None,   lambda: iterBinaryList(polyMesh.points, scalar)),
+            ("faces",       "faceCompactList",  None,   lambda: itertools.chain(iterBinaryList(offsets, label), iterBinaryList(polyMesh.faces[valid], label))),
+            ("owner",       "labelList",        note,   lambda: iterBinaryList(polyMesh.owner, label)),
+            ("neighbour",   "labelList",        note,   lambda: iterBinaryList(polyMesh.neighbour, label)),
+        )
+    else:
+        arch = None
+        files = (
+            ("points",      "vectorField",      None,   lambda: iterList(f"({float_str} {float_str} {float_str})\n", polyMesh.points)),
+            ("faces",       "faceList",         None,   lambda: iterFaces(polyMesh.faces)),
+            ("owner",       "labelList",        note,   lambda: iterList("%d\n", polyMesh.owner[:, None])),
+            ("neighbour",   "labelList",        note,   lambda: iterList("%d\n", polyMesh.neighbour[:, None])),
+        )
+    for objectName, className, fileNote, body in files:
+        with BufferedSink(os.path.join(directory, objectName), binary=arch is not None) as sink:
+            sink.writelines(iterFoamHeader(className, objectName, fileNote, arch))
+            sink.writelines(body())
+            sink.write("\n// ************************************************************************* //\n")
+
+    files = (
+        ("boundary",    "polyBoundaryMesh", lambda: iterPolyBoundary(polyMesh.patches)),
+        ("cellZones",   "regIOobject",      lambda: iterCellZones(polyMesh.cellZones)),
+    )
+    for objectName, className, body in files:
+        with BufferedSink(os.path.join(directory, objectName)) as sink:
+            sink.writelines(iterFoamHeader(className, objectName))
+            sink.writelines(body())
+            sink.write("\n// ************************************************************************* //\n")
 
-    if(bottomCapHeight>0):
-        bottomCap=True
-        nBlocksClad += 1
-        blockNameClad.insert(0, 'cladding')
-        cladType.insert(0, 'cap')
-        rInnerClad.insert(0, rInnerClad[0])
-        rOuterClad.insert(0, rOuterClad[0])
-        heightClad.insert(0, bottomCapHeight)
-        offsetClad -= float(heightClad[0])
-        nCellsRClad.insert(0, nCellsRClad[0])
-        nCellsZClad.insert(0, nCellsZBottomCap)
-        if geometry=='3D':
-            nCellsAzimuthalClad.insert(0, nCellsAzimuthalClad[0])
-
-    if(topCapHeight>0):
-        topCap=True
-        nBlocksClad += 1
-        blockNameClad.append('cladding')
-        cladType.append('cap')
-        rInnerClad.append(rInnerClad[nBlocksClad-2])
-        rOuterClad.append(rOuterClad[nBlocksClad-2])
-        heightClad.append(topCapHeight)
-        nCellsRClad.append(nCellsRClad[nBlocksClad-2])
-        nCellsZClad.append(nCellsZTopCap)
-        if geometry== '3D':
-            nCellsAzimuthalClad.append(nCellsAzimuthalClad[nBlocksClad-2])
-
-if geometry=='1D' or geometry=='2D-smeared':
+###################################################################################################################################################
+#########################---------------------------------------- ROD SETUP AND BUILD ----------------------------------------#########################
+###################################################################################################################################################
+
+class RodMesh:
+    """
+    Everything that ends up in the blockMeshDict of one rod: spheres,
+    vertices, blocks, arc edges, face projections, boundary patches and
+    merge pairs. Each call of build_rod() returns a fresh instance, so
+    nothing is shared between two rods built in the same process.
+    """
+
+    def __init__(self, convertToMeters, geometry, writePrecision=None, analyticDish=False):
+        self.convertToMeters = convertToMeters
+        self.geometry = geometry
+        self.writePrecision = writePrecision
+        self.analyticDish = analyticDish
+
+        self.spheres = GrowableArray(4)
+        self.vertices = GrowableArray(3)
+        self.blocks = BlockStore()
+        self.edges = EdgeStore()
+        self.projections = ProjectionStore()
+
+        self.patchDict = {}
+        self.mergePatchDict = defaultdict(list)
+        self.patchGroups = {}
+        # (first pellet, number of pellets, first and end rows of the vertices,
+        # edges and spheres) of each block of stamped pellets
+        self.pelletRows = []
+
+    def write(self, target, precision=None, incremental=False):
+        if precision is None:
+            precision = self.writePrecision
+        writeBlockMeshDict(self, target, precision, incremental)
+        if not hasattr(target, "write"):
+            writeInterfaceMap(self, target + ".interfaces")
+
+    def writePolyMesh(self, directory, precision=None, binary=False, labelSize=32, scalarSize=64):
+        # writes the mesh blockMesh would make of this dictionary (not for 2D-discrete)
+        if precision is None:
+            precision = self.writePrecision
+        buildPolyMesh(self).write(directory, precision, binary, labelSize, scalarSize)
+        writeInterfaceMap(self, os.path.join(directory, "interfaces"))
+
+def readRodDict(path='rodDict'):
+    # Reading the data from the rodDict file
+    with open(path) as f:
+        data = f.read()
+
+    # Reconstructing the data as a dictionary
+    return ast.literal_eval(data)
+
+def setupRod(rodDict):
+    """
+    Turns the user rodDict into the effective input of the generator: the
+    caps are inserted in the cladding lists, the pellet types are classified
+    and the fuel/cladding block dictionaries are created. The rodDict passed
+    in is not modified.
+    """
+
+    rodDict = copy.deepcopy(rodDict)
+    if rodDict.get('unitCell'):
+        if rodDict.get('discreteWindow') is not None:
+            raise ValueError("'unitCell' and 'discreteWindow' cannot be combined")
+        rodDict = unitCellDict(rodDict)
+
+    ###############################################################
+    ######### Extracting parameters from the dictionary ###########
+    ###############################################################
+
+    # Basic parameters
+    convertToMeters = rodDict['convertToMeters']
+    geometry = rodDict['geometryType']
+    if rodDict.get('discreteWindow') is not None and geometry not in ('3D', '2D-discrete'):
+        raise ValueError("'discreteWindow' needs the pellets of a 3D or 2D-discrete geometry")
+
+    nBlocksFuel = rodDict['nBlocksFuel']
+    blockNameFuel = rodDict['blockNameFuel']
+    nBlocksClad = rodDict['nBlocksClad']
+    blockNameClad = rodDict['blockNameClad']
+
+    # Geometrical parameters for fuel and cladding
+    rInnerFuel = rodDict['rInnerFuel']
+    rOuterFuel = rodDict['rOuterFuel']
+    rInnerClad = rodDict['rInnerClad']
+    rOuterClad = rodDict['rOuterClad']
+    heightFuel = rodDict['heightFuel']
+    heightClad = rodDict['heightClad']
+
+    # Global offsets
+    offsetFuel = rodDict['offsetFuel']
+    offsetClad = rodDict['offsetClad']
+
+    # Mesh properties for cladding
+    nCellsZClad = rodDict['nCellsZClad']
+    nCellsRClad = rodDict['nCellsRClad']
+
+    setup = {
+        "convertToMeters":       convertToMeters,
+        "geometry":              geometry,
+        "writePrecision":        rodDict.get('writePrecision', None),
+        "conformalStacking":     rodDict.get('conformalStacking', False),
+        "groupInterfacePatches": rodDict.get('groupInterfacePatches', False),
+        "symmetry":              rodDict.get('symmetry', None),
+        "unitCell":              rodDict.get('unitCell', None),
+        "analyticDish":          rodDict.get('analyticDish', False),
+        "bottomCap":             False,
+        "topCap":                False,
+    }
+
+    if geometry!='3D':
+        # transforming degrees to radians
+        wedgeAngle=rodDict['wedgeAngle']*math.pi/180
+        setup["wedgeAngle"]=wedgeAngle
+
+    if geometry=='2D-discrete' or geometry=='3D':
+        # Pellet parameters
+        nPelletsFuel = rodDict['nPelletsFuel']
+        setup["nPelletsFuel"]=nPelletsFuel
+        setup["totalPelletNumber"]=sum(nPelletsFuel)
+
+    if geometry=='3D':
+        squareFractionTopCap=rodDict.get('squareFractionTopCap', None)
+        squareFractionBottomCap=rodDict.get('squareFractionBottomCap', None)
+
+    if geometry=='2D-discrete' or geometry=='3D':
+        # Global merge patch pairs options
+        setup["mergeCladPatchPairs"] = rodDict['mergeCladPatchPairs']
+        setup["mergeFuelPatchPairs"] = rodDict['mergeFuelPatchPairs']
+
+        # Geometry of the fuel pellet
+        rDishFuel = rodDict['rDishFuel']
+        rCurvatureDish = rodDict['rCurvatureDish']
+        chamferHeight = rodDict['chamferHeight']
+        chamferWidth = rodDict['chamferWidth']
+
+    if geometry=='3D':
+        # Mesh properties for fuel
+        squareFraction = rodDict['squareFraction']
+        nCellsAzimuthalFuel = rodDict['nCellsAzimuthalFuel']
+        nCellsAzimuthalClad = rodDict['nCellsAzimuthalClad']
+        setup["eccentricity"]=rodDict['eccentricity']
+        setup["eccentricity_mode"]=rodDict['eccentricity_mode']
+
+        if setup["eccentricity_mode"]=='manual':
+            setup["eccVector"]=rodDict['eccentricity_vector']
+        else:
+            setup["eccentricitySeed"]=rodDict.get('eccentricitySeed', None)
+    else:
+        setup["eccentricity"]=False
+
+
+    ###################################################################
+    ############## Dealing with the top and bottom caps ###############
+    ####### adding new blocks to the list of cladding blocks ##########
+    ###################################################################
+    cladType = ['normal' for i in range(nBlocksClad)]
+
+    if geometry!='1D':
+        # Cap parameters
+        bottomCapHeight = rodDict['bottomCapHeight']
+        topCapHeight = rodDict['topCapHeight']
+        nCellsRBottomCap = rodDict.get('nCellsRBottomCap', None)
+        nCellsZBottomCap = rodDict.get('nCellsZBottomCap', None)
+        nCellsRTopCap = rodDict.get('nCellsRTopCap', None)
+        nCellsZTopCap = rodDict.get('nCellsZTopCap', None)
+
+
+        if(bottomCapHeight>0):
+            setup["bottomCap"]=True
+            nBlocksClad += 1
+            blockNameClad.insert(0, 'cladding')
+            cladType.insert(0, 'cap')
+            rInnerClad.insert(0, rInnerClad[0])
+            rOuterClad.insert(0, rOuterClad[0])
+            heightClad.insert(0, bottomCapHeight)
+            offsetClad -= float(heightClad[0])
+            nCellsRClad.insert(0, nCellsRClad[0])
+            nCellsZClad.insert(0, nCellsZBottomCap)
+            if geometry=='3D':
+                nCellsAzimuthalClad.insert(0, nCellsAzimuthalClad[0])
+
+        if(topCapHeight>0):
+            setup["topCap"]=True
+            nBlocksClad += 1
+            blockNameClad.append('cladding')
+            cladType.append('cap')
+            rInnerClad.append(rInnerClad[nBlocksClad-2])
+            rOuterClad.append(rOuterClad[nBlocksClad-2])
+            heightClad.append(topCapHeight)
+            nCellsRClad.append(nCellsRClad[nBlocksClad-2])
+            nCellsZClad.append(nCellsZTopCap)
+            if geometry== '3D':
+                nCellsAzimuthalClad.append(nCellsAzimuthalClad[nBlocksClad-2])
+
+    setup["offsetFuel"]=offsetFuel
+    setup["offsetClad"]=offsetClad
 
     ###########################################################################
     # Initialize lists to hold dictionaries for each fuel and cladding blocks #
@@ -1898,298 +3864,1680 @@ if geometry=='1D' or geometry=='2D-smeared':
     fuel_blocks = []
     cladding_blocks = []
 
-    for i in range(nBlocksFuel):
+    if geometry=='1D' or geometry=='2D-smeared':
 
-        block_fuel = {
-            
-            'name':                      blockNameFuel[i],
+        for i in range(nBlocksFuel):
 
-            'rInner':                     rInnerFuel[i],
-            'rOuter':                    rOuterFuel[i],
-            'height':                    heightFuel[i],
+            block_fuel = {
 
-            # mesh properties:
-            "nR":                        rodDict['nCellFuelR'][i],
-            "nZ":                        rodDict['nCellFuelZ'][i],
+                'name':                      blockNameFuel[i],
 
-            "nVertices":                 8
+                'rInner':                     rInnerFuel[i],
+                'rOuter':                    rOuterFuel[i],
+                'height':                    heightFuel[i],
 
-        }
+                # mesh properties:
+                "nR":                        rodDict['nCellFuelR'][i],
+                "nZ":                        rodDict['nCellFuelZ'][i],
 
-        fuel_blocks.append(block_fuel)
+                "nVertices":                 8
 
+            }
 
-    for i in range(nBlocksClad):
-        block_clad = {
+            fuel_blocks.append(block_fuel)
 
-            'name':                       blockNameClad[i],
-            'rInner':                     rInnerClad[i],
-            'rOuter':                     rOuterClad[i],
-            'height':                     heightClad[i],
 
-            'type':                       cladType[i],
+        for i in range(nBlocksClad):
+            block_clad = {
 
-            "nR":                         nCellsRClad[i],
-            "nZ":                         nCellsZClad[i],
+                'name':                       blockNameClad[i],
+                'rInner':                     rInnerClad[i],
+                'rOuter':                     rOuterClad[i],
+                'height':                     heightClad[i],
 
-            "nVertices":                 8
-        }    
+                'type':                       cladType[i],
 
-        if cladType[i]=='cap':
-            block_clad["nVertices"]=10
-            if i==0:
-                block_clad["nRInner"]=nCellsRBottomCap
-            else:
-                block_clad["nRInner"]=nCellsRTopCap
+                "nR":                         nCellsRClad[i],
+                "nZ":                         nCellsZClad[i],
 
-        cladding_blocks.append(block_clad)
-    
+                "nVertices":                 8
+            }
 
-if geometry=='2D-discrete' or geometry=='3D':
+            if cladType[i]=='cap':
+                block_clad["nVertices"]=10
+                if i==0:
+                    block_clad["nRInner"]=nCellsRBottomCap
+                else:
+                    block_clad["nRInner"]=nCellsRTopCap
 
-    nCellsRPellet=rodDict.get('nCellsRPellet',None)
-    nCellsRDish = rodDict.get('nCellsRDish', None)
-    nCellsRChamfer = rodDict.get('nCellsRChamfer',None)
-    nCellsZPellet = rodDict['nCellsZPellet']
+            cladding_blocks.append(block_clad)
 
-    # Creating the list of pellet types
-    pelletType = []
-    nVerticesFuel = [0.0 for i in range(nBlocksFuel)]
-    rLandFuel     = [0.0 for i in range(nBlocksFuel)] # end of land / start of chamfer
 
-    for i in range(nBlocksFuel):
-        if rDishFuel[i] > 0.0 and chamferWidth[i] > 0.0:
-            pelletType.append('dishedChamfered')
-            rLandFuel[i]     = rOuterFuel[i] - chamferWidth[i]
-            if geometry=='3D':
-                nVerticesFuel[i] = 32
-            else:
-                nVerticesFuel[i] = 16
-        elif rDishFuel[i] > 0.0:
-            pelletType.append('dished')
-            rLandFuel[i]     = rOuterFuel[i]
-            if geometry=='3D':
-                nVerticesFuel[i] = 24
+    if geometry=='2D-discrete' or geometry=='3D':
+
+        nCellsRPellet=rodDict.get('nCellsRPellet',None)
+        nCellsRDish = rodDict.get('nCellsRDish', None)
+        nCellsRChamfer = rodDict.get('nCellsRChamfer',None)
+        nCellsZPellet = rodDict['nCellsZPellet']
+
+        # Creating the list of pellet types
+        pelletType = []
+        nVerticesFuel = [0.0 for i in range(nBlocksFuel)]
+        rLandFuel     = [0.0 for i in range(nBlocksFuel)] # end of land / start of chamfer
+
+        for i in range(nBlocksFuel):
+            if rDishFuel[i] > 0.0 and chamferWidth[i] > 0.0:
+                pelletType.append('dishedChamfered')
+                rLandFuel[i]     = rOuterFuel[i] - chamferWidth[i]
+                if geometry=='3D':
+                    nVerticesFuel[i] = 32
+                else:
+                    nVerticesFuel[i] = 16
+            elif rDishFuel[i] > 0.0:
+                pelletType.append('dished')
+                rLandFuel[i]     = rOuterFuel[i]
+                if geometry=='3D':
+                    nVerticesFuel[i] = 24
+                else:
+                    nVerticesFuel[i] = 12
+            elif chamferWidth[i] > 0.0:
+                pelletType.append('chamfered')
+                rLandFuel[i]     = rOuterFuel[i] - chamferWidth[i]
+                if geometry=='3D':
+                    nVerticesFuel[i] = 24
+                else:
+                    nVerticesFuel[i] = 12
             else:
-                nVerticesFuel[i] = 12
-        elif chamferWidth[i] > 0.0:
-            pelletType.append('chamfered')
-            rLandFuel[i]     = rOuterFuel[i] - chamferWidth[i]
+                pelletType.append('flat')
+                rLandFuel[i]     = rOuterFuel[i]
+                if geometry=='3D':
+                    nVerticesFuel[i] = 16
+                else:
+                    nVerticesFuel[i]= 8
+
+
+        for i in range(nBlocksFuel):
+            fuel_block = {
+
+            "blockName": blockNameFuel[i],
+
+            "rInner": rInnerFuel[i],
+            "rOuter": rOuterFuel[i],
+            "height": heightFuel[i]/nPelletsFuel[i], # height of each pellet
+
+            "type": pelletType[i],
+
+            "rLand": rLandFuel[i],
+            "rDish": rDishFuel[i],
+            "rCurvatureDish" : rCurvatureDish[i],
+            "chamferWidth": chamferWidth[i],
+            "chamferHeight": chamferHeight[i],
+
+            "nCellsRPellet": nCellsRPellet[i],
+            "nCellsRDish": nCellsRDish[i],
+            "nCellsRChamfer": nCellsRChamfer[i],
+            "nCellsZPellet": nCellsZPellet[i],
+            "nVertices": nVerticesFuel[i],
+            }
+
             if geometry=='3D':
-                nVerticesFuel[i] = 24
+                fuel_block['squareFraction'] = squareFraction[i]
+                fuel_block["nCellsAzimuthal"]= nCellsAzimuthalFuel[i]
             else:
-                nVerticesFuel[i] = 12
-        else:
-            pelletType.append('flat')
-            rLandFuel[i]     = rOuterFuel[i]
+                fuel_block['wedgeAngle'] = wedgeAngle
+
+            fuel_blocks.append(fuel_block)
+
+        window = rodDict.get('discreteWindow', None)
+        if window is not None:
+            discrete = discretePellets(fuel_blocks, nPelletsFuel, offsetFuel, window)
+            fuel_blocks, nPelletsFuel, source = hybridFuelBlocks(fuel_blocks, nPelletsFuel, discrete, rodDict.get('nCellsZSmeared', 1), geometry)
+            setup["nPelletsFuel"] = nPelletsFuel
+            setup["totalPelletNumber"] = sum(nPelletsFuel)
+            setup["pelletSource"] = source
+            if "eccVector" in setup:
+                setup["eccVector"] = [setup["eccVector"][j] if j is not None else [0.0, 0.0] for j in source]
+
+        for i in range(nBlocksClad):
+            clad_block = {
+
+                "blockName": blockNameClad[i],
+
+                "type": cladType[i],
+                "rInner": rInnerClad[i],
+                "rOuter": rOuterClad[i],
+                "height": heightClad[i],
+                "nVertices": 8,
+                "nCellsR": nCellsRClad[i],
+                "nCellsZ": nCellsZClad[i]
+            }
+
             if geometry=='3D':
-                nVerticesFuel[i] = 16
+                clad_block["nCellsAzimuthal"]= nCellsAzimuthalClad[i]
+                clad_block["nVertices"]= 16
             else:
-                nVerticesFuel[i]= 8
+                clad_block['wedgeAngle'] = wedgeAngle
 
+            if cladType[i]=="cap":
+                if i==0:
+                    clad_block["nCellsRInner"]=nCellsRBottomCap
+                    if geometry=='3D':
+                        clad_block["squareFraction"]=squareFractionBottomCap
+                else:
+                    clad_block["nCellsRInner"]=nCellsRTopCap
+                    if geometry=='3D':
+                        clad_block["squareFraction"]=squareFractionTopCap
+                if geometry=='3D':
+                    clad_block["nVertices"]=24
+                else:
+                    clad_block["nVertices"]=10
 
-    '''------------------------------------------------------------------------
-    ------------------------------------------------------------------------'''
-    ###########################################################################
-    # Initialize lists to hold dictionaries for each fuel and cladding blocks #
-    ###########################################################################
-    
-    fuel_blocks = []
-    cladding_blocks = []
+            cladding_blocks.append(clad_block)
 
-    for i in range(nBlocksFuel):
-        fuel_block = {
+    setup["fuel_blocks"]=fuel_blocks
+    setup["cladding_blocks"]=cladding_blocks
 
-        "blockName": blockNameFuel[i],
+    # finding the minimum gap width along the whole rod, used for the case when
+    # simulating randoom pellet eccentricity in 3D case by 'default model'
+    if geometry=='3D' and setup["eccentricity"] and setup["eccentricity_mode"]=='default':
+        max_rOuterFuel=0
+        for i in range(nBlocksFuel):
+            rOuter=fuel_blocks[i]["rOuter"]
+            if rOuter>max_rOuterFuel:
+                max_rOuterFuel=rOuter
 
-        "rInner": rInnerFuel[i],
-        "rOuter": rOuterFuel[i],
-        "height": heightFuel[i]/nPelletsFuel[i], # height of each pellet
+        min_RInnerClad=100000
+        for i in range(nBlocksClad):
+            rInner=cladding_blocks[i]["rInner"]
+            if rInner<min_RInnerClad:
+                min_RInnerClad=rInner
+
+        setup["minGap"]=min_RInnerClad-max_rOuterFuel
+
+    return setup
+
+def addCladding(mesh, setup, i_vertex):
+    # the cladding blocks of a 2D-discrete or 3D rod, from vertex i_vertex on
+    geometry = setup["geometry"]
+    cladding_blocks = setup["cladding_blocks"]
+    global_clad_offset = setup["offsetClad"]
+    i_global = 1
+    for clad_block in cladding_blocks:
+        addCladVertices(mesh.vertices, clad_block, global_clad_offset, geometry)
+        addCladBlocks(mesh.blocks, clad_block, i_vertex, geometry)
+        addCladEdges(mesh.edges, clad_block, i_vertex, global_clad_offset, geometry)
+        addCladToPatchDict(mesh.patchDict, mesh.mergePatchDict, clad_block, setup["mergeCladPatchPairs"], len(cladding_blocks), i_vertex, i_global, geometry)
+        i_vertex += clad_block['nVertices']
+        global_clad_offset += clad_block['height']
+        i_global += 1
+
+def build_rod(rod_dict, workers=None):
+    """
+    Builds the blockMesh description of the rod defined by 'rod_dict' (the
+    dictionary read from a rodDict file) and returns it as a RodMesh. The
+    function keeps all of its state local, so it can be called repeatedly
+    in the same process. The pellets are built by 'workers' processes
+    (default: 'buildWorkers' of the rodDict, see AXIAL SHARDING).
+    """
+
+    setup = setupRod(rod_dict)
+
+    geometry = setup["geometry"]
+    fuel_blocks = setup["fuel_blocks"]
+    cladding_blocks = setup["cladding_blocks"]
+    nBlocksFuel = len(fuel_blocks)
+    nBlocksClad = len(cladding_blocks)
+    bottomCap = setup["bottomCap"]
+    topCap = setup["topCap"]
+
+    mesh = RodMesh(setup["convertToMeters"], geometry, setup["writePrecision"], setup["analyticDish"])
+
+    global_clad_offset=setup["offsetClad"]
+    global_fuel_offset=setup["offsetFuel"]
 
-        "type": pelletType[i],
+    i_global=1
+    i_vertex=0
+    i_sphere=2
 
-        "rLand": rLandFuel[i],
-        "rDish": rDishFuel[i],
-        "rCurvatureDish" : rCurvatureDish[i],
-        "chamferWidth": chamferWidth[i],
-        "chamferHeight": chamferHeight[i],
 
-        "nCellsRPellet": nCellsRPellet[i],
-        "nCellsRDish": nCellsRDish[i],
-        "nCellsRChamfer": nCellsRChamfer[i],    
-        "nCellsZPellet": nCellsZPellet[i],
-        "nVertices": nVerticesFuel[i],
-        }
+    if geometry=="1D" or geometry=="2D-smeared":
 
-        if geometry=='3D':
-            fuel_block['squareFraction'] = squareFraction[i]
-            fuel_block["nCellsAzimuthal"]= nCellsAzimuthalFuel[i]
-        else:
-            fuel_block['wedgeAngle'] = wedgeAngle
-      
-        fuel_blocks.append(fuel_block)
-
-    for i in range(nBlocksClad):
-        clad_block = {
-
-            "blockName": blockNameClad[i],
-
-            "type": cladType[i],
-            "rInner": rInnerClad[i],
-            "rOuter": rOuterClad[i],
-            "height": heightClad[i],
-            "nVertices": 8,
-            "nCellsR": nCellsRClad[i],
-            "nCellsZ": nCellsZClad[i]
-        }
+            wedgeAngle=setup["wedgeAngle"]
 
-        if geometry=='3D':
-            clad_block["nCellsAzimuthal"]= nCellsAzimuthalClad[i]
-            clad_block["nVertices"]= 16
+            for i in range(nBlocksFuel):
+                addWedgeVertices(mesh.vertices, fuel_blocks[i], wedgeAngle, global_fuel_offset, 0)
+                addWedgeBlocks(mesh.blocks, fuel_blocks[i], i_vertex, 0)
+                addWedgePatches(mesh.patchDict, mesh.mergePatchDict, fuel_blocks[i], nBlocksFuel, bottomCap, topCap, i_vertex, i_global, geometry, 0)
+                global_fuel_offset+=fuel_blocks[i]['height']
+                i_vertex+=fuel_blocks[i]['nVertices']
+                i_global+=1
+
+            i_global=1
+
+            for i in range(nBlocksClad):
+                addWedgeVertices(mesh.vertices, cladding_blocks[i], wedgeAngle, global_clad_offset, 1)
+                addWedgeBlocks(mesh.blocks, cladding_blocks[i], i_vertex, 1)
+                addWedgePatches(mesh.patchDict, mesh.mergePatchDict, cladding_blocks[i], nBlocksClad, bottomCap, topCap, i_vertex, i_global, geometry, 1)
+                global_clad_offset+=cladding_blocks[i]['height']
+                i_vertex+=cladding_blocks[i]['nVertices']
+                i_global+=1
+
+
+    if geometry=="3D" or geometry=="2D-discrete":
+
+        layout=fuelLayout(setup)
+        if workers is None:
+            workers=rod_dict.get('buildWorkers', 1) or 1
+        # (no nested pools inside the worker processes of batch runs and sweeps)
+        if workers > 1 and not multiprocessing.current_process().daemon:
+            nFuelBlocks=addShardedRod(mesh, setup, layout, workers)
         else:
-            clad_block['wedgeAngle'] = wedgeAngle
+            totalPelletNumber=setup["totalPelletNumber"]
+            for pellet, offsets, shiftX, shiftY in layout:
+                nPellets=len(offsets)
+
+                rows = (len(mesh.vertices), len(mesh.edges), len(mesh.spheres))
+                i_sphere = addStampedPellets(mesh, pellet, nPellets, i_vertex, i_sphere, offsets, shiftX, shiftY, geometry)
+                mesh.pelletRows.append((i_global-1, nPellets, rows, (len(mesh.vertices), len(mesh.edges), len(mesh.spheres))))
+
+                # the patch names depend on the global pellet number, so the patches
+                # are still set pellet by pellet
+                for j in range(nPellets):
+                    addFuelToPatchDict(mesh.patchDict, mesh.mergePatchDict, pellet, setup["mergeFuelPatchPairs"], totalPelletNumber, bottomCap, topCap, i_vertex, i_global, geometry)
+                    i_vertex+=pellet['nVertices']
+                    i_global+=1
+
+            nFuelBlocks=len(mesh.blocks)
+            addCladding(mesh, setup, i_vertex)
+
+    if setup["symmetry"] is not None:
+        if geometry!='3D' or setup["eccentricity"]:
+            raise ValueError("'symmetry' needs a 3D geometry without eccentricity")
+        cutSymmetry(mesh, setup["symmetry"], nFuelBlocks)
+    if setup["unitCell"]:
+        makeCyclicEnds(mesh, fuel_blocks[0]['height']*setup["unitCell"], setup["unitCell"])
+    if setup["conformalStacking"]:
+        weldConformalInterfaces(mesh)
+    if setup["groupInterfacePatches"]:
+        groupInterfacePatches(mesh)
+
+    return mesh
 
-        if cladType[i]=="cap":
-            if i==0:
-                clad_block["nCellsRInner"]=nCellsRBottomCap
-                if geometry=='3D':
-                    clad_block["squareFraction"]=squareFractionBottomCap
+'''------------------------------------------------------------
+-------------------------- MAIN -------------------------------
+------------------------------------------------------------'''
+
+###################################################################################################################################################
+#########################-------------------------------------------- OUTPUT CACHE --------------------------------------------#########################
+###################################################################################################################################################
+
+# The generated blockMeshDict only depends on the effective input of the
+# generator (the setup after cap insertion and pellet classification), on the
+# write precision and on the generator itself: cases are stored under the
+# digest of these in <cache>/<digest[:2]>/<digest>/, optionally together with
+# the polyMesh blockMesh made of them. Entries are created by an atomic
+# rename, so concurrent workers never see half-written entries, and the least
+# recently used ones are evicted when the cache exceeds its size. The total
+# size is kept in <cache>/size, so that the entries are only listed when the
+# limit is crossed.
+
+def toolDigest():
+    with open(os.path.abspath(__file__), 'rb') as f:
+        return __version__ + "-" + hashlib.sha1(f.read()).hexdigest()
+
+def cacheKey(rodDict, precision=None):
+    # Digest of the effective input, None if the output is not reproducible
+    # (random 'default' eccentricity without an 'eccentricitySeed')
+    setup = setupRod(rodDict)
+    if setup["eccentricity"] and setup["eccentricity_mode"]=='default' and setup.get("eccentricitySeed") is None:
+        return None
+    if precision is None:
+        precision = setup["writePrecision"]
+    normalized = json.dumps([toolDigest(), precision, setup], sort_keys=True, default=repr)
+    return hashlib.sha256(normalized.encode()).hexdigest()
+
+def copyFile(source, target, readOnly=False):
+    # The cached files are copied, never hard-linked: OpenFOAM tools rewrite
+    # files in place (blockMesh, renumberMesh -overwrite, ...), which would
+    # change the cache entry and every case linked to it. The target is
+    # removed first, in case it is still a link made by an older version.
+    if os.path.lexists(target):
+        os.remove(target)
+    shutil.copyfile(source, target)
+    if readOnly:
+        os.chmod(target, 0o444)
+
+def entrySize(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, dirs, files in os.walk(path) for name in files)
+
+class OutputCache:
+
+    def __init__(self, root, maxBytes=1 << 30):
+        self.root = os.path.abspath(root)
+        self.maxBytes = maxBytes
+
+    def entry(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def fetch(self, key, target, polyMeshTarget=None):
+        # Copies the cached blockMeshDict, and the cached polyMesh if asked
+        # and available; False on a miss
+        entry = self.entry(key)
+        try:
+            os.utime(entry)
+            copyFile(os.path.join(entry, 'blockMeshDict'), target)
+            if os.path.exists(os.path.join(entry, 'blockMeshDict.interfaces')):
+                copyFile(os.path.join(entry, 'blockMeshDict.interfaces'), target + ".interfaces")
+            if polyMeshTarget is not None and os.path.isdir(os.path.join(entry, 'polyMesh')):
+                self.restorePolyMesh(os.path.join(entry, 'polyMesh'), polyMeshTarget)
+        except OSError:
+            # missing, or evicted meanwhile by another worker
+            return False
+        return True
+
+    def restorePolyMesh(self, source, target):
+        # replaces the whole target directory, so that no file of an older
+        # mesh (cellZones, sets, ...) is left next to the restored one
+        parent = os.path.dirname(os.path.abspath(target))
+        os.makedirs(parent, exist_ok=True)
+        staging = tempfile.mkdtemp(prefix='.polyMesh-', dir=parent)
+        try:
+            for name in os.listdir(source):
+                copyFile(os.path.join(source, name), os.path.join(staging, name))
+            if os.path.lexists(target):
+                doomed = tempfile.mkdtemp(prefix='.polyMesh-', dir=parent)
+                os.rename(target, os.path.join(doomed, 'polyMesh'))
+                shutil.rmtree(doomed, ignore_errors=True)
+            os.rename(staging, target)
+        except OSError:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+
+    def publish(self, key, fill):
+        # fill(directory) populates a private directory which is then renamed
+        # into place; the first of concurrent writers wins
+        os.makedirs(os.path.dirname(self.entry(key)), exist_ok=True)
+        staging = tempfile.mkdtemp(prefix='.staging-', dir=self.root)
+        try:
+            fill(staging)
+            size = entrySize(staging)
+            os.rename(staging, self.entry(key))
+        except OSError as e:
+            shutil.rmtree(staging, ignore_errors=True)
+            if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                raise
+            return
+        self.grow(size)
+
+    def store(self, key, blockMeshDict):
+        def fill(staging):
+            copyFile(blockMeshDict, os.path.join(staging, 'blockMeshDict'), readOnly=True)
+            if os.path.exists(blockMeshDict + ".interfaces"):
+                copyFile(blockMeshDict + ".interfaces", os.path.join(staging, 'blockMeshDict.interfaces'), readOnly=True)
+        self.publish(key, fill)
+
+    def storePolyMesh(self, key, polyMeshDir):
+        # adds the polyMesh generated by blockMesh to an existing entry
+        entry = self.entry(key)
+        if not os.path.isdir(entry) or os.path.isdir(os.path.join(entry, 'polyMesh')):
+            return False
+        staging = tempfile.mkdtemp(prefix='.staging-', dir=entry)
+        try:
+            for name in os.listdir(polyMeshDir):
+                if os.path.isfile(os.path.join(polyMeshDir, name)):
+                    copyFile(os.path.join(polyMeshDir, name), os.path.join(staging, name), readOnly=True)
+            size = entrySize(staging)
+            os.rename(staging, os.path.join(entry, 'polyMesh'))
+        except OSError:
+            shutil.rmtree(staging, ignore_errors=True)
+            return False
+        self.grow(size)
+        return True
+
+    def grow(self, size):
+        # adds a new entry (or polyMesh) to the running total, and evicts
+        # once the total exceeds maxBytes; without a size file (new cache,
+        # or written by an older version) the entries are counted once
+        with open(os.path.join(self.root, 'lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(os.path.join(self.root, 'size')) as f:
+                    total = int(f.read()) + size
+            except (OSError, ValueError):
+                total = None
+            if total is None or total > self.maxBytes:
+                self.removeOldest()
             else:
-                clad_block["nCellsRInner"]=nCellsRTopCap
-                if geometry=='3D':
-                    clad_block["squareFraction"]=squareFractionTopCap
-            if geometry=='3D':
-                clad_block["nVertices"]=24
+                self.writeSize(total)
+
+    def writeSize(self, total):
+        with BufferedSink(os.path.join(self.root, 'size')) as sink:
+            sink.write("%d\n" % total)
+
+    def evict(self):
+        with open(os.path.join(self.root, 'lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self.removeOldest()
+
+    def removeOldest(self):
+        # removes the least recently used entries down to 90% of maxBytes,
+        # so that the next stores do not list the entries again, and resets
+        # the running total to the size left; called with the lock held
+        entries = []
+        for prefix in os.listdir(self.root):
+            if len(prefix) == 2 and os.path.isdir(os.path.join(self.root, prefix)):
+                for key in os.listdir(os.path.join(self.root, prefix)):
+                    path = os.path.join(self.root, prefix, key)
+                    entries.append((os.path.getmtime(path), entrySize(path), path))
+        total = sum(size for mtime, size, path in entries)
+        if total <= self.maxBytes:
+            self.writeSize(total)
+            return
+        for mtime, size, path in sorted(entries):
+            if total <= 0.9*self.maxBytes:
+                break
+            # renamed first, so that readers see either the entry or nothing
+            doomed = tempfile.mkdtemp(prefix='.evicted-', dir=self.root)
+            os.rename(path, os.path.join(doomed, 'entry'))
+            shutil.rmtree(doomed, ignore_errors=True)
+            total -= size
+        self.writeSize(total)
+
+###################################################################################################################################################
+#########################--------------------------------------------- BATCH MODE ---------------------------------------------#########################
+###################################################################################################################################################
+
+def findRodDicts(patterns):
+    # Expands files, case directories and glob patterns into a sorted list of
+    # unique rodDict paths; a directory stands for <dir>/rodDict
+    paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        if not matches:
+            raise FileNotFoundError("no match for '%s'" % pattern)
+        for match in matches:
+            if os.path.isdir(match):
+                match = os.path.join(match, 'rodDict')
+            paths.append(os.path.abspath(match))
+    return sorted(set(paths))
+
+def caseOutputPath(rodDictPath):
+    return os.path.join(os.path.dirname(rodDictPath), 'system', 'blockMeshDict')
+
+def runCase(rodDictPath, precision=None, cache=None, polyMesh=False, direct=False, polyMeshFormat=None):
+    # Worker of the batch mode: never raises, returns (path, seconds, error, cached)
+    start = time.perf_counter()
+    # forked workers share the parent's random state: reseed so that
+    # 'default' eccentricities differ between cases as in separate runs
+    random.seed()
+    cached = False
+    try:
+        rodDict = readRodDict(rodDictPath)
+        polyMeshDir = os.path.join(os.path.dirname(rodDictPath), 'constant', 'polyMesh')
+        output = caseOutputPath(rodDictPath)
+        key = cacheKey(rodDict, precision) if cache is not None and not direct else None
+        if direct:
+            build_rod(rodDict).writePolyMesh(polyMeshDir, precision, **(polyMeshFormat or {}))
+        else:
+            os.makedirs(os.path.dirname(output), exist_ok=True)
+            if key is not None and cache.fetch(key, output, polyMeshDir if polyMesh else None):
+                cached = True
             else:
-                clad_block["nVertices"]=10
+                build_rod(rodDict).write(output, precision, incremental=True)
+                if key is not None:
+                    cache.store(key, output)
+        error = None
+    except Exception:
+        error = traceback.format_exc(limit=-1).strip()
+    return rodDictPath, time.perf_counter() - start, error, cached
+
+def runBatch(rodDictPaths, workers=None, precision=None, cache=None, polyMesh=False, direct=False, polyMeshFormat=None, log=sys.stdout):
+    # Builds every case in a process pool; failures are reported, not raised.
+    # Returns the list of (path, seconds, error, cached) in completion order.
+    results = []
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(runCase, path, precision, cache, polyMesh, direct, polyMeshFormat) for path in rodDictPaths]
+        for future in as_completed(futures):
+            path, seconds, error, cached = future.result()
+            results.append((path, seconds, error, cached))
+            status = "FAILED" if error is not None else "cached" if cached else "ok"
+            log.write("[%d/%d] %-6s %8.3f s  %s\n" % (len(results), len(futures), status, seconds, path))
+            if error is not None:
+                log.write("        " + error.replace("\n", "\n        ") + "\n")
+            log.flush()
+
+    failed = [r for r in results if r[2] is not None]
+    log.write("%d cases, %d failed, %d from cache, %.3f s wall, %.3f s total build time\n"
+              % (len(results), len(failed), sum(r[3] for r in results), time.perf_counter() - start, sum(r[1] for r in results)))
+    return results
+
+def cachePolyMeshes(rodDictPaths, cache, precision=None, log=sys.stdout):
+    # Stores <case>/constant/polyMesh in the cache entry of each case (the
+    # entry of the blockMeshDict written with 'precision', as in runBatch)
+    for path in rodDictPaths:
+        key = cacheKey(readRodDict(path), precision)
+        polyMeshDir = os.path.join(os.path.dirname(path), 'constant', 'polyMesh')
+        stored = key is not None and os.path.isdir(polyMeshDir) and cache.storePolyMesh(key, polyMeshDir)
+        log.write("%-8s %s\n" % ("stored" if stored else "skipped", path))
 
-        cladding_blocks.append(clad_block)
+###################################################################################################################################################
+#########################------------------------------------------- PARAMETER SWEEPS -------------------------------------------#########################
+###################################################################################################################################################
 
+# A sweepDict names rodDict keys and their values (see the example 'sweepDict'):
+# the variants are expanded on a Cartesian grid or by Latin-hypercube sampling,
+# each one is written to its own case directory, and a manifest.json maps the
+# cases to their parameters. A key can address one block with 'key[i]'; a
+# scalar given for a per-block list key is applied to all the blocks.
+
+sweepBase = None
+
+def parameterLevels(spec):
+    # Explicit list of values, or {'range': [min, max], 'n': number of levels}
+    if isinstance(spec, dict):
+        if 'values' in spec:
+            return list(spec['values'])
+        lo, hi = spec['range']
+        levels = np.linspace(lo, hi, spec['n'])
+        if isinstance(lo, int) and isinstance(hi, int):
+            return sorted(set(int(round(x)) for x in levels))
+        return levels.tolist()
+    return list(spec)
+
+def expandCartesian(parameters):
+    keys = list(parameters)
+    levels = [parameterLevels(parameters[key]) for key in keys]
+    return [dict(zip(keys, values)) for values in itertools.product(*levels)]
+
+def expandLatinHypercube(parameters, nSamples, seed=None):
+    # one sample in each of the nSamples equal-probability strata of every
+    # parameter, the strata being paired at random between parameters
+    rng = np.random.default_rng(seed)
+    columns = {}
+    for key, spec in parameters.items():
+        u = (rng.permutation(nSamples) + rng.random(nSamples))/nSamples
+        if isinstance(spec, dict) and 'range' in spec:
+            lo, hi = spec['range']
+            if isinstance(lo, int) and isinstance(hi, int):
+                columns[key] = np.floor(lo + u*(hi - lo + 1)).astype(int).tolist()
+            else:
+                columns[key] = (lo + u*(hi - lo)).tolist()
+        else:
+            levels = parameterLevels(spec)
+            columns[key] = [levels[k] for k in (u*len(levels)).astype(int)]
+    return [{key: columns[key][n] for key in columns} for n in range(nSamples)]
+
+def applyParameters(rodDict, parameters):
+    # Returns a copy of rodDict with the swept entries replaced
+    variant = copy.deepcopy(rodDict)
+    for key, value in parameters.items():
+        match = re.fullmatch(r"(\w+)(?:\[(\d+)\])?", key)
+        if match is None or match.group(1) not in variant:
+            raise KeyError("'%s' is not a key of the base rodDict" % key)
+        name, index = match.group(1), match.group(2)
+        if index is not None:
+            variant[name][int(index)] = value
+        elif isinstance(variant[name], list) and not isinstance(value, list):
+            variant[name] = [value]*len(variant[name])
+        else:
+            variant[name] = value
+    return variant
+
+def initSweepWorker(base):
+    # the base rodDict is parsed once and sent once to each worker
+    global sweepBase
+    sweepBase = base
+
+def runSweepCase(caseDir, parameters, precision=None):
+    # Worker of the sweep: writes <caseDir>/rodDict and <caseDir>/system/blockMeshDict,
+    # never raises and returns (seconds, sha1 of the mesh, error)
+    start = time.perf_counter()
+    random.seed()
+    try:
+        variant = applyParameters(sweepBase, parameters)
+        mesh = build_rod(variant)
+        text = io.StringIO()
+        mesh.write(text, precision)
+        text = text.getvalue()
+
+        os.makedirs(os.path.join(caseDir, 'system'), exist_ok=True)
+        with BufferedSink(os.path.join(caseDir, 'rodDict')) as sink:
+            sink.write("# rodDict generated by the rodMaker sweep, parameters: %r\n" % (parameters,))
+            sink.write(pprint.pformat(variant, sort_dicts=False) + "\n")
+        with BufferedSink(os.path.join(caseDir, 'system', 'blockMeshDict')) as sink:
+            sink.write(text)
+        digest, error = hashlib.sha1(text.encode()).hexdigest(), None
+    except Exception:
+        digest, error = None, traceback.format_exc(limit=-1).strip()
+    return time.perf_counter() - start, digest, error
+
+def runSweep(sweepDict, sweepDir='.', outputDir=None, workers=None, log=sys.stdout):
+    """
+    Expands the sweepDict into case directories and writes their manifest.
+    Variants with the same parameters, or whose blockMeshDict is
+    byte-identical to an earlier case, are not kept as separate cases: the
+    manifest points them to the case holding their mesh ('duplicateOf').
+    Relative paths of the sweepDict are taken from sweepDir.
+    """
+    baseRodDict = os.path.join(sweepDir, sweepDict.get('baseRodDict', 'rodDict'))
+    outputDir = outputDir or os.path.join(sweepDir, sweepDict.get('outputDir', 'sweep'))
+    precision = sweepDict.get('writePrecision', None)
+    parameters = sweepDict['parameters']
+
+    mode = sweepDict.get('mode', 'cartesian')
+    if mode == 'cartesian':
+        variants = expandCartesian(parameters)
+    elif mode == 'latinHypercube':
+        variants = expandLatinHypercube(parameters, sweepDict['nSamples'], sweepDict.get('seed', None))
+    else:
+        raise ValueError("unknown sweep mode '%s' (cartesian/latinHypercube)" % mode)
+
+    base = readRodDict(baseRodDict)
+    width = len(str(max(len(variants) - 1, 0)))
+    cases = []
+    firstCase = {}
+    for n, variant in enumerate(variants):
+        case = {"case": "case_%0*d" % (width, n), "parameters": variant, "duplicateOf": None}
+        first = firstCase.setdefault(repr(sorted(applyParameters(base, variant).items())), case["case"])
+        if first != case["case"]:
+            case["duplicateOf"] = first
+        cases.append(case)
+
+    todo = [case for case in cases if case["duplicateOf"] is None]
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers, initializer=initSweepWorker, initargs=(base,)) as pool:
+        futures = {pool.submit(runSweepCase, os.path.join(outputDir, case["case"]), case["parameters"], precision): case
+                   for case in todo}
+        for done, future in enumerate(as_completed(futures), 1):
+            case = futures[future]
+            case["seconds"], case["sha1"], case["error"] = future.result()
+            status = "ok" if case["error"] is None else "FAILED"
+            log.write("[%d/%d] %-6s %8.3f s  %s %r\n" % (done, len(todo), status, case["seconds"], case["case"], case["parameters"]))
+            log.flush()
+
+    # byte-identical meshes: keep the first case only
+    firstMesh = {}
+    for case in todo:
+        if case["sha1"] is not None:
+            first = firstMesh.setdefault(case["sha1"], case["case"])
+            if first != case["case"]:
+                case["duplicateOf"] = first
+                shutil.rmtree(os.path.join(outputDir, case["case"]))
+    byName = {case["case"]: case for case in todo}
+    for case in cases:
+        if case["duplicateOf"] in byName:
+            case["duplicateOf"] = byName[case["duplicateOf"]]["duplicateOf"] or case["duplicateOf"]
+
+    manifest = {
+        "baseRodDict":  baseRodDict,
+        "mode":         mode,
+        "seed":         sweepDict.get('seed', None),
+        "parameters":   parameters,
+        "cases":        cases,
+    }
+    os.makedirs(outputDir, exist_ok=True)
+    with BufferedSink(os.path.join(outputDir, 'manifest.json')) as sink:
+        json.dump(manifest, sink, indent=2)
+        sink.write("\n")
 
-global_clad_offset=offsetClad
-global_fuel_offset=offsetFuel
+    failed = [case for case in todo if case["error"] is not None]
+    log.write("%d variants, %d unique meshes, %d failed, %.3f s wall -> %s\n"
+              % (len(cases), len(set(firstMesh)), len(failed), time.perf_counter() - start, outputDir))
+    return manifest
 
-list_spheres=[]
-list_vertices=[]
-list_blocks=[]
-list_projection_faces=[]
-list_edges=[]
+###################################################################################################################################################
+#########################---------------------------------------- ECCENTRICITY ENSEMBLES ----------------------------------------#########################
+###################################################################################################################################################
 
-patchDict = {}
-mergePatchDict = defaultdict(list)
+# An ensemble is a set of realizations of the random pellet eccentricity of
+# one rod. Only the pellet vertices, arc midpoints and sphere centres depend
+# on the shifts: the rod is built once with centred pellets, the shifts of
+# all the pellets of all the realizations are drawn at once from a seeded
+# generator, and each realization translates the rows of every pellet. Each
+# realization is written to '<outputDir>/realization_<n>' with a rodDict
+# giving its shifts as a manual eccentricity_vector.
+
+ECCENTRICITY_DISTRIBUTIONS = ('square', 'disk', 'normal')
+
+def drawEccentricities(rng, nRealizations, nPellets, minGap, distribution='disk'):
+    """
+    Shifts (nRealizations, nPellets, 2) of the pellets. 'square' draws each
+    coordinate uniformly in [-minGap, minGap] (as the 'default' eccentricity
+    mode), 'disk' is uniform in the disk of radius minGap and 'normal' is a
+    normal distribution of standard deviation minGap/3 per coordinate,
+    truncated to that disk.
+    """
+    size = (nRealizations, nPellets)
+    if distribution == 'square':
+        return rng.uniform(-minGap, minGap, size + (2,))
+    if distribution == 'disk':
+        radius = minGap*np.sqrt(rng.random(size))
+        angle = 2*math.pi*rng.random(size)
+        return np.stack((radius*np.cos(angle), radius*np.sin(angle)), axis=-1)
+    if distribution == 'normal':
+        shifts = rng.normal(0.0, minGap/3, size + (2,))
+        outside = np.hypot(shifts[..., 0], shifts[..., 1]) > minGap
+        while outside.any():
+            shifts[outside] = rng.normal(0.0, minGap/3, (outside.sum(), 2))
+            outside = np.hypot(shifts[..., 0], shifts[..., 1]) > minGap
+        return shifts
+    raise ValueError("unknown distribution '%s' (%s)" % (distribution, "/".join(ECCENTRICITY_DISTRIBUTIONS)))
+
+def pelletOwners(mesh):
+    # pellet of every vertex, arc edge and sphere row (-1 for the cladding)
+    owners = [np.full(len(mesh.vertices), -1), np.full(len(mesh.edges), -1), np.full(len(mesh.spheres), -1)]
+    for firstPellet, nPellets, start, end in mesh.pelletRows:
+        for owner, first, last in zip(owners, start, end):
+            owner[first:last] = firstPellet + np.repeat(np.arange(nPellets), (last - first)//nPellets)
+    return owners
+
+def shiftedRows(rows, owner, shifts):
+    # copy of the rows with the x and y of the rows of each pellet translated
+    shifted = GrowableArray(rows.shape[1], capacity=max(len(rows), 1))
+    shifted.extend(rows)
+    moved = owner >= 0
+    shifted.view[moved, :2] += shifts[owner[moved]]
+    return shifted
+
+def realizationMesh(mesh, owners, shifts):
+    # the mesh with the pellets shifted, sharing the blocks, patches and
+    # projections of 'mesh'
+    realization = copy.copy(mesh)
+    realization.vertices = shiftedRows(mesh.vertices.view, owners[0], shifts)
+    realization.edges = EdgeStore()
+    realization.edges.ends = mesh.edges.ends
+    realization.edges.midpoints = shiftedRows(mesh.edges.midpoints.view, owners[1], shifts)
+    realization.spheres = shiftedRows(mesh.spheres.view, owners[2], shifts)
+    return realization
+
+def runEnsemble(rodDict, outputDir, nRealizations, seed=None, distribution='disk', precision=None,
+                direct=False, polyMeshFormat=None, log=sys.stdout):
+    """
+    Writes nRealizations eccentricity realizations of the 3D rod of rodDict,
+    with shifts bounded by the minimum fuel-cladding gap, and their
+    manifest. Without a seed, a fresh one is drawn and recorded in the
+    manifest.
+    """
+    if rodDict['geometryType'] != '3D':
+        raise ValueError("eccentricity ensembles need a 3D geometry")
+    for key in ('conformalStacking', 'symmetry', 'unitCell'):
+        if rodDict.get(key):
+            raise ValueError("eccentricity ensembles cannot be combined with '%s'" % key)
+    if seed is None:
+        seed = int(np.random.SeedSequence().entropy % (1 << 63))
+
+    setup = setupRod(dict(rodDict, eccentricity=True, eccentricity_mode='default'))
+    minGap = setup["minGap"]
+    smeared = np.repeat([pellet.get('smeared', False) for pellet in setup["fuel_blocks"]], setup["nPelletsFuel"])
+    shifts = drawEccentricities(np.random.default_rng(seed), nRealizations, len(smeared), minGap, distribution)
+    shifts[:, smeared] = 0.0
+
+    start = time.perf_counter()
+    centred = dict(rodDict, eccentricity=False)
+    mesh = build_rod(centred)
+    owners = pelletOwners(mesh)
+
+    # the rodDict of a realization gives the shifts of the pellets before any
+    # smearing (see hybridFuelBlocks)
+    source = setup.get("pelletSource", range(len(smeared)))
+    nOriginal = sum(rodDict['nPelletsFuel'])
+    width = len(str(max(nRealizations - 1, 0)))
+    cases = []
+    for n in range(nRealizations):
+        caseDir = os.path.join(outputDir, "realization_%0*d" % (width, n))
+        realization = realizationMesh(mesh, owners, shifts[n])
+        if direct:
+            realization.writePolyMesh(os.path.join(caseDir, 'constant', 'polyMesh'), precision, **(polyMeshFormat or {}))
+        else:
+            os.makedirs(os.path.join(caseDir, 'system'), exist_ok=True)
+            realization.write(os.path.join(caseDir, 'system', 'blockMeshDict'), precision)
+
+        vector = np.zeros((nOriginal, 2))
+        for j, original in enumerate(source):
+            if original is not None:
+                vector[original] = shifts[n, j]
+        variant = dict(rodDict, eccentricity=True, eccentricity_mode='manual', eccentricity_vector=vector.tolist())
+        with BufferedSink(os.path.join(caseDir, 'rodDict')) as sink:
+            sink.write("# rodDict generated by the rodMaker ensemble, realization %d (seed %d, %s)\n" % (n, seed, distribution))
+            sink.write(pprint.pformat(variant, sort_dicts=False) + "\n")
+        cases.append({"case": os.path.basename(caseDir), "maxShift": float(np.hypot(*shifts[n].T).max(initial=0.0))})
+
+    manifest = {
+        "seed":             seed,
+        "distribution":     distribution,
+        "minGap":           minGap,
+        "nRealizations":    nRealizations,
+        "cases":            cases,
+    }
+    os.makedirs(outputDir, exist_ok=True)
+    with BufferedSink(os.path.join(outputDir, 'manifest.json')) as sink:
+        json.dump(manifest, sink, indent=2)
+        sink.write("\n")
+    log.write("%d realizations (seed %d, %s), %.3f s -> %s\n" % (nRealizations, seed, distribution, time.perf_counter() - start, outputDir))
+    return manifest
 
-i_global=1
-i_vertex=0
-i_sphere=2
+###################################################################################################################################################
+#########################---------------------------------------------- ASSEMBLIES ----------------------------------------------#########################
+###################################################################################################################################################
 
+# An assemblyDict places rods on a square lattice (see the example
+# 'assemblyDict'): every position of the layout holds a rod type, or nothing.
+# The rod of a position is the base rodDict with the overrides of its type
+# and of the position (same syntax as the sweep parameters). Each distinct
+# rod is built once, in parallel workers; the built rods are then translated
+# to their position and stitched into a single mesh, with their vertex,
+# sphere and block indices offset and their patches prefixed with
+# 'rod_<row>_<column>_'. The cellZones keep their names.
+
+assemblyBase = None
+
+def initAssemblyWorker(base):
+    # the base rodDict is parsed once and sent once to each worker
+    global assemblyBase
+    assemblyBase = base
+
+def buildAssemblyRod(parameters):
+    return build_rod(applyParameters(assemblyBase, parameters))
+
+def assemblyPositions(assemblyDict):
+    # [(row, column, rod type, overrides)] of the occupied positions, rows
+    # counted from the top of the layout
+    rodTypes = assemblyDict.get('rods', {})
+    positionOverrides = assemblyDict.get('positions', {})
+    positions = []
+    for row, line in enumerate(assemblyDict['layout']):
+        for column, rodType in enumerate(line.replace(' ', '')):
+            if rodType == '.':
+                continue
+            if rodType not in rodTypes:
+                raise ValueError("rod type '%s' at (%d, %d) is not in 'rods'" % (rodType, row, column))
+            overrides = dict(rodTypes[rodType])
+            overrides.update(positionOverrides.get((row, column), {}))
+            positions.append((row, column, rodType, overrides))
+    return positions
+
+def prefixPatches(patchDict, prefix):
+    # the patches of one rod with their names (and neighbours) prefixed
+    prefixed = {}
+    for name, patch in patchDict.items():
+        entry = dict(patch)
+        if entry.get('neighbour', 'none') != 'none':
+            entry['neighbour'] = prefix + entry['neighbour']
+        prefixed[prefix + name] = entry
+    return prefixed
+
+def stitchRods(rods):
+    """
+    Stitches the rods [(patch prefix, RodMesh, (x, y))] into one RodMesh,
+    each rod translated by (x, y).
+    """
+    first = rods[0][1]
+    if any((rod.convertToMeters, rod.geometry, rod.analyticDish) != (first.convertToMeters, first.geometry, first.analyticDish)
+           for prefix, rod, centre in rods):
+        raise ValueError("the rods of an assembly need the same convertToMeters, geometry and analyticDish")
+    assembly = RodMesh(first.convertToMeters, first.geometry, first.writePrecision, first.analyticDish)
+    assembly.vertices.reserve(sum(len(rod.vertices) for prefix, rod, centre in rods))
+    assembly.blocks.hexes.reserve(sum(len(rod.blocks) for prefix, rod, centre in rods))
+
+    for prefix, rod, (x, y) in rods:
+        vertexOffset = len(assembly.vertices)
+        sphereOffset = len(assembly.spheres)
+        assembly.vertices.extend(rod.vertices.view + (x, y, 0.0))
+        assembly.spheres.extend(rod.spheres.view + (x, y, 0.0, 0.0))
+
+        zones = np.array([assembly.blocks.zoneId(name) for name in rod.blocks.zoneNames], dtype=np.int32)
+        assembly.blocks.extend(rod.blocks.hexes.view + vertexOffset, rod.blocks.cells.view, zones[rod.blocks.zones])
+        assembly.edges.ends.extend(rod.edges.ends.view + vertexOffset)
+        assembly.edges.midpoints.extend(rod.edges.midpoints.view + (x, y, 0.0))
+        assembly.projections.extend(rod.projections.faces.view + vertexOffset, rod.projections.spheres + sphereOffset)
+
+        for name, patch in prefixPatches(rod.patchDict, prefix).items():
+            patch['faces'] = (np.array(patch['faces'], dtype=np.int64).reshape(-1, 4) + vertexOffset).tolist()
+            assembly.patchDict[name] = patch
+        for master, slave in rod.mergePatchDict.items():
+            assembly.mergePatchDict[prefix + master] = prefix + slave
+        for group, interfaces in rod.patchGroups.items():
+            assembly.patchGroups[prefix + group] = interfaces
+    return assembly
+
+def runAssembly(assemblyDict, assemblyDir='.', outputDir=None, workers=None, direct=False, polyMeshFormat=None, log=sys.stdout):
+    """
+    Builds the assembly of the assemblyDict into <outputDir>/system/blockMeshDict
+    (or <outputDir>/constant/polyMesh with direct=True) and writes a
+    manifest.json mapping the positions to their patch prefix, centre and
+    overrides. Relative paths of the assemblyDict are taken from assemblyDir.
+    """
+    baseRodDict = os.path.join(assemblyDir, assemblyDict.get('baseRodDict', 'rodDict'))
+    outputDir = outputDir or os.path.join(assemblyDir, assemblyDict.get('outputDir', 'assembly'))
+    precision = assemblyDict.get('writePrecision', None)
+    pitch = assemblyDict['pitch']
+    base = readRodDict(baseRodDict)
+
+    positions = assemblyPositions(assemblyDict)
+    if not positions:
+        raise ValueError("the assembly layout has no rod")
+    nRows = len(assemblyDict['layout'])
+    nColumns = max(len(line.replace(' ', '')) for line in assemblyDict['layout'])
+    width = len(str(max(nRows, nColumns) - 1))
+
+    # one build per distinct rod, unless its random eccentricity is not seeded
+    variants = {}
+    keys = []
+    for row, column, rodType, overrides in positions:
+        variant = applyParameters(base, overrides)
+        setup = setupRod(variant)
+        if setup["geometry"] != '3D':
+            raise ValueError("assemblies need a 3D geometry")
+        if 2*max(block["rOuter"] for block in setup["cladding_blocks"]) >= pitch:
+            raise ValueError("the rod at (%d, %d) does not fit in the pitch %g" % (row, column, pitch))
+        key = repr(sorted(overrides.items()))
+        if cacheKey(variant) is None:
+            key += repr((row, column))
+        variants.setdefault(key, overrides)
+        keys.append(key)
+
+    start = time.perf_counter()
+    built = {}
+    with ProcessPoolExecutor(max_workers=workers, initializer=initAssemblyWorker, initargs=(base,)) as pool:
+        futures = {pool.submit(buildAssemblyRod, overrides): key for key, overrides in variants.items()}
+        for done, future in enumerate(as_completed(futures), 1):
+            built[futures[future]] = future.result()
+            log.write("[%d/%d] rod built\n" % (done, len(futures)))
+            log.flush()
+
+    rods = []
+    manifest = {"baseRodDict": baseRodDict, "pitch": pitch, "rods": []}
+    for (row, column, rodType, overrides), key in zip(positions, keys):
+        prefix = "rod_%0*d_%0*d_" % (width, row, width, column)
+        centre = ((column - 0.5*(nColumns - 1))*pitch, (0.5*(nRows - 1) - row)*pitch)
+        rods.append((prefix, built[key], centre))
+        manifest["rods"].append({"position": [row, column], "type": rodType, "prefix": prefix,
+                                 "centre": list(centre), "overrides": overrides})
+    assembly = stitchRods(rods)
+
+    if direct:
+        assembly.writePolyMesh(os.path.join(outputDir, 'constant', 'polyMesh'), precision, **(polyMeshFormat or {}))
+    else:
+        os.makedirs(os.path.join(outputDir, 'system'), exist_ok=True)
+        assembly.write(os.path.join(outputDir, 'system', 'blockMeshDict'), precision)
+    with BufferedSink(os.path.join(outputDir, 'manifest.json')) as sink:
+        json.dump(manifest, sink, indent=2, default=repr)
+        sink.write("\n")
+    log.write("%d rods (%d distinct), %d blocks, %.3f s -> %s\n"
+              % (len(rods), len(variants), len(assembly.blocks), time.perf_counter() - start, outputDir))
+    return manifest
 
-if geometry=="1D" or geometry=="2D-smeared":
-        
-        for i in range(nBlocksFuel):
-            addWedgeVertices(list_vertices, fuel_blocks[i], wedgeAngle, global_fuel_offset, 0)
-            addWedgeBlocks(list_blocks, fuel_blocks[i], i_vertex, 0)
-            addWedgePatches(patchDict, mergePatchDict, fuel_blocks[i], nBlocksFuel, bottomCap, topCap, i_vertex, i_global, geometry, 0)  
-            global_fuel_offset+=fuel_blocks[i]['height']
-            i_vertex+=fuel_blocks[i]['nVertices']
-            i_global+=1
+###################################################################################################################################################
+#########################----------------------------------------- AXIAL DECOMPOSITION -----------------------------------------#########################
+###################################################################################################################################################
 
-        i_global=1
+# blockMesh is serial: a long rod can instead be cut at pellet interfaces into
+# axial segments, each with its own blockMeshDict (local vertex and sphere
+# numbering), meshed concurrently and joined with mergeMeshes. The cuts are
+# balanced by cell count and moved onto a cladding block boundary when one
+# coincides with a pellet interface nearby. The blocks spanning a cut (the
+# cladding) are split there, their axial cells divided between the parts,
+# so every segment is an axial slab. The mergePatchPairs between two
+# segments become stitchMesh calls after the merge, and the internal faces
+# on a cut (split blocks, welded interfaces of a conformal stack) become the
+# patch pair segmentTop_i_j/segmentBottom_i_j between the segments i and j
+# (from 1), stitched back with -perfect.
+
+def pelletInterfaces(setup):
+    # z of the interfaces between consecutive pellets (fuel blocks for the
+    # smeared geometries) and of the tops of the cladding blocks
+    fuel_blocks = setup["fuel_blocks"]
+    heights = np.repeat([pellet['height'] for pellet in fuel_blocks], setup.get("nPelletsFuel", [1]*len(fuel_blocks)))
+    interfaces = (setup["offsetFuel"] + np.cumsum(heights))[:-1]
+    cladBoundaries = setup["offsetClad"] + np.cumsum([block['height'] for block in setup["cladding_blocks"]])
+    return interfaces, cladBoundaries
+
+def balancedCuts(z, weights, candidates, nParts, preferred=(), window=0.0):
+    # at most nParts - 1 cuts among the candidates splitting the weights of
+    # the items at z evenly; a preferred candidate within 'window' of the
+    # ideal cut is taken before the others
+    preferred = np.asarray(preferred, dtype=float)
+    if not len(candidates):
+        return np.zeros(0)
+    order = np.argsort(z, kind='stable')
+    cumulative = np.cumsum(weights[order])
+    cuts = []
+    for k in range(1, nParts):
+        ideal = z[order[np.searchsorted(cumulative, k*cumulative[-1]/nParts)]]
+        choice = preferred if len(preferred) and np.abs(preferred - ideal).min() <= window else candidates
+        cuts.append(choice[np.abs(choice - ideal).argmin()])
+    return np.unique(cuts)
+
+def cellLayers(mesh):
+    # The layers of cells of every block along its axial direction (the
+    # block axis, vertex 0 to 1, 3 or 4, with the largest change of z):
+    # axial direction and number of layers of each block, then z and number
+    # of cells of each layer, block after block from the first vertex on
+    hexes, cells = mesh.blocks.hexes.view, mesh.blocks.cells.view
+    corners = mesh.vertices.view[hexes, 2]
+    rise = corners[:, [1, 3, 4]] - corners[:, [0]]
+    axial = np.abs(rise).argmax(axis=1)
+    upward = rise[np.arange(len(hexes)), axial] >= 0
+    nLayers = cells[np.arange(len(hexes)), axial]
+    bottom, top = corners.min(axis=1), corners.max(axis=1)
+
+    layerBlock = np.repeat(np.arange(len(hexes)), nLayers)
+    layer = np.arange(len(layerBlock)) - np.repeat(np.cumsum(nLayers) - nLayers, nLayers)
+    layer = np.where(upward[layerBlock], layer, nLayers[layerBlock] - 1 - layer)
+    layerZ = bottom[layerBlock] + (layer + 0.5)*(top - bottom)[layerBlock]/nLayers[layerBlock]
+    layerCells = (np.prod(cells, axis=1)//nLayers)[layerBlock]
+    return axial, nLayers, layerZ, layerCells
+
+def axialCuts(mesh, setup, nSegments):
+    # z of the (at most nSegments - 1) cuts between the segments of the rod
+    vertices = mesh.vertices.view
+    bottom, top = vertices[:, 2].min(), vertices[:, 2].max()
+    tolerance = 1e-7*(top - bottom)
+
+    interfaces, cladBoundaries = pelletInterfaces(setup)
+    aligned = interfaces[np.abs(interfaces[:, None] - cladBoundaries[None, :]).min(axis=1, initial=np.inf) <= tolerance]
+    axial, nLayers, layerZ, layerCells = cellLayers(mesh)
+    return balancedCuts(layerZ, layerCells, interfaces, nSegments, aligned, 0.25*(top - bottom)/nSegments)
+
+# the edges of the bottom face of a block and the matching edges of its top
+BOTTOM_EDGES = ((0, 1), (1, 2), (2, 3), (3, 0))
+
+def splitAtCuts(mesh, cuts):
+    """
+    Returns a copy of mesh in which every block spanning one of the cuts
+    (z) is split there into blocks stacked along its third axis, the axial
+    cells being divided in proportion to the heights of the parts. The
+    vertices and arc edges of a cut level are shared by the neighbouring
+    blocks, and the patch faces on the sides of a split block are split
+    with it.
+    """
+    vertices = mesh.vertices.view
+    hexes, cells = mesh.blocks.hexes.view, mesh.blocks.cells.view
+    z = vertices[hexes, 2]
+    tolerance = 1e-7*np.ptp(vertices[:, 2])
+    low, high = z.min(axis=1), z.max(axis=1)
+    spanned = (cuts[None, :] > low[:, None] + tolerance) & (cuts[None, :] < high[:, None] - tolerance)
+    if not spanned.any():
+        return mesh
+
+    arcs = {tuple(sorted(ends)): midpoint for ends, midpoint in zip(mesh.edges.ends.view.tolist(), mesh.edges.midpoints.view)}
+    newVertices, newEdges, levelVertices, levelEdges = [], [], {}, set()
+    blocks, sideFaces = [], {}
+    for b, (hex, blockCells, zone) in enumerate(zip(hexes.tolist(), cells.tolist(), mesh.blocks.zones.tolist())):
+        if not spanned[b].any():
+            blocks.append((hex, blockCells, zone))
+            continue
+        z0, z1 = z[b, :4], z[b, 4:]
+        if np.ptp(z0) > tolerance or np.ptp(z1) > tolerance or z1[0] <= z0[0] or any(
+                tuple(sorted((hex[c], hex[c + 4]))) in arcs for c in range(4)):
+            raise ValueError("the block %d spans a cut but is not a straight axial block, it cannot be split" % b)
+        fractions = np.concatenate(([0.0], (cuts[spanned[b]] - z0[0])/(z1[0] - z0[0]), [1.0]))
+        nk = np.diff(np.round(fractions*blockCells[2]).astype(int))
+        if np.any(nk < 1):
+            raise ValueError("the block %d has too few axial cells (%d) to be split at the cuts, use fewer segments" % (b, blockCells[2]))
+
+        # the vertices of the bottom face of every part, then of the top
+        rings = [hex[:4]]
+        for level, f in zip(cuts[spanned[b]].tolist(), fractions[1:-1]):
+            ring = []
+            for c in range(4):
+                key = (hex[c], hex[c + 4], level)
+                if key not in levelVertices:
+                    levelVertices[key] = len(vertices) + len(newVertices)
+                    # (exactly at the cut, where the pellets of the next segment start)
+                    newVertices.append(np.append(vertices[hex[c], :2] + f*(vertices[hex[c + 4], :2] - vertices[hex[c], :2]), level))
+                ring.append(levelVertices[key])
+            rings.append(ring)
+            for a, e in BOTTOM_EDGES:
+                lower, upper = arcs.get(tuple(sorted((hex[a], hex[e])))), arcs.get(tuple(sorted((hex[a + 4], hex[e + 4]))))
+                if (lower is None) != (upper is None):
+                    raise ValueError("the block %d has an arc on only one of its ends, it cannot be split" % b)
+                ends = tuple(sorted((ring[a], ring[e])))
+                if lower is not None and ends not in levelEdges and ring[a] != ring[e]:
+                    levelEdges.add(ends)
+                    newEdges.append(([ring[a], ring[e]], lower + f*(upper - lower)))
+        rings.append(hex[4:])
+
+        parts = [rings[n] + rings[n + 1] for n in range(len(nk))]
+        for part, n in zip(parts, nk.tolist()):
+            blocks.append((part, [blockCells[0], blockCells[1], n], zone))
+        for axis, side, corners in BLOCK_FACES[:4]:
+            sideFaces[tuple(sorted(hex[c] for c in corners))] = [[part[c] for c in corners] for part in parts]
+
+    # a side face shared with a block that is not split would leave a
+    # non-conformal interface
+    for hex, blockCells, zone in blocks:
+        for axis, side, corners in BLOCK_FACES:
+            if tuple(sorted(hex[c] for c in corners)) in sideFaces:
+                raise ValueError("a block spanning a cut shares a face with a block that does not, they cannot be split")
+
+    split = copy.copy(mesh)
+    split.vertices = GrowableArray(3, capacity=len(vertices) + len(newVertices))
+    split.vertices.extend(vertices)
+    split.vertices.extend(np.array(newVertices).reshape(-1, 3))
+    split.blocks = BlockStore()
+    for name in mesh.blocks.zoneNames:
+        split.blocks.zoneId(name)
+    split.blocks.extend([hex for hex, blockCells, zone in blocks], [blockCells for hex, blockCells, zone in blocks],
+                        [zone for hex, blockCells, zone in blocks])
+    split.edges = EdgeStore()
+    split.edges.ends.extend(mesh.edges.ends.view)
+    split.edges.midpoints.extend(mesh.edges.midpoints.view)
+    for ends, midpoint in newEdges:
+        split.edges.append(ends, midpoint)
+    split.patchDict = {}
+    for name, patch in mesh.patchDict.items():
+        faces = []
+        for face in patch['faces']:
+            faces.extend(sideFaces.get(tuple(sorted(face)), [face]))
+        split.patchDict[name] = dict(patch, faces=faces)
+    return split
+
+def segmentMesh(mesh, keep):
+    """
+    Returns the RodMesh of the blocks 'keep' (boolean mask) of mesh, with its
+    vertices, spheres, arc edges, projections and patches renumbered, the
+    patches without faces of these blocks left out, and the mergePatchPairs whose two
+    patches it holds.
+    """
+    segment = RodMesh(mesh.convertToMeters, mesh.geometry, mesh.writePrecision, mesh.analyticDish)
+    hexes = mesh.blocks.hexes.view[keep]
+    used = np.zeros(len(mesh.vertices), dtype=bool)
+    used[hexes] = True
+    compact = np.cumsum(used) - 1
+    compact[~used] = -1
+
+    segment.vertices.extend(mesh.vertices.view[used])
+    for name in mesh.blocks.zoneNames:
+        segment.blocks.zoneId(name)
+    segment.blocks.extend(compact[hexes], mesh.blocks.cells.view[keep], mesh.blocks.zones[keep])
+
+    ends = compact[mesh.edges.ends.view]
+    kept = np.all(ends >= 0, axis=1)
+    segment.edges.ends.extend(ends[kept])
+    segment.edges.midpoints.extend(mesh.edges.midpoints.view[kept])
+
+    faces = compact[mesh.projections.faces.view]
+    kept = np.all(faces >= 0, axis=1)
+    sphereIds = mesh.projections.spheres[kept]
+    spheres, sphereIds = np.unique(sphereIds, return_inverse=True)
+    segment.spheres.extend(mesh.spheres.view[spheres])
+    segment.projections.extend(faces[kept], sphereIds)
+
+    # (a face shared with a block of another segment has all its vertices in
+    # both, so the patch faces are looked up among the faces of the blocks)
+    blockFaces = {tuple(sorted(face)) for face in np.concatenate([hexes[:, corners] for axis, side, corners in BLOCK_FACES]).tolist()}
+    for name, patch in mesh.patchDict.items():
+        faces = [face for face in patch['faces'] if tuple(sorted(face)) in blockFaces]
+        if faces:
+            segment.patchDict[name] = dict(patch, faces=compact[np.array(faces, dtype=int)].tolist())
+    for master, slave in mesh.mergePatchDict.items():
+        if master in segment.patchDict and slave in segment.patchDict:
+            segment.mergePatchDict[master] = slave
+    return segment
+
+def cutFaces(mesh, segments):
+    # [(lower segment, upper segment, faces)] of the internal block faces
+    # between two segments, in the orientation of the block of the lower one
+    hexes = mesh.blocks.hexes.view
+    faces = np.concatenate([hexes[:, corners] for axis, side, corners in BLOCK_FACES])
+    owners = np.tile(np.arange(len(hexes)), len(BLOCK_FACES))
+    keys = np.sort(faces, axis=1)
+    unique, inverse, counts = np.unique(keys, axis=0, return_inverse=True, return_counts=True)
+    inverse = inverse.reshape(-1)
+    shared = (counts[inverse] == 2) & np.array([len(set(key)) > 2 for key in keys.tolist()])
+
+    order = np.argsort(inverse[shared], kind='stable')
+    pairs = np.flatnonzero(shared)[order].reshape(-1, 2)
+    pairs = pairs[segments[owners[pairs[:, 0]]] != segments[owners[pairs[:, 1]]]]
+    # the lower block of each pair first
+    swap = segments[owners[pairs[:, 0]]] > segments[owners[pairs[:, 1]]]
+    pairs[swap] = pairs[swap, ::-1]
+
+    sides = np.column_stack((segments[owners[pairs[:, 0]]], segments[owners[pairs[:, 1]]]))
+    return [(lower, upper, faces[pairs[np.all(sides == (lower, upper), axis=1), 0]])
+            for lower, upper in np.unique(sides, axis=0).tolist()]
+
+def iterSegmentsScript(segmentDirs, stitches):
+    # bash driver meshing the segments concurrently and joining them into
+    # constant/polyMesh of the case
+    yield "#!/bin/bash\n"
+    yield "# Generated by rodMaker: meshes the axial segments concurrently, then merges\n"
+    yield "# them into the first one and stitches the patch pairs across the cuts.\n"
+    yield 'cd "${0%/*}" || exit 1\n\n'
+    yield "segments=(%s)\n\n" % " ".join(segmentDirs)
+    yield "pids=()\n"
+    yield 'for segment in "${segments[@]}"; do\n'
+    yield '    mkdir -p "$segment/system" && cp system/controlDict "$segment/system/" || exit 1\n'
+    yield '    blockMesh -case "$segment" > "$segment/log.blockMesh" 2>&1 &\n'
+    yield '    pids+=($!)\n'
+    yield "done\n"
+    yield 'for pid in "${pids[@]}"; do\n'
+    yield '    wait "$pid" || { echo "blockMesh failed, see the log.blockMesh of the segments"; exit 1; }\n'
+    yield "done\n\n"
+    yield 'for segment in "${segments[@]:1}"; do\n'
+    yield '    mergeMeshes -overwrite "${segments[0]}" "$segment" > "$segment/log.mergeMeshes" 2>&1 || exit 1\n'
+    yield "done\n"
+    for master, slave, perfect in stitches:
+        yield 'stitchMesh -case "${segments[0]}" -overwrite%s %s %s >> "${segments[0]}/log.stitchMesh" 2>&1 || exit 1\n' % (
+            " -perfect" if perfect else "", master, slave)
+    yield "\nrm -rf constant/polyMesh\n"
+    yield 'mkdir -p constant && cp -r "${segments[0]}/constant/polyMesh" constant/polyMesh\n'
+
+def runSegments(rodDict, nSegments, outputDir='segments', script='Allrun.segments', precision=None, log=sys.stdout):
+    """
+    Builds the rod of rodDict, cuts it into at most nSegments axial segments
+    written to <outputDir>/segment_<k>/system/blockMeshDict, and writes the
+    driver 'script' joining them (see AXIAL DECOMPOSITION) and a
+    manifest.json. Returns the manifest.
+    """
+    if rodDict['geometryType'] not in ('3D', '2D-discrete'):
+        raise ValueError("axial segments need the pellets of a 3D or 2D-discrete geometry")
+    for key in ('unitCell', 'groupInterfacePatches'):
+        if rodDict.get(key):
+            raise ValueError("axial segments cannot be combined with '%s'" % key)
+    if nSegments < 1:
+        raise ValueError("the number of segments must be positive")
+
+    start = time.perf_counter()
+    mesh = build_rod(rodDict)
+    cuts = axialCuts(mesh, setupRod(rodDict), nSegments)
+    mesh = splitAtCuts(mesh, cuts)
+    centres = mesh.vertices.view[mesh.blocks.hexes.view, 2].mean(axis=1)
+    segments = np.searchsorted(cuts, centres)
+    nSegments = len(cuts) + 1
+
+    cut = copy.copy(mesh)
+    cut.patchDict = dict(mesh.patchDict)
+    cutPairs = []
+    for lower, upper, faces in cutFaces(mesh, segments):
+        top, bottom = "segmentTop_%d_%d" % (lower + 1, upper + 1), "segmentBottom_%d_%d" % (lower + 1, upper + 1)
+        addToPatchDict(cut.patchDict, top, "patch", "none", "false", [])
+        addToPatchDict(cut.patchDict, bottom, "patch", "none", "false", [])
+        cut.patchDict[top]["faces"].extend(faces.tolist())
+        cut.patchDict[bottom]["faces"].extend(faces[:, ::-1].tolist())
+        cutPairs.append((top, bottom, True))
+    parts = [segmentMesh(cut, segments == k) for k in range(nSegments)]
+
+    stitches = [(master, slave, False) for master, slave in mesh.mergePatchDict.items()
+                if not any(master in part.mergePatchDict for part in parts)]
+    stitches += cutPairs
+
+    width = len(str(nSegments - 1))
+    segmentDirs = []
+    manifest = {"nSegments": nSegments, "cuts": cuts.tolist(), "segments": [], "stitches": stitches}
+    for k, part in enumerate(parts):
+        segmentDir = os.path.join(outputDir, "segment_%0*d" % (width, k))
+        os.makedirs(os.path.join(segmentDir, 'system'), exist_ok=True)
+        part.write(os.path.join(segmentDir, 'system', 'blockMeshDict'), precision)
+        segmentDirs.append(segmentDir)
+        manifest["segments"].append({"case": segmentDir, "blocks": len(part.blocks),
+                                     "cells": int(np.prod(part.blocks.cells.view, axis=1).sum())})
+
+    scriptDir = os.path.dirname(os.path.abspath(script))
+    with BufferedSink(script) as sink:
+        sink.writelines(iterSegmentsScript([os.path.relpath(os.path.abspath(d), scriptDir) for d in segmentDirs], stitches))
+    os.chmod(script, 0o755)
+    with BufferedSink(os.path.join(outputDir, 'manifest.json')) as sink:
+        json.dump(manifest, sink, indent=2)
+        sink.write("\n")
+    log.write("%d segments (%s cells), %.3f s -> %s\n" % (nSegments, "/".join(str(entry["cells"]) for entry in manifest["segments"]),
+                                                         time.perf_counter() - start, script))
+    return manifest
 
-        for i in range(nBlocksClad):
-            addWedgeVertices(list_vertices, cladding_blocks[i], wedgeAngle, global_clad_offset, 1)
-            addWedgeBlocks(list_blocks, cladding_blocks[i], i_vertex, 1)
-            addWedgePatches(patchDict, mergePatchDict, cladding_blocks[i], nBlocksClad, bottomCap, topCap, i_vertex, i_global, geometry, 1)
-            global_clad_offset+=cladding_blocks[i]['height']
-            i_vertex+=cladding_blocks[i]['nVertices']
-            i_global+=1
-            
+###################################################################################################################################################
+#########################---------------------------------------- PRE-DECOMPOSED OUTPUT ----------------------------------------#########################
+###################################################################################################################################################
+
+# For parallel runs the direct polyMesh can be written already decomposed,
+# as decomposePar would: the cells are split into axial slabs cut at pellet
+# interfaces (balanced by cell count), every cell going to the slab holding
+# its centre, so the fuel and cladding cells at the same height share a rank.
+# Each processor keeps the cells of its slab in their global order, the
+# internal faces between them, its faces of every patch (all patches are
+# listed, possibly empty) and one procBoundary<p>to<q> patch per neighbour,
+# whose faces are listed in global face order on both sides and reversed on
+# the side of the global neighbour cell. The processors are written in
+# parallel, each with its cellProcAddressing, faceProcAddressing (global
+# face + 1, negative for reversed faces), pointProcAddressing and
+# boundaryProcAddressing.
+
+def cellHeights(polyMesh):
+    # z of the centre of every cell (mean of the centres of its faces)
+    valid = polyMesh.faces >= 0
+    z = np.where(valid, polyMesh.points[np.where(valid, polyMesh.faces, 0), 2], 0.0).sum(axis=1)/valid.sum(axis=1)
+    nInternal = len(polyMesh.neighbour)
+    cells = np.concatenate((polyMesh.owner, polyMesh.neighbour))
+    faceZ = np.concatenate((z, z[:nInternal]))
+    return np.bincount(cells, faceZ, polyMesh.nCells)/np.bincount(cells, minlength=polyMesh.nCells)
+
+def axialPartition(polyMesh, setup, nProcs):
+    # rank of every cell: nProcs axial slabs cut at pellet interfaces
+    z = cellHeights(polyMesh)
+    interfaces, cladBoundaries = pelletInterfaces(setup)
+    cuts = balancedCuts(z, np.ones(len(z)), interfaces*setup["convertToMeters"], nProcs)
+    rank = np.searchsorted(cuts, z)
+    counts = np.bincount(rank, minlength=nProcs)
+    if np.any(counts == 0):
+        raise ValueError("the rod has too few pellets for %d processors" % nProcs)
+    return rank
+
+def reverseFaces(faces):
+    # the faces (rows padded with -1) reversed as OpenFOAM's face::reverseFace,
+    # keeping their first point
+    sizes = (faces >= 0).sum(axis=1)[:, None]
+    columns = np.arange(faces.shape[1])[None, :]
+    reversed = np.take_along_axis(faces, (sizes - columns) % sizes, axis=1)
+    return np.where(columns < sizes, reversed, -1)
+
+def processorMesh(polyMesh, rank, p):
+    """
+    Returns the PolyMesh of processor p of the partition 'rank' (one rank per
+    cell) and its addressing {name: labels}.
+    """
+    nInternal = len(polyMesh.neighbour)
+    cells = np.flatnonzero(rank == p)
+    local = np.full(len(rank), -1)
+    local[cells] = np.arange(len(cells))
+    ownerRank = rank[polyMesh.owner]
+    neighbourRank = rank[polyMesh.neighbour]
+
+    # internal faces, then the faces of the patches, then the processor faces
+    internal = np.flatnonzero((ownerRank[:nInternal] == p) & (neighbourRank == p))
+    selected, flipped = [internal], [np.zeros(len(internal), dtype=bool)]
+    patches = []
+    start = len(internal)
+    for name, info, patchStart, nFaces in polyMesh.patches:
+        faces = patchStart + np.flatnonzero(ownerRank[patchStart:patchStart + nFaces] == p)
+        selected.append(faces)
+        flipped.append(np.zeros(len(faces), dtype=bool))
+        patches.append((name, info, start, len(faces)))
+        start += len(faces)
+    onOwner = (ownerRank[:nInternal] == p) & (neighbourRank != p)
+    onNeighbour = (neighbourRank == p) & (ownerRank[:nInternal] != p)
+    other = np.where(onOwner, neighbourRank, ownerRank[:nInternal])
+    for q in np.unique(other[onOwner | onNeighbour]).tolist():
+        faces = np.flatnonzero((onOwner | onNeighbour) & (other == q))
+        selected.append(faces)
+        flipped.append(onNeighbour[faces])
+        patches.append(("procBoundary%dto%d" % (p, q), {'type': 'processor', 'myProcNo': p, 'neighbProcNo': q}, start, len(faces)))
+        start += len(faces)
+    selected, flipped = np.concatenate(selected), np.concatenate(flipped)
+
+    faces = polyMesh.faces[selected]
+    faces[flipped] = reverseFaces(faces[flipped])
+    owner = local[polyMesh.owner[selected]]
+    owner[flipped] = local[polyMesh.neighbour[selected[flipped]]]
+    neighbour = local[polyMesh.neighbour[internal]]
+
+    valid = faces >= 0
+    points = np.unique(faces[valid])
+    renumber = np.full(len(polyMesh.points), -1)
+    renumber[points] = np.arange(len(points))
+    faces[valid] = renumber[faces[valid]]
+
+    cellZones = [(name, local[zoneCells[rank[zoneCells] == p]]) for name, zoneCells in polyMesh.cellZones]
+    addressing = {
+        "pointProcAddressing":      points,
+        "faceProcAddressing":       np.where(flipped, -(selected + 1), selected + 1),
+        "cellProcAddressing":       cells,
+        "boundaryProcAddressing":   np.concatenate((np.arange(len(polyMesh.patches)), np.full(len(patches) - len(polyMesh.patches), -1))),
+    }
+    return PolyMesh(polyMesh.points[points], faces, owner, neighbour, patches, cellZones, len(cells)), addressing
+
+def writeAddressing(addressing, directory, binary=False, labelSize=32, scalarSize=64):
+    # the labelList files of 'addressing' {name: labels} in 'directory'
+    arch = "LSB;label=%d;scalar=%d" % (labelSize, scalarSize) if binary else None
+    for objectName, labels in addressing.items():
+        with BufferedSink(os.path.join(directory, objectName), binary=binary) as sink:
+            sink.writelines(iterFoamHeader("labelList", objectName, None, arch))
+            if binary:
+                sink.writelines(iterBinaryList(labels, "<i%d" % (labelSize//8)))
+            else:
+                sink.writelines(iterList("%d\n", np.asarray(labels)[:, None]))
+            sink.write("\n// ************************************************************************* //\n")
+
+decomposedMesh = None
+
+def initProcessorWorker(polyMesh, rank):
+    # the global mesh and its partition are sent once to each worker
+    global decomposedMesh
+    decomposedMesh = (polyMesh, rank)
+
+def writeProcessor(p, caseDir, precision=None, polyMeshFormat=None):
+    polyMesh, rank = decomposedMesh
+    polyMeshFormat = polyMeshFormat or {}
+    local, addressing = processorMesh(polyMesh, rank, p)
+    directory = os.path.join(caseDir, "processor%d" % p, "constant", "polyMesh")
+    local.write(directory, precision, **polyMeshFormat)
+    writeAddressing(addressing, directory, **polyMeshFormat)
+    return local.nCells
+
+def writeDecomposed(mesh, setup, nProcs, caseDir='.', precision=None, polyMeshFormat=None, workers=None):
+    """
+    Writes the direct polyMesh of 'mesh' decomposed into nProcs axial slabs,
+    as <caseDir>/processor<p>/constant/polyMesh, the processors being written
+    by 'workers' processes. Returns the number of cells of each processor.
+    """
+    if setup["unitCell"]:
+        raise ValueError("the cyclic ends of a unit cell cannot be decomposed, use decomposePar")
+    if precision is None:
+        precision = mesh.writePrecision
+    polyMesh = buildPolyMesh(mesh)
+    rank = axialPartition(polyMesh, setup, nProcs)
+    if multiprocessing.current_process().daemon:
+        initProcessorWorker(polyMesh, rank)
+        return [writeProcessor(p, caseDir, precision, polyMeshFormat) for p in range(nProcs)]
+    with ProcessPoolExecutor(max_workers=min(workers or os.cpu_count() or 1, nProcs),
+                             initializer=initProcessorWorker, initargs=(polyMesh, rank)) as pool:
+        return list(pool.map(writeProcessor, range(nProcs), itertools.repeat(caseDir),
+                             itertools.repeat(precision), itertools.repeat(polyMeshFormat)))
+
+###################################################################################################################################################
+#########################----------------------------------------- CELL DECOMPOSITION -----------------------------------------#########################
+###################################################################################################################################################
 
+# blockMesh numbers the cells block after block, in the order of the blocks
+# list, and within a block with i fastest, then j, then k. The rank of every
+# cell of a decomposition into axial slabs therefore follows from the block
+# sizes alone: each block is a stack of layers of cells along its axial
+# direction, the layers (with their z and number of cells) are split into
+# slabs balanced by cell count and cut at pellet interfaces, and the rank of
+# each layer is broadcast over the (k, j, i) index space of its block. The
+# result is written as the labelList constant/cellDecomposition read by the
+# 'manual' method of decomposePar, with the matching decomposeParDict.
+
+def cellDecomposition(mesh, setup, nRanks):
+    """
+    Returns the rank of every cell of the blockMesh of 'mesh' for nRanks
+    axial slabs, in the blockMesh cell order.
+    """
+    cells = mesh.blocks.cells.view
+    axial, nLayers, layerZ, layerCells = cellLayers(mesh)
+
+    interfaces, cladBoundaries = pelletInterfaces(setup)
+    layerRank = np.searchsorted(balancedCuts(layerZ, layerCells, interfaces, nRanks), layerZ)
+    if np.any(np.bincount(layerRank, layerCells, minlength=nRanks) == 0):
+        raise ValueError("the rod has too few pellets for %d ranks" % nRanks)
+
+    ranks = []
+    start = 0
+    for (ni, nj, nk), axis, n in zip(cells.tolist(), axial.tolist(), nLayers.tolist()):
+        shape = [1, 1, 1]
+        shape[2 - axis] = n
+        ranks.append(np.broadcast_to(layerRank[start:start + n].reshape(shape), (nk, nj, ni)).ravel())
+        start += n
+    return np.concatenate(ranks) if ranks else np.zeros(0, dtype=int)
+
+def iterDecomposeParDict(nRanks):
+    yield from iterFoamHeader("dictionary", "decomposeParDict", location="system")
+    yield "numberOfSubdomains %d;\n\n" % nRanks
+    yield "method          manual;\n\n"
+    yield "manualCoeffs\n{\n    dataFile        \"cellDecomposition\";\n}\n"
+    yield "\n// ************************************************************************* //\n"
+
+def writeCellDecomposition(mesh, setup, nRanks, caseDir='.', force=False):
+    # writes <caseDir>/constant/cellDecomposition and the matching
+    # <caseDir>/system/decomposeParDict, and returns the cells of each rank
+    # and the path of the dictionary. An existing decomposeParDict is kept
+    # (unless 'force'): the dictionary then goes to decomposeParDict.rodMaker
+    ranks = cellDecomposition(mesh, setup, nRanks)
+    os.makedirs(os.path.join(caseDir, 'constant'), exist_ok=True)
+    with BufferedSink(os.path.join(caseDir, 'constant', 'cellDecomposition')) as sink:
+        sink.writelines(iterFoamHeader("labelList", "cellDecomposition", location="constant"))
+        sink.writelines(iterList("%d\n", ranks[:, None]))
+        sink.write("\n// ************************************************************************* //\n")
+    os.makedirs(os.path.join(caseDir, 'system'), exist_ok=True)
+    path = os.path.join(caseDir, 'system', 'decomposeParDict')
+    if os.path.exists(path) and not force:
+        path += ".rodMaker"
+    with BufferedSink(path) as sink:
+        sink.writelines(iterDecomposeParDict(nRanks))
+    return np.bincount(ranks, minlength=nRanks), path
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='rodMaker',
+        description="Build the blockMeshDict of a fuel rod from its rodDict. Without arguments "
+                    "the 'rodDict' of the current directory is written to 'blockMeshDict'.")
+    parser.add_argument('--direct', action='store_true', help="write constant/polyMesh directly instead of the blockMeshDict")
+    parser.add_argument('--binary', action='store_true', help="with --direct, write points, faces, owner and neighbour in binary format")
+    parser.add_argument('--label-size', type=int, choices=(32, 64), help="with --binary, bits of the labels (default: 32)")
+    parser.add_argument('--scalar-size', type=int, choices=(32, 64), help="with --binary, bits of the scalars (default: 64)")
+    parser.add_argument('--incremental', action='store_true',
+                        help="keep a blockMeshDict.sections sidecar and only regenerate the sections that changed since the last run")
+    parser.add_argument('--segments', type=int, default=None, metavar='K',
+                        help="cut the rod into K axial segments under segments/, meshed concurrently by Allrun.segments")
+    parser.add_argument('--processors', type=int, default=None, metavar='N',
+                        help="with --direct, write processor<p>/constant/polyMesh for N axial slabs instead of constant/polyMesh")
+    parser.add_argument('--decompose', type=int, default=None, metavar='N',
+                        help="also write a manual constant/cellDecomposition of N axial slabs and its system/decomposeParDict")
+    parser.add_argument('--force', action='store_true', help="with --decompose, replace an existing system/decomposeParDict")
+    subparsers = parser.add_subparsers(dest='command')
+
+    batch = subparsers.add_parser('batch', help="build many cases in parallel, each into <case>/system/blockMeshDict")
+    batch.add_argument('cases', nargs='+', help="rodDict files, case directories or glob patterns")
+    batch.add_argument('-j', '--workers', type=int, default=None, help="number of worker processes (default: CPU count)")
+    batch.add_argument('--precision', type=int, default=None, help="significant digits of the written coordinates")
+    batch.add_argument('--cache', default=os.environ.get('RODMAKER_CACHE'), help="output cache directory (default: $RODMAKER_CACHE)")
+    batch.add_argument('--cache-size', type=float, default=1024, help="cache size limit in MB (default: 1024)")
+    batch.add_argument('--polymesh', action='store_true', help="also restore the cached constant/polyMesh on cache hits")
+    batch.add_argument('--direct', action='store_true', help="write <case>/constant/polyMesh directly instead of the blockMeshDict")
+    batch.add_argument('--binary', action='store_true', help="with --direct, write points, faces, owner and neighbour in binary format")
+    batch.add_argument('--label-size', type=int, choices=(32, 64), help="with --binary, bits of the labels (default: 32)")
+    batch.add_argument('--scalar-size', type=int, choices=(32, 64), help="with --binary, bits of the scalars (default: 64)")
+
+    storePolyMesh = subparsers.add_parser('cache-polymesh', help="store the constant/polyMesh made by blockMesh in the output cache")
+    storePolyMesh.add_argument('cases', nargs='+', help="rodDict files, case directories or glob patterns")
+    storePolyMesh.add_argument('--cache', default=os.environ.get('RODMAKER_CACHE'), help="output cache directory (default: $RODMAKER_CACHE)")
+    storePolyMesh.add_argument('--cache-size', type=float, default=1024, help="cache size limit in MB (default: 1024)")
+    storePolyMesh.add_argument('--precision', type=int, default=None, help="significant digits given to the batch run of these cases")
+
+    sweep = subparsers.add_parser('sweep', help="expand a sweepDict into case directories with a manifest")
+    sweep.add_argument('sweepDict', nargs='?', default='sweepDict', help="sweep specification (default: sweepDict)")
+    sweep.add_argument('-o', '--output', default=None, help="output directory (default: 'outputDir' of the sweepDict)")
+    sweep.add_argument('-j', '--workers', type=int, default=None, help="number of worker processes (default: CPU count)")
+
+    assembly = subparsers.add_parser('assembly', help="build a lattice of rods described by an assemblyDict into a single mesh")
+    assembly.add_argument('assemblyDict', nargs='?', default='assemblyDict', help="assembly specification (default: assemblyDict)")
+    assembly.add_argument('-o', '--output', default=None, help="output directory (default: 'outputDir' of the assemblyDict)")
+    assembly.add_argument('-j', '--workers', type=int, default=None, help="number of worker processes (default: CPU count)")
+    assembly.add_argument('--direct', action='store_true', help="write <output>/constant/polyMesh directly instead of the blockMeshDict")
+    assembly.add_argument('--binary', action='store_true', help="with --direct, write points, faces, owner and neighbour in binary format")
+    assembly.add_argument('--label-size', type=int, choices=(32, 64), help="with --binary, bits of the labels (default: 32)")
+    assembly.add_argument('--scalar-size', type=int, choices=(32, 64), help="with --binary, bits of the scalars (default: 64)")
+
+    ensemble = subparsers.add_parser('ensemble', help="write realizations of the random pellet eccentricity of a 3D rod")
+    ensemble.add_argument('rodDict', nargs='?', default='rodDict', help="rod specification (default: rodDict)")
+    ensemble.add_argument('-n', '--realizations', type=int, required=True, help="number of realizations")
+    ensemble.add_argument('--seed', type=int, default=None, help="seed of the shifts (default: drawn and recorded in the manifest)")
+    ensemble.add_argument('--distribution', choices=ECCENTRICITY_DISTRIBUTIONS, default='disk', help="distribution of the shifts (default: disk)")
+    ensemble.add_argument('-o', '--output', default='ensemble', help="output directory (default: ensemble)")
+    ensemble.add_argument('--precision', type=int, default=None, help="significant digits of the written coordinates")
+    ensemble.add_argument('--direct', action='store_true', help="write <realization>/constant/polyMesh directly instead of the blockMeshDict")
+    ensemble.add_argument('--binary', action='store_true', help="with --direct, write points, faces, owner and neighbour in binary format")
+    ensemble.add_argument('--label-size', type=int, choices=(32, 64), help="with --binary, bits of the labels (default: 32)")
+    ensemble.add_argument('--scalar-size', type=int, choices=(32, 64), help="with --binary, bits of the scalars (default: 64)")
+
+    args = parser.parse_args(argv)
+    polyMeshFormat = None
+    if hasattr(args, 'binary'):
+        # the format options only apply to the polyMesh written by --direct
+        if args.binary and not args.direct:
+            parser.error("--binary needs --direct")
+        for option, value in (('--label-size', args.label_size), ('--scalar-size', args.scalar_size)):
+            if value is not None and not args.binary:
+                parser.error("%s needs --binary and --direct" % option)
+        if args.binary:
+            polyMeshFormat = {'binary': True, 'labelSize': args.label_size or 32, 'scalarSize': args.scalar_size or 64}
+
+    cache = None
+    if getattr(args, 'cache', None):
+        cache = OutputCache(args.cache, int(args.cache_size*(1 << 20)))
+        os.makedirs(cache.root, exist_ok=True)
+
+    if args.command == 'batch':
+        results = runBatch(findRodDicts(args.cases), args.workers, args.precision, cache, args.polymesh, args.direct, polyMeshFormat)
+        return 1 if any(r[2] is not None for r in results) else 0
+
+    if args.command == 'cache-polymesh':
+        if cache is None:
+            parser.error("no cache directory given (--cache or $RODMAKER_CACHE)")
+        cachePolyMeshes(findRodDicts(args.cases), cache, args.precision)
+        return 0
 
+    if args.command == 'assembly':
+        runAssembly(readRodDict(args.assemblyDict), os.path.dirname(os.path.abspath(args.assemblyDict)),
+                    args.output, args.workers, args.direct, polyMeshFormat)
+        return 0
 
-# finding the minimum gap width along the whole rod, used for the case when
-# simulating randoom pellet eccentricity in 3D case by 'default model'
-if geometry=='3D' and eccentricity and eccentricity_mode=='default':
-    max_rOuterFuel=0
-    for i in range(nBlocksFuel):
-        rOuter=fuel_blocks[i]["rOuter"]
-        if rOuter>max_rOuterFuel:
-            max_rOuterFuel=rOuter
+    if args.command == 'ensemble':
+        runEnsemble(readRodDict(args.rodDict), args.output, args.realizations, args.seed, args.distribution,
+                    args.precision, args.direct, polyMeshFormat)
+        return 0
 
-    min_RInnerClad=100000
-    for i in range(nBlocksClad):
-        rInner=cladding_blocks[i]["rInner"]
-        if rInner<min_RInnerClad:
-            min_RInnerClad=rInner
+    if args.command == 'sweep':
+        manifest = runSweep(readRodDict(args.sweepDict), os.path.dirname(os.path.abspath(args.sweepDict)),
+                            args.output, args.workers)
+        return 1 if any(case.get("error") for case in manifest["cases"]) else 0
 
-    minGap=min_RInnerClad-max_rOuterFuel
+    ###############################################################
+    #### Reading the rodDict file and making the dictionary #######
+    ###############################################################
+    rodDict = readRodDict('rodDict')
 
-# Call the function with your desired file name
-if geometry=="3D" or geometry=="2D-discrete":
+    if args.segments:
+        if args.direct:
+            parser.error("--segments writes blockMeshDicts, it cannot be combined with --direct")
+        runSegments(rodDict, args.segments)
+        return 0
 
-    shiftX=0
-    shiftY=0
+    if args.processors and not args.direct:
+        parser.error("--processors needs --direct")
 
-    for i in range(nBlocksFuel):
-        for j in range(nPelletsFuel[i]):
-           
-            if geometry=='3D': 
-                if eccentricity:
-                    if eccentricity_mode=='default':
-                        shiftX=random.uniform(-minGap, minGap)
-                        shiftY=random.uniform(-minGap, minGap)
-                    else:
-                        shiftX=eccVector[i_global-1][0]
-                        shiftY=eccVector[i_global-1][1]             
-
-            addSpheres(list_spheres,fuel_blocks[i], global_fuel_offset, geometry, shiftX, shiftY)
-            addPelletVertices(list_vertices, fuel_blocks[i], global_fuel_offset, geometry, shiftX, shiftY)
-            addFuelBlocks(list_blocks, fuel_blocks[i], i_vertex, geometry)
-            addFuelEdges(list_edges, fuel_blocks[i], i_vertex, global_fuel_offset, geometry, shiftX, shiftY)
-            i_sphere = addFaceProjections(list_projection_faces, fuel_blocks[i], i_vertex, i_sphere, geometry)
-            addFuelToPatchDict(patchDict, mergePatchDict, fuel_blocks[i], mergeFuelPatchPairs, totalPelletNumber, bottomCap, topCap, i_vertex, i_global, geometry)
-            i_vertex+=fuel_blocks[i]['nVertices']
-            global_fuel_offset+=fuel_blocks[i]['height']
-            i_global+=1
+    mesh = build_rod(rodDict)
 
+    if args.decompose:
+        nCells, path = writeCellDecomposition(mesh, setupRod(rodDict), args.decompose, force=args.force)
+        sys.stdout.write("cellDecomposition: %d ranks (%s cells)\n" % (len(nCells), "/".join(map(str, nCells))))
+        if not path.endswith("decomposeParDict"):
+            sys.stdout.write("system/decomposeParDict exists and was kept (--force replaces it); use the new one with\n"
+                             "    decomposePar -decomposeParDict %s\n" % path)
 
-    i_global=1
-    for i in range(nBlocksClad):
-            addCladVertices(list_vertices, cladding_blocks[i], global_clad_offset, geometry)
-            addCladBlocks(list_blocks, cladding_blocks[i], i_vertex, geometry)
-            addCladEdges(list_edges, cladding_blocks[i], i_vertex, global_clad_offset, geometry)
-            addCladToPatchDict(patchDict, mergePatchDict, cladding_blocks[i], mergeCladPatchPairs, nBlocksClad, i_vertex, i_global, geometry)
-            i_vertex+=cladding_blocks[i]['nVertices']
-            global_clad_offset+=cladding_blocks[i]['height']
-            i_global+=1
-
-
-
-
-##################################################################
-##### Now, all od the parameters are set up...####################
-## The only thing left is to write them in the blockMeshDict :) ##
-##################################################################
-
-file = open("blockMeshDict", "w+")
-writeHeader(file)
-file.write("\nconvertToMeters " + str(convertToMeters) + "; \n\n")
-writeGeometry(list_spheres,file)
-writeVertices(list_vertices,file)
-writeBlocks(list_blocks, file)
-writeEdges(list_edges, file)
-writeFaceProjections(list_projection_faces, file)
-writeBoundaries(patchDict, file)
-writeMergedPatches(mergePatchDict, file)
-
-'''
-# Function to print variables to a file
-def print_variables_to_file(filename):
-    with open(filename, 'w') as file:
-        for name, value in globals().items():
-            # Optionally, filter out built-in variables and modules
-            if not name.startswith('__') and not hasattr(value, '__call__'):
-                file.write(f"{name}: {value}\n")
-
-# Call the function with your desired file name
-print_variables_to_file('variables.txt')
-'''
\ No newline at end of file
+    if args.processors:
+        nCells = writeDecomposed(mesh, setupRod(rodDict), args.processors, '.', None, polyMeshFormat)
+        sys.stdout.write("%d processors (%s cells)\n" % (len(nCells), "/".join(map(str, nCells))))
+        return 0
+
+    if args.direct:
+        mesh.writePolyMesh(os.path.join("constant", "polyMesh"), **(polyMeshFormat or {}))
+        return 0
+
+    ##################################################################
+    ##### Now, all od the parameters are set up...####################
+    ## The only thing left is to write them in the blockMeshDict :) ##
+    ##################################################################
+    mesh.write("blockMeshDict", incremental=args.incremental)
+
+if __name__ == "__main__":
+    sys.exit(main())